@@ -0,0 +1,176 @@
+"""event_log: monthly RANGE partitioning, hourly rollups
+
+Revision ID: 0001_event_log_partitioning
+Revises:
+Create Date: 2026-10-17
+
+Первая ревизия, но не базовая: до неё схема создавалась без Alembic (baseline-модели),
+и миграция рассчитывает, что таблицы baseline уже есть — в частности event_log
+с integer id на event_log_id_seq, а также tasks / outbox_messages / webhook_dedup.
+Новая база: сначала baseline-схема, затем alembic upgrade head.
+"""
+from __future__ import annotations
+
+from datetime import date, datetime, timezone
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0001_event_log_partitioning"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+MONTHS_AHEAD = 2
+
+
+def _add_months(d: date, n: int) -> date:
+    m = d.month - 1 + n
+    return date(d.year + m // 12, m % 12 + 1, 1)
+
+
+def upgrade() -> None:
+    conn = op.get_bind()
+
+    # 1) старая таблица уходит в сторону; sequence переживёт её удаление
+    op.execute("ALTER TABLE event_log RENAME TO event_log_legacy")
+    op.execute("ALTER SEQUENCE event_log_id_seq OWNED BY NONE")
+    # sequence от SERIAL — integer и упрётся в 2^31 раньше, чем BIGINT-колонка
+    op.execute("ALTER SEQUENCE event_log_id_seq AS bigint")
+    op.execute("ALTER TABLE event_log_legacy DROP CONSTRAINT event_log_pkey")
+
+    op.execute(
+        """
+        CREATE TABLE event_log (
+            id BIGINT NOT NULL DEFAULT nextval('event_log_id_seq'),
+            ts TIMESTAMPTZ NOT NULL DEFAULT now(),
+            event_name VARCHAR(128) NOT NULL,
+            appointment_id INTEGER,
+            client_id INTEGER,
+            task_id INTEGER,
+            outbox_id INTEGER,
+            template_key VARCHAR(64),
+            template_version INTEGER,
+            meta_json JSON NOT NULL,
+            CONSTRAINT event_log_pkey PRIMARY KEY (id, ts)
+        ) PARTITION BY RANGE (ts)
+        """
+    )
+    op.execute("ALTER SEQUENCE event_log_id_seq OWNED BY event_log.id")
+    op.execute("CREATE TABLE event_log_default PARTITION OF event_log DEFAULT")
+
+    # 2) месячные партиции: от самого старого события до текущего месяца + MONTHS_AHEAD
+    oldest = conn.execute(sa.text("SELECT min(ts) FROM event_log_legacy")).scalar()
+    today = datetime.now(timezone.utc).date()
+    lo = date((oldest or today).year, (oldest or today).month, 1)
+    last = _add_months(date(today.year, today.month, 1), MONTHS_AHEAD)
+    while lo <= last:
+        hi = _add_months(lo, 1)
+        op.execute(
+            f"CREATE TABLE event_log_y{lo.year}m{lo.month:02d} PARTITION OF event_log "
+            f"FOR VALUES FROM ('{lo.isoformat()}') TO ('{hi.isoformat()}')"
+        )
+        lo = hi
+
+    # 3) почасовые агрегаты + statement-level триггер
+    op.execute(
+        """
+        CREATE TABLE event_rollup_hourly (
+            bucket TIMESTAMPTZ NOT NULL,
+            event_name VARCHAR(128) NOT NULL,
+            template_key VARCHAR(64) NOT NULL DEFAULT '',
+            template_version INTEGER NOT NULL DEFAULT 0,
+            count BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, event_name, template_key, template_version)
+        )
+        """
+    )
+    op.execute(
+        """
+        CREATE FUNCTION event_log_rollup() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO event_rollup_hourly AS r (bucket, event_name, template_key, template_version, count)
+            SELECT date_trunc('hour', ts AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+                   event_name,
+                   coalesce(template_key, ''),
+                   coalesce(template_version, 0),
+                   count(*)
+            FROM new_rows
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT (bucket, event_name, template_key, template_version)
+            DO UPDATE SET count = r.count + EXCLUDED.count;
+            RETURN NULL;
+        END
+        $$
+        """
+    )
+
+    # 4) перенос данных (триггер ещё не создан — агрегаты строим одним запросом ниже)
+    op.execute(
+        """
+        INSERT INTO event_log (id, ts, event_name, appointment_id, client_id, task_id, outbox_id,
+                               template_key, template_version, meta_json)
+        SELECT id, ts, event_name, appointment_id, client_id, task_id, outbox_id,
+               template_key, template_version, coalesce(meta_json, '{}'::json)
+        FROM event_log_legacy
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO event_rollup_hourly (bucket, event_name, template_key, template_version, count)
+        SELECT date_trunc('hour', ts AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+               event_name, coalesce(template_key, ''), coalesce(template_version, 0), count(*)
+        FROM event_log
+        GROUP BY 1, 2, 3, 4
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER trg_event_log_rollup
+        AFTER INSERT ON event_log
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION event_log_rollup()
+        """
+    )
+    op.execute("DROP TABLE event_log_legacy")
+
+    # 5) индексы (на родителе — создаются на всех партициях)
+    op.create_index("ix_event_log_event_name_ts", "event_log", ["event_name", "ts"])
+    op.create_index("ix_event_log_appointment_id", "event_log", ["appointment_id"])
+    op.create_index("ix_event_log_outbox_id", "event_log", ["outbox_id"])
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER IF EXISTS trg_event_log_rollup ON event_log")
+    op.execute("DROP FUNCTION IF EXISTS event_log_rollup()")
+    op.drop_table("event_rollup_hourly")
+
+    op.execute("ALTER TABLE event_log RENAME TO event_log_partitioned")
+    op.execute("ALTER SEQUENCE event_log_id_seq OWNED BY NONE")
+    op.execute("ALTER INDEX ix_event_log_appointment_id RENAME TO ix_event_log_appointment_id_p")
+    op.execute("ALTER INDEX ix_event_log_outbox_id RENAME TO ix_event_log_outbox_id_p")
+    op.execute("ALTER TABLE event_log_partitioned RENAME CONSTRAINT event_log_pkey TO event_log_partitioned_pkey")
+    op.execute(
+        """
+        CREATE TABLE event_log (
+            id INTEGER NOT NULL DEFAULT nextval('event_log_id_seq') PRIMARY KEY,
+            ts TIMESTAMPTZ NOT NULL DEFAULT now(),
+            event_name VARCHAR(128) NOT NULL,
+            appointment_id INTEGER,
+            client_id INTEGER,
+            task_id INTEGER,
+            outbox_id INTEGER,
+            template_key VARCHAR(64),
+            template_version INTEGER,
+            meta_json JSON NOT NULL
+        )
+        """
+    )
+    op.execute("ALTER SEQUENCE event_log_id_seq OWNED BY event_log.id")
+    # не пройдёт, если sequence уже вышла за 2^31 — тогда и integer id откат не вместит
+    op.execute("ALTER SEQUENCE event_log_id_seq AS integer")
+    op.execute("INSERT INTO event_log SELECT * FROM event_log_partitioned")
+    op.execute("DROP TABLE event_log_partitioned CASCADE")
+
+    for col in ("ts", "event_name", "appointment_id", "client_id", "task_id", "outbox_id", "template_key"):
+        op.create_index(f"ix_event_log_{col}", "event_log", [col])
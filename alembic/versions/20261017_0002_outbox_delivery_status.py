@@ -0,0 +1,41 @@
+"""outbox: delivery statuses, unique provider_message_id
+
+Revision ID: 0002_outbox_delivery_status
+Revises: 0001_event_log_partitioning
+Create Date: 2026-10-17
+"""
+from __future__ import annotations
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0002_outbox_delivery_status"
+down_revision = "0001_event_log_partitioning"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # новые значения enum нельзя использовать в той же транзакции, где они добавлены
+    with op.get_context().autocommit_block():
+        for value in ("sending", "delivered", "read"):
+            op.execute(f"ALTER TYPE outboxstatus ADD VALUE IF NOT EXISTS '{value}'")
+
+    op.add_column("outbox_messages", sa.Column("delivered_at", sa.DateTime(timezone=True), nullable=True))
+    op.add_column("outbox_messages", sa.Column("read_at", sa.DateTime(timezone=True), nullable=True))
+
+    # пустые id (ответ без messages[0].id) не должны конфликтовать в уникальном индексе
+    op.execute("UPDATE outbox_messages SET provider_message_id = NULL WHERE provider_message_id = ''")
+    op.create_index(
+        "uq_outbox_provider_message_id",
+        "outbox_messages",
+        ["provider_message_id"],
+        unique=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("uq_outbox_provider_message_id", table_name="outbox_messages")
+    op.drop_column("outbox_messages", "read_at")
+    op.drop_column("outbox_messages", "delivered_at")
+    # значения enum в PostgreSQL не удаляются; оставляем как есть
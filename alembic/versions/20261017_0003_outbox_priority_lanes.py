@@ -0,0 +1,79 @@
+"""tasks/outbox: priority lanes and deadlines
+
+Revision ID: 0003_outbox_priority_lanes
+Revises: 0002_outbox_delivery_status
+Create Date: 2026-10-17
+"""
+from __future__ import annotations
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0003_outbox_priority_lanes"
+down_revision = "0002_outbox_delivery_status"
+branch_labels = None
+depends_on = None
+
+# см. app.db.models.Lane и app.services.task_plan.default_task_specs
+URGENT_TYPES = ("send_created", "reminder_2h")
+BULK_TYPES = ("rebook_invite",)
+URGENT_TEMPLATES = ("APPT_CREATED", "REMINDER_2H")
+BULK_TEMPLATES = ("REBOOK_INVITE",)
+STARTS_AT_DEADLINE_TYPES = ("send_created", "reminder_2h", "reminder_24h")
+
+
+def _in(values: tuple[str, ...]) -> str:
+    return ", ".join(f"'{v}'" for v in values)
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TYPE outboxstatus ADD VALUE IF NOT EXISTS 'expired'")
+
+    for table in ("tasks", "outbox_messages"):
+        op.add_column(table, sa.Column("priority", sa.SmallInteger(), nullable=False, server_default="1"))
+        op.add_column(table, sa.Column("deadline_at", sa.DateTime(timezone=True), nullable=True))
+
+    # ещё не отправленные строки — в свои полосы, напоминаниям — срок = начало визита
+    op.execute(
+        f"""
+        UPDATE tasks SET priority = CASE
+            WHEN type IN ({_in(URGENT_TYPES)}) THEN 0
+            WHEN type IN ({_in(BULK_TYPES)}) THEN 2
+            ELSE 1 END
+        WHERE status IN ('scheduled', 'queued')
+        """
+    )
+    op.execute(
+        f"""
+        UPDATE tasks t SET deadline_at = a.starts_at
+        FROM appointments a
+        WHERE a.id = t.appointment_id
+          AND t.status IN ('scheduled', 'queued')
+          AND t.type IN ({_in(STARTS_AT_DEADLINE_TYPES)})
+        """
+    )
+    op.execute(
+        f"""
+        UPDATE outbox_messages o SET
+            priority = CASE
+                WHEN o.template_key IN ({_in(URGENT_TEMPLATES)}) THEN 0
+                WHEN o.template_key IN ({_in(BULK_TEMPLATES)}) THEN 2
+                ELSE 1 END,
+            deadline_at = t.deadline_at
+        FROM tasks t
+        WHERE t.id = o.task_id AND o.status IN ('queued', 'sending')
+        """
+    )
+
+    op.execute("DROP INDEX IF EXISTS ix_outbox_queue")
+    op.create_index("ix_outbox_queue", "outbox_messages", ["status", "priority", "created_at"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_outbox_queue", table_name="outbox_messages")
+    op.create_index("ix_outbox_queue", "outbox_messages", ["status", "created_at"])
+    for table in ("tasks", "outbox_messages"):
+        op.drop_column(table, "deadline_at")
+        op.drop_column(table, "priority")
+    # значение enum 'expired' остаётся (PostgreSQL не удаляет значения enum)
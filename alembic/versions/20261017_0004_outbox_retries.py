@@ -0,0 +1,37 @@
+"""outbox: retry attempts, next_attempt_at, dead_letter
+
+Revision ID: 0004_outbox_retries
+Revises: 0003_outbox_priority_lanes
+Create Date: 2026-10-17
+"""
+from __future__ import annotations
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0004_outbox_retries"
+down_revision = "0003_outbox_priority_lanes"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TYPE outboxstatus ADD VALUE IF NOT EXISTS 'dead_letter'")
+
+    op.add_column("outbox_messages", sa.Column("attempts", sa.Integer(), nullable=False, server_default="0"))
+    op.add_column("outbox_messages", sa.Column("next_attempt_at", sa.DateTime(timezone=True), nullable=True))
+    # существующая очередь сохраняет порядок created_at
+    op.execute("UPDATE outbox_messages SET next_attempt_at = created_at")
+    op.alter_column("outbox_messages", "next_attempt_at", nullable=False, server_default=sa.text("now()"))
+
+    op.drop_index("ix_outbox_queue", table_name="outbox_messages")
+    op.create_index("ix_outbox_queue", "outbox_messages", ["status", "priority", "next_attempt_at"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_outbox_queue", table_name="outbox_messages")
+    op.create_index("ix_outbox_queue", "outbox_messages", ["status", "priority", "created_at"])
+    op.drop_column("outbox_messages", "next_attempt_at")
+    op.drop_column("outbox_messages", "attempts")
+    # значение enum 'dead_letter' остаётся (PostgreSQL не удаляет значения enum)
@@ -0,0 +1,54 @@
+"""outbox: one message per (task_id, template_key)
+
+Revision ID: 0005_outbox_task_template_unique
+Revises: 0004_outbox_retries
+Create Date: 2026-10-17
+"""
+from __future__ import annotations
+
+from alembic import op
+
+revision = "0005_outbox_task_template_unique"
+down_revision = "0004_outbox_retries"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Исторические дубли (task_id, template_key) любых статусов: оставляем одну строку на пару —
+    # самую "продвинувшуюся" (read > delivered > sent > sending > queued > прочие), при равенстве — раннюю.
+    # Остальные удаляем: иначе уникальный индекс не создастся как раз там, где были двойные отправки.
+    # event_log ссылается на outbox_id без FK, история событий сохраняется.
+    op.execute(
+        """
+        DELETE FROM outbox_messages o
+        USING (
+            SELECT id,
+                   row_number() OVER (
+                       PARTITION BY task_id, template_key
+                       ORDER BY CASE status::text
+                                    WHEN 'read' THEN 0
+                                    WHEN 'delivered' THEN 1
+                                    WHEN 'sent' THEN 2
+                                    WHEN 'sending' THEN 3
+                                    WHEN 'queued' THEN 4
+                                    ELSE 5
+                                END,
+                                id
+                   ) AS rn
+            FROM outbox_messages
+        ) ranked
+        WHERE ranked.id = o.id
+          AND ranked.rn > 1
+        """
+    )
+    op.create_index(
+        "uq_outbox_task_template",
+        "outbox_messages",
+        ["task_id", "template_key"],
+        unique=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("uq_outbox_task_template", table_name="outbox_messages")
@@ -0,0 +1,49 @@
+"""companies (tenants) and per-sender outbox queue
+
+Revision ID: 0006_companies
+Revises: 0005_outbox_task_template_unique
+Create Date: 2026-10-17
+"""
+from __future__ import annotations
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0006_companies"
+down_revision = "0005_outbox_task_template_unique"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "companies",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("name", sa.String(256), nullable=False),
+        sa.Column("altegio_company_id", sa.Integer(), nullable=False, unique=True),
+        sa.Column("altegio_api_token", sa.Text(), nullable=True),
+        sa.Column("altegio_webhook_secret", sa.String(256), nullable=True),
+        sa.Column("whatsapp_phone_number_id", sa.String(64), nullable=True),
+        sa.Column("whatsapp_token", sa.Text(), nullable=True),
+        sa.Column("is_active", sa.Boolean(), nullable=False, server_default="true"),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+    )
+    op.create_index("ix_companies_whatsapp_phone_number_id", "companies", ["whatsapp_phone_number_id"])
+
+    # существующие сообщения остаются на номере по умолчанию (NULL)
+    op.add_column("outbox_messages", sa.Column("phone_number_id", sa.String(64), nullable=True))
+
+    op.drop_index("ix_outbox_queue", table_name="outbox_messages")
+    op.create_index(
+        "ix_outbox_queue",
+        "outbox_messages",
+        ["status", "phone_number_id", "priority", "next_attempt_at"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_outbox_queue", table_name="outbox_messages")
+    op.create_index("ix_outbox_queue", "outbox_messages", ["status", "priority", "next_attempt_at"])
+    op.drop_column("outbox_messages", "phone_number_id")
+    op.drop_index("ix_companies_whatsapp_phone_number_id", table_name="companies")
+    op.drop_table("companies")
@@ -0,0 +1,28 @@
+"""outbox: sender lease columns (locked_by, locked_until)
+
+Revision ID: 0007_outbox_lease
+Revises: 0006_companies
+Create Date: 2026-10-17
+"""
+from __future__ import annotations
+
+from alembic import op
+
+revision = "0007_outbox_lease"
+down_revision = "0006_companies"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # IF NOT EXISTS: базы, поднятые через create_all, колонки уже имеют
+    op.execute("ALTER TABLE outbox_messages ADD COLUMN IF NOT EXISTS locked_by VARCHAR(128)")
+    op.execute("ALTER TABLE outbox_messages ADD COLUMN IF NOT EXISTS locked_until TIMESTAMP WITH TIME ZONE")
+    # reclaim: WHERE status = 'sending' AND locked_until < now()
+    op.execute("CREATE INDEX IF NOT EXISTS ix_outbox_lease ON outbox_messages (status, locked_until)")
+
+
+def downgrade() -> None:
+    op.drop_index("ix_outbox_lease", table_name="outbox_messages")
+    op.drop_column("outbox_messages", "locked_until")
+    op.drop_column("outbox_messages", "locked_by")
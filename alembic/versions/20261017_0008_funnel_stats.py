@@ -0,0 +1,44 @@
+"""analytics: template_funnel_stats and analytics_watermarks
+
+Revision ID: 0008_funnel_stats
+Revises: 0007_outbox_lease
+Create Date: 2026-10-17
+"""
+from __future__ import annotations
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0008_funnel_stats"
+down_revision = "0007_outbox_lease"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "template_funnel_stats",
+        sa.Column("template_key", sa.String(64), primary_key=True),
+        sa.Column("template_version", sa.Integer(), primary_key=True),
+        sa.Column("queued", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.Column("sent", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.Column("failed", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.Column("delivered", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.Column("read", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.Column("queued_to_sent_hist", sa.JSON(), nullable=False, server_default="[]"),
+        sa.Column("sent_to_delivered_hist", sa.JSON(), nullable=False, server_default="[]"),
+        sa.Column("sent_to_read_hist", sa.JSON(), nullable=False, server_default="[]"),
+        sa.Column("updated_at", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+    )
+    op.create_table(
+        "analytics_watermarks",
+        sa.Column("name", sa.String(64), primary_key=True),
+        sa.Column("last_event_id", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.Column("pending_ids", sa.JSON(), nullable=False, server_default="[]"),
+        sa.Column("updated_at", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("analytics_watermarks")
+    op.drop_table("template_funnel_stats")
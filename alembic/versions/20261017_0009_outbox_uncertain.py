@@ -0,0 +1,24 @@
+"""outbox: 'uncertain' status for sends without a provider response
+
+Revision ID: 0009_outbox_uncertain
+Revises: 0008_funnel_stats
+Create Date: 2026-10-17
+"""
+from __future__ import annotations
+
+from alembic import op
+
+revision = "0009_outbox_uncertain"
+down_revision = "0008_funnel_stats"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TYPE outboxstatus ADD VALUE IF NOT EXISTS 'uncertain'")
+
+
+def downgrade() -> None:
+    # значения enum в PostgreSQL не удаляются; оставляем как есть
+    pass
@@ -1,7 +1,17 @@
 from __future__ import annotations
 
+from app.api.routes.analytics import router as analytics_router
 from app.api.routes.health import router as health_router
+from app.api.routes.metrics import router as metrics_router
 from app.api.routes.templates import router as templates_router
 from app.api.routes.webhook_altegio import router as webhook_router
+from app.api.routes.webhook_whatsapp import router as whatsapp_webhook_router
 
-all_routers = [health_router, templates_router, webhook_router]
+all_routers = [
+    health_router,
+    metrics_router,
+    templates_router,
+    analytics_router,
+    webhook_router,
+    whatsapp_webhook_router,
+]
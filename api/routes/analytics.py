@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+from fastapi import APIRouter, Depends
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.api.deps import admin_auth
+from app.db.models import AnalyticsWatermark, TemplateFunnelStats
+from app.db.session import AsyncSessionLocal
+from app.services.funnel import WATERMARK_NAME, latency_summary
+
+router = APIRouter(prefix="/admin/analytics", tags=["analytics"])
+
+
+async def get_db() -> AsyncSession:
+    async with AsyncSessionLocal() as session:
+        yield session
+
+
+def _rate(part: int, total: int) -> float | None:
+    return round(part / total, 4) if total else None
+
+
+@router.get("/funnel", dependencies=[Depends(admin_auth)])
+async def template_funnel(template_key: str | None = None, db: AsyncSession = Depends(get_db)) -> dict:
+    """
+    Воронка queued -> sent/failed -> delivered -> read по версиям шаблонов.
+    Читает только предагрегированную template_funnel_stats (обновляется задачей refresh_funnel_stats).
+    """
+    q = select(TemplateFunnelStats).order_by(TemplateFunnelStats.template_key, TemplateFunnelStats.template_version)
+    if template_key:
+        q = q.where(TemplateFunnelStats.template_key == template_key)
+    items = (await db.execute(q)).scalars().all()
+
+    wm = (
+        await db.execute(select(AnalyticsWatermark).where(AnalyticsWatermark.name == WATERMARK_NAME))
+    ).scalar_one_or_none()
+
+    return {
+        "watermark": {
+            "last_event_id": wm.last_event_id if wm else 0,
+            "updated_at": wm.updated_at if wm else None,
+        },
+        "items": [
+            {
+                "template_key": s.template_key,
+                "template_version": s.template_version,
+                "queued": s.queued,
+                "sent": s.sent,
+                "failed": s.failed,
+                "delivered": s.delivered,
+                "read": s.read,
+                "sent_rate": _rate(s.sent, s.queued),
+                "failed_rate": _rate(s.failed, s.queued),
+                "delivered_rate": _rate(s.delivered, s.sent),
+                "read_rate": _rate(s.read, s.sent),
+                "latency": {
+                    "queued_to_sent": latency_summary(s.queued_to_sent_hist),
+                    "sent_to_delivered": latency_summary(s.sent_to_delivered_hist),
+                    "sent_to_read": latency_summary(s.sent_to_read_hist),
+                },
+            }
+            for s in items
+        ],
+    }
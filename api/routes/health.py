@@ -2,9 +2,17 @@ from __future__ import annotations
 
 from fastapi import APIRouter
 
+from app.db.session import pool_stats
+
 router = APIRouter()
 
 
 @router.get("/health")
 def health() -> dict:
     return {"status": "ok"}
+
+
+@router.get("/health/db-pool")
+def db_pool() -> dict:
+    # пулы соединений этого процесса (воркера uvicorn)
+    return pool_stats()
@@ -0,0 +1,15 @@
+from __future__ import annotations
+
+from fastapi import APIRouter, HTTPException, Response
+
+from app.core import metrics
+
+router = APIRouter()
+
+
+@router.get("/metrics", include_in_schema=False)
+def prometheus_metrics() -> Response:
+    if not metrics.available():
+        raise HTTPException(status_code=503, detail="prometheus_client is not installed")
+    body, content_type = metrics.render_latest()
+    return Response(content=body, media_type=content_type)
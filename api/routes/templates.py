@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import logging
+
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 
@@ -9,10 +11,22 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from app.api.deps import admin_auth
 from app.db.models import MessageTemplate
 from app.db.session import AsyncSessionLocal
+from app.services.templating import publish_templates_changed
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/admin/templates", tags=["templates"])
 
 
+async def _notify_templates_changed(template_id: int) -> None:
+    # изменение уже закоммичено: сбой Redis не должен превращать его в 500 (и в повтор клиента) —
+    # процессы подхватят шаблон по TEMPLATE_CACHE_MAX_AGE_SECONDS
+    try:
+        await publish_templates_changed()
+    except Exception as e:
+        logger.warning("Template change notification failed", extra={"template_id": template_id, "error": str(e)})
+
+
 async def get_db() -> AsyncSession:
     async with AsyncSessionLocal() as session:
         yield session
@@ -67,6 +81,7 @@ async def create_template(payload: TemplateIn, db: AsyncSession = Depends(get_db
     db.add(t)
     await db.commit()
     await db.refresh(t)
+    await _notify_templates_changed(t.id)
     return {"id": t.id, "key": t.key, "language": t.language, "version": t.version}
 
 
@@ -89,5 +104,6 @@ async def update_template(template_id: int, payload: TemplateUpdate, db: AsyncSe
     if changed:
         await db.commit()
         await db.refresh(t)
+        await _notify_templates_changed(t.id)
 
     return {"id": t.id, "key": t.key, "language": t.language, "is_active": t.is_active, "version": t.version}
@@ -6,13 +6,20 @@ import logging
 from datetime import datetime, timezone
 
 from fastapi import APIRouter, Header, HTTPException, Request, status
-from sqlalchemy import select
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.config import settings
-from app.db.models import WebhookDedup
 from app.db.session import AsyncSessionLocal
-from app.tasks.jobs import process_altegio_event  # Celery task
+from app.services import batch_queue, coalesce, event_stream
+from app.services.dedup import claim_event, get_async_redis, release_event
+from app.services.tenants import aload_tenants, tenant_for
+from app.tasks.jobs import (  # Celery tasks
+    KEY_ALTEGIO_EVENTS,
+    drain_altegio_events,
+    process_altegio_event,
+    schedule_appointment_events,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -25,19 +32,30 @@ async def get_db() -> AsyncSession:
 
 
 @router.post("/altegio")
+@router.post("/altegio/{company_id}")
 async def altegio_webhook(
     request: Request,
+    company_id: int | None = None,
     x_altegio_secret: str | None = Header(default=None),
     x_request_id: str | None = Header(default=None),
 ):
-    # 1) simple shared-secret check
-    if x_altegio_secret != settings.ALTEGIO_WEBHOOK_SECRET:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Bad webhook secret")
-
     body_bytes = await request.body()
     if not body_bytes:
         raise HTTPException(status_code=400, detail="Empty body")
 
+    try:
+        payload = json.loads(body_bytes.decode("utf-8"))
+    except Exception:
+        payload = {"raw": body_bytes.decode("utf-8", errors="replace")}
+
+    # 1) салон: из URL, иначе из тела; shared secret — свой у салона (companies) или глобальный
+    if company_id is None and isinstance(payload, dict) and str(payload.get("company_id", "")).isdigit():
+        company_id = int(payload["company_id"])
+    async with AsyncSessionLocal() as db:
+        tenant = tenant_for(await aload_tenants(db), company_id)
+    if x_altegio_secret != tenant.webhook_secret:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Bad webhook secret")
+
     # 2) idempotency key: prefer request id, else sha256(body)
     if x_request_id:
         event_key = f"rid:{x_request_id}"
@@ -45,30 +63,49 @@ async def altegio_webhook(
         digest = hashlib.sha256(body_bytes).hexdigest()
         event_key = f"sha256:{digest}"
 
-    # 3) dedup in DB
-    async with AsyncSessionLocal() as db:
-        exists = await db.execute(
-            select(WebhookDedup).where(WebhookDedup.provider == "altegio", WebhookDedup.event_key == event_key)
-        )
-        if exists.scalar_one_or_none():
-            return {"status": "duplicate_ignored", "event_key": event_key}
-
-        db.add(WebhookDedup(provider="altegio", event_key=event_key))
-        await db.commit()
+    # 3) dedup: Redis SET NX (fast path), БД — ON CONFLICT DO NOTHING
+    if not await claim_event("altegio", event_key):
+        return {"status": "duplicate_ignored", "event_key": event_key}
 
     # 4) enqueue processing into Celery (async -> background)
+    event = {
+        "event_key": event_key,
+        "received_at": datetime.now(timezone.utc).isoformat(),
+        "company_id": tenant.altegio_company_id,
+        "payload": payload,
+    }
+    appointment_key = coalesce.appointment_key(event)
+    # stored: событие уже лежит в Redis — снимать claim после этого нельзя (ретрай Altegio задвоит его)
+    stored = False
     try:
-        payload = json.loads(body_bytes.decode("utf-8"))
+        if settings.ALTEGIO_EVENTS_STREAM:
+            # asyncio-путь: XADD в Redis Stream, обработка — app.tasks.stream_consumer
+            await event_stream.publish(get_async_redis(), event)
+        elif settings.ALTEGIO_COALESCE_SECONDS > 0 and appointment_key:
+            # всплеск событий одной записи -> одно применение последнего состояния через окно
+            window = settings.ALTEGIO_COALESCE_SECONDS
+            first = await coalesce.push(get_async_redis(), appointment_key, event, window)
+            stored = True
+            if first:
+                await run_in_threadpool(schedule_appointment_events, appointment_key, countdown=window)
+        elif settings.ALTEGIO_EVENTS_BATCHING:
+            # микро-батчинг: события копятся в Redis, одна задача применяет их пачкой
+            delay = settings.ALTEGIO_EVENTS_BATCH_DELAY_SECONDS
+            first = await batch_queue.push(get_async_redis(), KEY_ALTEGIO_EVENTS, [event], delay)
+            stored = True
+            if first:
+                await run_in_threadpool(drain_altegio_events.apply_async, countdown=delay)
+        else:
+            # publish в брокер через kombu — блокирующий, не держим им event loop
+            await run_in_threadpool(process_altegio_event.delay, event)
     except Exception:
-        payload = {"raw": body_bytes.decode("utf-8", errors="replace")}
-
-    process_altegio_event.delay(
-        {
-            "event_key": event_key,
-            "received_at": datetime.now(timezone.utc).isoformat(),
-            "payload": payload,
-        }
-    )
+        if stored:
+            # не запланировалась только debounce-задача: событие подберёт периодический sweep/drain
+            logger.exception("Altegio event stored but not scheduled", extra={"event_key": event_key})
+        else:
+            # не смогли поставить в очередь — снимаем claim, чтобы ретрай Altegio не посчитался дублем
+            await release_event("altegio", event_key)
+            raise
 
     logger.info("Altegio webhook accepted", extra={"event_key": event_key})
     return {"status": "accepted", "event_key": event_key}
@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import json
+import logging
+
+from fastapi import APIRouter, Header, HTTPException, Query, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
+
+from app.core.config import settings
+from app.services import batch_queue
+from app.services.dedup import get_async_redis
+from app.services.delivery_status import KEY_STATUS_QUEUE, parse_statuses, verify_signature
+from app.tasks.jobs import apply_whatsapp_statuses  # Celery task
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/webhook", tags=["webhooks"])
+
+
+@router.get("/whatsapp")
+async def whatsapp_verify(
+    hub_mode: str | None = Query(default=None, alias="hub.mode"),
+    hub_verify_token: str | None = Query(default=None, alias="hub.verify_token"),
+    hub_challenge: str | None = Query(default=None, alias="hub.challenge"),
+):
+    # подтверждение подписки при настройке webhook в Meta
+    if hub_mode != "subscribe" or hub_verify_token != settings.WHATSAPP_VERIFY_TOKEN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Verification failed")
+    return PlainTextResponse(hub_challenge or "")
+
+
+@router.post("/whatsapp")
+async def whatsapp_webhook(
+    request: Request,
+    x_hub_signature_256: str | None = Header(default=None),
+):
+    body_bytes = await request.body()
+    if not verify_signature(body_bytes, x_hub_signature_256):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Bad signature")
+
+    try:
+        payload = json.loads(body_bytes.decode("utf-8"))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+
+    # отвечаем сразу: статусы копятся в Redis и применяются пачками Celery-задачей
+    statuses = parse_statuses(payload)
+    delay = settings.WHATSAPP_STATUS_BATCH_DELAY_SECONDS
+    if await batch_queue.push(get_async_redis(), KEY_STATUS_QUEUE, statuses, delay):
+        # публикация в брокер синхронная — не блокируем event loop
+        await run_in_threadpool(apply_whatsapp_statuses.apply_async, countdown=delay)
+
+    return {"status": "accepted", "statuses": len(statuses)}
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Prometheus-метрики горячих путей. prometheus_client — опциональная зависимость:
+# без неё метрики превращаются в no-op, а /metrics и metrics-сервер не поднимаются.
+# Несколько процессов (Celery prefork, uvicorn --workers, SENDER_WORKERS) агрегируются
+# через multiprocess-режим: переменная окружения PROMETHEUS_MULTIPROC_DIR.
+try:
+    import prometheus_client
+    from prometheus_client import CollectorRegistry, Gauge, Histogram
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:  # pragma: no cover
+    prometheus_client = None
+
+# секунды; от быстрого рендера до ожидания слота rate-limit / медленного Graph API
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LAG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def available() -> bool:
+    return prometheus_client is not None
+
+
+def multiprocess_mode() -> bool:
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+class _Noop:
+    def labels(self, *args, **kwargs) -> _Noop:
+        return self
+
+    def observe(self, value: float) -> None:
+        pass
+
+    def set(self, value: float) -> None:
+        pass
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+
+def _histogram(name: str, doc: str, labels: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+    if not available():
+        return _Noop()
+    return Histogram(name, doc, labels, buckets=buckets)
+
+
+def _gauge(name: str, doc: str, labels: tuple[str, ...] = ()):
+    if not available():
+        return _Noop()
+    # multiprocess: значение последнего живого процесса (sender обновляет гейджи из supervisor-а)
+    return Gauge(name, doc, labels, multiprocess_mode="livemostrecent")
+
+
+HTTP_REQUEST_SECONDS = _histogram(
+    "http_request_duration_seconds", "API request latency (webhooks included)", ("method", "route", "status")
+)
+TEMPLATE_RENDER_SECONDS = _histogram("template_render_seconds", "render_template duration", ("template_key",))
+WHATSAPP_SEND_SECONDS = _histogram("whatsapp_send_seconds", "Graph API send_text latency", ("status",))
+RATE_LIMIT_WAIT_SECONDS = _histogram("rate_limit_wait_seconds", "Time spent waiting for a token bucket slot")
+TASK_DUE_LAG_SECONDS = _histogram(
+    "task_due_lag_seconds", "now - planned_at when a due task is materialized into outbox", buckets=LAG_BUCKETS
+)
+OUTBOX_QUEUE_DEPTH = _gauge("outbox_queue_depth", "Queued outbox messages", ("priority",))
+OUTBOX_OLDEST_AGE_SECONDS = _gauge("outbox_oldest_queued_age_seconds", "Age of the oldest queued outbox message")
+
+
+@contextmanager
+def timed(metric, **labels):
+    # исключение тоже попадает в гистограмму: медленная ошибка — тоже латентность
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        (metric.labels(**labels) if labels else metric).observe(time.perf_counter() - start)
+
+
+class _DbPoolCollector:
+    """
+    Пулы соединений процесса (app.db.session.pool_stats) — читаются в момент scrape.
+    """
+
+    def collect(self):
+        from app.db.session import pool_stats
+
+        family = GaugeMetricFamily(
+            "db_pool_connections", "DB pool connections by state", labels=["engine", "role", "state"]
+        )
+        for engine, stats in pool_stats().items():
+            for state in ("size", "checked_in", "checked_out", "overflow"):
+                if state in stats:
+                    family.add_metric([engine, stats["role"], state], stats[state])
+        yield family
+
+
+if available():
+    prometheus_client.REGISTRY.register(_DbPoolCollector())
+
+
+def registry():
+    """
+    Registry для отдачи: в multiprocess-режиме — агрегат по всем процессам + пул текущего.
+    """
+    if not multiprocess_mode():
+        return prometheus_client.REGISTRY
+    from prometheus_client import multiprocess
+
+    reg = CollectorRegistry()
+    multiprocess.MultiProcessCollector(reg)
+    reg.register(_DbPoolCollector())
+    return reg
+
+
+def render_latest() -> tuple[bytes, str]:
+    return prometheus_client.generate_latest(registry()), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def start_metrics_server(port: int) -> bool:
+    """
+    Отдельный HTTP-сервер /metrics для процессов без FastAPI (sender, Celery). port 0 — выключено.
+    """
+    if port <= 0:
+        return False
+    if not available():
+        logger.warning("Metrics port is configured but 'prometheus_client' is not installed, metrics are disabled")
+        return False
+    prometheus_client.start_http_server(port, registry=registry())
+    logger.info("Metrics server started", extra={"port": port})
+    return True
+
+
+def mark_process_dead(pid: int) -> None:
+    if available() and multiprocess_mode():
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(pid)
+
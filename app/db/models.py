@@ -6,12 +6,14 @@ from typing import Optional
 
 from sqlalchemy import (
     JSON,
+    BigInteger,
     Boolean,
     DateTime,
     Enum,
     ForeignKey,
     Index,
     Integer,
+    SmallInteger,
     String,
     Text,
     UniqueConstraint,
@@ -32,8 +34,47 @@ class TaskStatus(str, enum.Enum):
 
 class OutboxStatus(str, enum.Enum):
     queued = "queued"
+    sending = "sending"  # захвачено sender-воркером (lease до locked_until)
     sent = "sent"
+    delivered = "delivered"  # статусы ниже приходят из WhatsApp status webhook
+    read = "read"
     failed = "failed"
+    expired = "expired"  # не отправлено: deadline_at прошёл (напоминание после начала визита)
+    dead_letter = "dead_letter"  # временные ошибки, но SENDER_MAX_ATTEMPTS попыток исчерпано
+    uncertain = "uncertain"  # запрос ушёл, ответа нет (таймаут / обрыв): не повторяется автоматически
+
+
+class Lane(enum.IntEnum):
+    """
+    Приоритет отправки (меньше — срочнее); хранится числом в tasks/outbox_messages.priority.
+    Sender делит пачку между полосами по весам SENDER_LANE_WEIGHTS.
+    """
+
+    urgent = 0  # подтверждение записи, напоминание за 2ч
+    normal = 1  # напоминание за 24ч, запрос отзыва
+    bulk = 2  # маркетинг (приглашение на повторную запись)
+
+
+class Company(Base):
+    """
+    Салон (tenant): своя компания Altegio и свой номер WhatsApp.
+    Пустые креды — берутся глобальные из настроек (ALTEGIO_API_TOKEN, WHATSAPP_*), см. app.services.tenants.
+    """
+
+    __tablename__ = "companies"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    name: Mapped[str] = mapped_column(String(256))
+
+    altegio_company_id: Mapped[int] = mapped_column(Integer, unique=True)
+    altegio_api_token: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    altegio_webhook_secret: Mapped[Optional[str]] = mapped_column(String(256), nullable=True)
+
+    whatsapp_phone_number_id: Mapped[Optional[str]] = mapped_column(String(64), nullable=True, index=True)
+    whatsapp_token: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+
+    is_active: Mapped[bool] = mapped_column(Boolean, default=True, server_default="true")
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
 
 
 class Client(Base):
@@ -108,6 +149,10 @@ class Task(Base):
     payload_json: Mapped[dict] = mapped_column(JSON, default=dict)
     last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
 
+    priority: Mapped[int] = mapped_column(SmallInteger, default=Lane.normal, server_default=str(int(Lane.normal)))
+    # после этого момента сообщение бесполезно и не отправляется (None — без срока)
+    deadline_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
 
 
@@ -119,37 +164,119 @@ class OutboxMessage(Base):
     task: Mapped["Task"] = relationship()
 
     to_phone: Mapped[str] = mapped_column(String(32), index=True)
+    # номер отправителя (tenant); NULL — номер по умолчанию (settings.WHATSAPP_PHONE_NUMBER_ID)
+    phone_number_id: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
     template_key: Mapped[str] = mapped_column(String(64), index=True)
     template_version: Mapped[int] = mapped_column(Integer, default=1)
 
     rendered_text: Mapped[str] = mapped_column(Text)
 
+    # копируются из Task при постановке в outbox
+    priority: Mapped[int] = mapped_column(SmallInteger, default=Lane.normal, server_default=str(int(Lane.normal)))
+    deadline_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+
     status: Mapped[OutboxStatus] = mapped_column(Enum(OutboxStatus), default=OutboxStatus.queued, index=True)
+    # retry: сколько попыток отправки было и когда можно следующую (для новых — момент постановки)
+    attempts: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
     provider_message_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
     error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
 
+    # lease: кто из sender-воркеров держит сообщение и до какого момента
+    locked_by: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+    locked_until: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
     sent_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    delivered_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    read_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
 
 
 class EventLog(Base):
+    """
+    Партиционирована по месяцам: RANGE (ts), см. миграцию event_log_partitioning
+    и app.db.partitions (создание будущих / удаление старых партиций).
+    Отчёты читают event_rollup_hourly, поэтому вторичных индексов минимум.
+    """
+
     __tablename__ = "event_log"
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    ts: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), index=True)
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    # ключ партиционирования обязан входить в PK
+    ts: Mapped[datetime] = mapped_column(DateTime(timezone=True), primary_key=True, server_default=func.now())
 
-    event_name: Mapped[str] = mapped_column(String(128), index=True)
+    event_name: Mapped[str] = mapped_column(String(128))
 
     appointment_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, index=True)
-    client_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, index=True)
-    task_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, index=True)
+    client_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    task_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     outbox_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, index=True)
 
-    template_key: Mapped[Optional[str]] = mapped_column(String(64), nullable=True, index=True)
+    template_key: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
     template_version: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
 
     meta_json: Mapped[dict] = mapped_column(JSON, default=dict)
 
+    __table_args__ = (
+        Index("ix_event_log_event_name_ts", "event_name", "ts"),
+        {"postgresql_partition_by": "RANGE (ts)"},
+    )
+
+
+class EventRollupHourly(Base):
+    """
+    Почасовые счётчики событий; поддерживаются statement-level триггером на event_log
+    (одна агрегированная upsert-операция на каждый INSERT-statement).
+    """
+
+    __tablename__ = "event_rollup_hourly"
+
+    bucket: Mapped[datetime] = mapped_column(DateTime(timezone=True), primary_key=True)
+    event_name: Mapped[str] = mapped_column(String(128), primary_key=True)
+    # '' / 0 вместо NULL — иначе они не могут быть частью PK
+    template_key: Mapped[str] = mapped_column(String(64), primary_key=True, default="")
+    template_version: Mapped[int] = mapped_column(Integer, primary_key=True, default=0)
+
+    count: Mapped[int] = mapped_column(BigInteger, default=0)
+
+
+class TemplateFunnelStats(Base):
+    """
+    Инкрементальные агрегаты воронки по версии шаблона (см. app.services.funnel).
+    *_hist — счётчики по корзинам FUNNEL_LATENCY_BUCKETS (секунды), из них считаются перцентили.
+    """
+
+    __tablename__ = "template_funnel_stats"
+
+    template_key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    template_version: Mapped[int] = mapped_column(Integer, primary_key=True)
+
+    queued: Mapped[int] = mapped_column(BigInteger, default=0)
+    sent: Mapped[int] = mapped_column(BigInteger, default=0)
+    failed: Mapped[int] = mapped_column(BigInteger, default=0)
+    delivered: Mapped[int] = mapped_column(BigInteger, default=0)
+    read: Mapped[int] = mapped_column(BigInteger, default=0)
+
+    queued_to_sent_hist: Mapped[list] = mapped_column(JSON, default=list)
+    sent_to_delivered_hist: Mapped[list] = mapped_column(JSON, default=list)
+    sent_to_read_hist: Mapped[list] = mapped_column(JSON, default=list)
+
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
+
+class AnalyticsWatermark(Base):
+    __tablename__ = "analytics_watermarks"
+
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    last_event_id: Mapped[int] = mapped_column(BigInteger, default=0)
+    # [[event_id, first_seen_epoch], ...] — id ниже watermark, строк которых ещё не было (незакоммиченные транзакции)
+    pending_ids: Mapped[list] = mapped_column(JSON, default=list)
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
 
 class WebhookDedup(Base):
     __tablename__ = "webhook_dedup"
@@ -163,4 +290,18 @@ class WebhookDedup(Base):
 
 
 Index("ix_tasks_due", Task.status, Task.planned_at)
-Index("ix_outbox_queue", OutboxMessage.status, OutboxMessage.created_at)
+# claim sender-а: WHERE status = 'queued' AND phone_number_id = :sender AND priority = :lane
+#   AND next_attempt_at <= now() ORDER BY next_attempt_at
+# (ретраи с backoff не попадают в диапазон индекса, пока не наступит их время)
+Index(
+    "ix_outbox_queue",
+    OutboxMessage.status,
+    OutboxMessage.phone_number_id,
+    OutboxMessage.priority,
+    OutboxMessage.next_attempt_at,
+)
+Index("ix_outbox_lease", OutboxMessage.status, OutboxMessage.locked_until)
+# идемпотентность постановки: одно сообщение на (задача, шаблон), даже при повторной доставке Celery-задачи
+Index("uq_outbox_task_template", OutboxMessage.task_id, OutboxMessage.template_key, unique=True)
+# ключ для пачечных обновлений статусов доставки из WhatsApp webhook
+Index("uq_outbox_provider_message_id", OutboxMessage.provider_message_id, unique=True)
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import logging
+import re
+from datetime import date, datetime, timezone
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+PARENT = "event_log"
+DEFAULT_PARTITION = "event_log_default"
+_PARTITION_RE = re.compile(r"^event_log_y(\d{4})m(\d{2})$")
+
+
+def month_start(d: date) -> date:
+    return date(d.year, d.month, 1)
+
+
+def add_months(d: date, n: int) -> date:
+    m = d.month - 1 + n
+    return date(d.year + m // 12, m % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARENT}_y{month.year}m{month.month:02d}"
+
+
+def existing_partitions(db: Session) -> dict[str, date]:
+    """
+    {имя партиции: первый день месяца} для месячных партиций event_log (DEFAULT не включается).
+    """
+    rows = db.execute(
+        text(
+            """
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = :parent
+            """
+        ),
+        {"parent": PARENT},
+    ).scalars()
+
+    out: dict[str, date] = {}
+    for name in rows:
+        m = _PARTITION_RE.match(name)
+        if m:
+            out[name] = date(int(m.group(1)), int(m.group(2)), 1)
+    return out
+
+
+def ensure_event_log_partitions(db: Session, months_ahead: int, today: date | None = None) -> list[str]:
+    """
+    Создаёт партиции с текущего месяца по текущий + months_ahead. Возвращает созданные.
+    """
+    today = today or datetime.now(timezone.utc).date()
+    have = existing_partitions(db)
+    created: list[str] = []
+
+    start = month_start(today)
+    for i in range(months_ahead + 1):
+        lo = add_months(start, i)
+        name = partition_name(lo)
+        if name in have:
+            continue
+        hi = add_months(lo, 1)
+        if _default_has_rows(db, lo, hi):
+            _create_from_default(db, name, lo, hi)
+        else:
+            db.execute(
+                text(
+                    f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF {PARENT} '
+                    f"FOR VALUES FROM ('{lo.isoformat()}') TO ('{hi.isoformat()}')"
+                )
+            )
+        created.append(name)
+    return created
+
+
+def _default_has_rows(db: Session, lo: date, hi: date) -> bool:
+    return bool(
+        db.execute(
+            text(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE ts >= :lo AND ts < :hi)"),
+            {"lo": lo, "hi": hi},
+        ).scalar()
+    )
+
+
+def _create_from_default(db: Session, name: str, lo: date, hi: date) -> None:
+    """
+    В DEFAULT уже есть строки этого месяца (партицию не создали вовремя) — CREATE ... PARTITION OF
+    упал бы. DEFAULT отсоединяется, строки месяца переносятся прямо в новую партицию
+    (минуя родителя: statement-триггер rollup не посчитает их второй раз), DEFAULT возвращается.
+    """
+    logger.warning("Moving event_log rows out of the default partition", extra={"partition": name})
+    db.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {DEFAULT_PARTITION}"))
+    db.execute(
+        text(
+            f'CREATE TABLE "{name}" PARTITION OF {PARENT} '
+            f"FOR VALUES FROM ('{lo.isoformat()}') TO ('{hi.isoformat()}')"
+        )
+    )
+    params = {"lo": lo, "hi": hi}
+    db.execute(text(f'INSERT INTO "{name}" SELECT * FROM {DEFAULT_PARTITION} WHERE ts >= :lo AND ts < :hi'), params)
+    db.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE ts >= :lo AND ts < :hi"), params)
+    db.execute(text(f"ALTER TABLE {PARENT} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+
+
+def drop_expired_event_log_partitions(db: Session, retention_months: int, today: date | None = None) -> list[str]:
+    """
+    Удаляет партиции, целиком старше retention_months месяцев.
+    Почасовые агрегаты (event_rollup_hourly) при этом сохраняются.
+    """
+    today = today or datetime.now(timezone.utc).date()
+    cutoff = add_months(month_start(today), -retention_months)
+    dropped: list[str] = []
+
+    for name, lo in sorted(existing_partitions(db).items(), key=lambda kv: kv[1]):
+        if add_months(lo, 1) <= cutoff:
+            db.execute(text(f'DROP TABLE IF EXISTS "{name}"'))
+            dropped.append(name)
+    return dropped
@@ -1,11 +1,22 @@
 from __future__ import annotations
 
-from sqlalchemy import create_engine
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+import threading
+from collections.abc import Callable
+from uuid import uuid4
+
+from sqlalchemy import Engine, create_engine
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 
 from app.core.config import settings
 
+# Engine-ы создаются лениво, при первой сессии: процесс, которому нужен только sync
+# (Celery-воркер) или только async (API), не держит второй пул. Размер пула — по роли
+# процесса (configure_role), DB_POOL_SIZES="api=10,worker=2,sender=8".
+# DB_PGBOUNCER: transaction-mode PgBouncer держит пул сам — у нас NullPool
+# и без prepared statements, переживающих транзакцию.
+
 
 def _make_async_url(sync_url: str) -> str:
     # postgresql+psycopg2:// -> postgresql+asyncpg://
@@ -18,14 +29,138 @@ def _make_async_url(sync_url: str) -> str:
 
 ASYNC_DATABASE_URL = _make_async_url(settings.DATABASE_URL)
 
-async_engine = create_async_engine(ASYNC_DATABASE_URL, pool_pre_ping=True)
-AsyncSessionLocal = sessionmaker(
-    bind=async_engine,
-    class_=AsyncSession,
-    expire_on_commit=False,
-    autoflush=False,
-    autocommit=False,
+_role = "default"
+_lock = threading.Lock()
+_sync_engine: Engine | None = None
+_async_engine: AsyncEngine | None = None
+
+
+def configure_role(role: str) -> None:
+    """
+    Роль процесса (api / worker / sender / consumer / dispatcher) — до первой сессии.
+    """
+    global _role
+    _role = role
+
+
+def pool_size_for(role: str) -> int:
+    sizes = {}
+    for item in str(settings.DB_POOL_SIZES).split(","):
+        name, _, size = item.partition("=")
+        if name.strip() and size.strip():
+            sizes[name.strip()] = int(size)
+    return sizes.get(role, settings.DB_POOL_SIZE)
+
+
+def _pool_kwargs() -> dict:
+    if settings.DB_PGBOUNCER:
+        return {"poolclass": NullPool}
+    return {
+        "pool_size": pool_size_for(_role),
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT_SECONDS,
+        "pool_recycle": settings.DB_POOL_RECYCLE_SECONDS,
+        # pre-ping — лишний round-trip на каждый checkout; pool_recycle обычно достаточно
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+    }
+
+
+def _asyncpg_connect_args() -> dict:
+    if not settings.DB_PGBOUNCER:
+        return {}
+    # соединение за PgBouncer меняется между транзакциями: кэш prepared statements выключен,
+    # имена — уникальные, чтобы не столкнуться с чужими на том же серверном соединении
+    return {
+        "statement_cache_size": 0,
+        "prepared_statement_cache_size": 0,
+        "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+    }
+
+
+def get_sync_engine() -> Engine:
+    global _sync_engine
+    if _sync_engine is None:
+        with _lock:
+            if _sync_engine is None:
+                _sync_engine = create_engine(settings.DATABASE_URL, **_pool_kwargs())
+    return _sync_engine
+
+
+def get_async_engine() -> AsyncEngine:
+    global _async_engine
+    if _async_engine is None:
+        with _lock:
+            if _async_engine is None:
+                _async_engine = create_async_engine(
+                    ASYNC_DATABASE_URL,
+                    connect_args=_asyncpg_connect_args(),
+                    **_pool_kwargs(),
+                )
+    return _async_engine
+
+
+def dispose_inherited_engines() -> None:
+    """
+    После fork (Celery prefork): соединения родителя не закрываем и не используем,
+    дочерний процесс откроет свои.
+    """
+    if _sync_engine is not None:
+        _sync_engine.dispose(close=False)
+    if _async_engine is not None:
+        _async_engine.sync_engine.dispose(close=False)
+
+
+def pool_stats() -> dict[str, dict]:
+    """
+    Состояние пулов этого процесса (только созданных engine-ов).
+    """
+    stats: dict[str, dict] = {}
+    for name, engine in (
+        ("sync", _sync_engine),
+        ("async", _async_engine.sync_engine if _async_engine is not None else None),
+    ):
+        if engine is None:
+            continue
+        pool = engine.pool
+        if isinstance(pool, NullPool):
+            stats[name] = {"role": _role, "pool": "null"}
+            continue
+        stats[name] = {
+            "role": _role,
+            "pool": type(pool).__name__,
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+        }
+    return stats
+
+
+class _LazySessionmaker:
+    """
+    sessionmaker, который привязывается к engine при первом вызове.
+    """
+
+    def __init__(self, factory: Callable[[], sessionmaker]) -> None:
+        self._factory = factory
+        self._maker: sessionmaker | None = None
+
+    def __call__(self, **kwargs):
+        if self._maker is None:
+            self._maker = self._factory()
+        return self._maker(**kwargs)
+
+
+AsyncSessionLocal = _LazySessionmaker(
+    lambda: sessionmaker(
+        bind=get_async_engine(),
+        class_=AsyncSession,
+        expire_on_commit=False,
+        autoflush=False,
+        autocommit=False,
+    )
 )
 
-sync_engine = create_engine(settings.DATABASE_URL, pool_pre_ping=True)
-SessionLocal = sessionmaker(bind=sync_engine, expire_on_commit=False, autoflush=False, autocommit=False)
+SessionLocal = _LazySessionmaker(
+    lambda: sessionmaker(bind=get_sync_engine(), expire_on_commit=False, autoflush=False, autocommit=False)
+)
@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+from sqlalchemy import func, literal_column
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from app.db.models import Appointment, Client
+
+APPOINTMENT_UPDATABLE = ("client_id", "starts_at", "ends_at", "status", "staff_name", "service_name", "source")
+
+
+def client_upsert_stmt(rows: list[dict]):
+    """
+    INSERT ... ON CONFLICT (phone_e164) DO UPDATE; имя обновляется только если пришло непустое.
+    """
+    stmt = pg_insert(Client).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[Client.phone_e164],
+        set_={"name": func.coalesce(stmt.excluded.name, Client.name)},
+    )
+
+
+def appointment_upsert_stmt(rows: list[dict]):
+    """
+    INSERT ... ON CONFLICT ON CONSTRAINT uq_appt_altegio DO UPDATE.
+    """
+    stmt = pg_insert(Appointment).values(rows)
+    return stmt.on_conflict_do_update(
+        constraint="uq_appt_altegio",
+        set_={**{c: stmt.excluded[c] for c in APPOINTMENT_UPDATABLE}, "updated_at": func.now()},
+    )
+
+
+def upsert_clients(db: Session, rows: list[dict]) -> dict[str, int]:
+    """
+    rows = [{"phone_e164", "name"}, ...] -> {phone_e164: client_id}. Один statement на всю пачку.
+    """
+    if not rows:
+        return {}
+    # дубли телефона в одной пачке: ON CONFLICT DO UPDATE не может задеть строку дважды
+    by_phone: dict[str, dict] = {}
+    for row in rows:
+        prev = by_phone.get(row["phone_e164"])
+        by_phone[row["phone_e164"]] = {
+            "phone_e164": row["phone_e164"],
+            "name": row.get("name") or (prev or {}).get("name"),
+            "locale": "ru",
+        }
+
+    stmt = client_upsert_stmt(list(by_phone.values())).returning(Client.phone_e164, Client.id)
+    return {phone: client_id for phone, client_id in db.execute(stmt)}
+
+
+def upsert_appointments(db: Session, rows: list[dict]) -> list[tuple[int, int, int, bool]]:
+    """
+    rows — словари с колонками Appointment (altegio_company_id, altegio_appointment_id, client_id, ...).
+    Возвращает [(appointment.id, altegio_company_id, altegio_appointment_id, inserted)],
+    inserted — строка новая (xmax = 0).
+    """
+    if not rows:
+        return []
+    # последняя версия записи в пачке побеждает
+    by_key = {(r["altegio_company_id"], r["altegio_appointment_id"]): r for r in rows}
+
+    stmt = appointment_upsert_stmt(list(by_key.values())).returning(
+        Appointment.id,
+        Appointment.altegio_company_id,
+        Appointment.altegio_appointment_id,
+        literal_column("(xmax = 0)").label("inserted"),
+    )
+    return [
+        (appt_id, company_id, altegio_id, bool(inserted))
+        for appt_id, company_id, altegio_id, inserted in db.execute(stmt)
+    ]
@@ -1,14 +1,42 @@
 from __future__ import annotations
 
-from fastapi import FastAPI
+import time
+
+from fastapi import FastAPI, Request
 
 from app.api.routes import all_routers
+from app.core import metrics
 from app.core.config import settings
 from app.core.logging import setup_logging
+from app.db.session import configure_role
+from app.services.dedup import dedup_writer
 
 setup_logging()
+configure_role("api")
 
 app = FastAPI(title=settings.APP_NAME)
 
 for r in all_routers:
     app.include_router(r)
+
+
+@app.middleware("http")
+async def observe_request_latency(request: Request, call_next):
+    # route — шаблон пути (/webhook/altegio/{company_id}), а не сырой URL: ограниченная кардинальность
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.HTTP_REQUEST_SECONDS.labels(
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=str(status_code),
+        ).observe(time.perf_counter() - start)
+
+
+# дописываем накопленные dedup-ключи в БД при остановке
+app.add_event_handler("shutdown", dedup_writer.close)
@@ -1,105 +1,785 @@
 from __future__ import annotations
 
+import asyncio
 import logging
-from datetime import datetime, timezone
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 
 import redis
-from sqlalchemy import select
-from sqlalchemy.orm import Session
+import redis.asyncio as aioredis
+from sqlalchemy import func, or_, select, true, update
+from sqlalchemy.orm import Session, selectinload
 
+from app.core import metrics
 from app.core.config import settings
-from app.db.models import OutboxMessage, OutboxStatus, TaskStatus
-from app.db.session import SessionLocal
-from app.services.analytics import log_event
-from app.services.rate_limit import set_next_allowed, wait_for_slot
-from app.services.whatsapp import WhatsAppClient
+from app.db.models import Lane, OutboxMessage, OutboxStatus, Task, TaskStatus
+from app.db.session import AsyncSessionLocal, SessionLocal, configure_role
+from app.services.analytics import event_row, log_event, log_events
+from app.services.capping import AsyncSendGuard, SendGuard, sent_provider_id
+from app.services.rate_limit import (
+    AdaptiveRate,
+    AsyncAdaptiveRate,
+    AsyncTokenBucketLimiter,
+    TokenBucketLimiter,
+    whatsapp_buckets,
+)
+from app.services.retry import backoff_seconds, classify_send_error
+from app.services.tenants import SenderNumber, aload_tenants, backlog_numbers, load_tenants, sender_numbers
+from app.services.whatsapp import AsyncWhatsAppClient, WhatsAppClient
 
 logger = logging.getLogger(__name__)
 
+IDLE_SLEEP_SECONDS = 5
 
-def _now_ts() -> int:
-    return int(datetime.now(timezone.utc).timestamp())
 
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
 
-def fetch_next_queued(db: Session) -> OutboxMessage | None:
-    return db.execute(
-        select(OutboxMessage)
+
+def make_worker_id(index: int, sender: SenderNumber | None = None) -> str:
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{index}"
+    return f"{worker_id}:{sender.phone_number_id}" if sender is not None else worker_id
+
+
+def _reclaim_stmt():
+    return (
+        update(OutboxMessage)
+        .where(OutboxMessage.status == OutboxStatus.sending, OutboxMessage.locked_until < _now())
+        .values(status=OutboxStatus.queued, locked_by=None, locked_until=None)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _expire_stmt():
+    return (
+        update(OutboxMessage)
+        .where(OutboxMessage.status == OutboxStatus.queued, OutboxMessage.deadline_at <= _now())
+        .values(status=OutboxStatus.expired, error="Deadline passed")
+        .returning(OutboxMessage.id, OutboxMessage.task_id, OutboxMessage.template_key, OutboxMessage.template_version)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def lane_quotas(limit: int) -> list[tuple[Lane, int]]:
+    """
+    Делит пачку из `limit` сообщений между полосами пропорционально SENDER_LANE_WEIGHTS
+    ("urgent,normal,bulk", например "8,3,1"); остаток от округления — срочным.
+    """
+    raw = [int(w) for w in str(settings.SENDER_LANE_WEIGHTS).split(",") if w.strip()]
+    weights = [raw[i] if i < len(raw) else 1 for i in range(len(Lane))]
+    total = sum(weights) or 1
+    quotas = [limit * w // total for w in weights]
+    quotas[0] += limit - sum(quotas)
+    return list(zip(Lane, quotas))
+
+
+def _sender_filter(sender: SenderNumber | None):
+    if sender is None:
+        return true()
+    if sender.default:
+        # NULL — номер по умолчанию (салоны без своего номера, строки до миграции 0006)
+        return or_(OutboxMessage.phone_number_id.is_(None), OutboxMessage.phone_number_id == sender.phone_number_id)
+    return OutboxMessage.phone_number_id == sender.phone_number_id
+
+
+def _claim_stmt(worker_id: str, limit: int, lease_seconds: int, lane: Lane, sender: SenderNumber | None = None):
+    candidates = (
+        select(OutboxMessage.id)
+        .where(
+            OutboxMessage.status == OutboxStatus.queued,
+            _sender_filter(sender),
+            OutboxMessage.priority == lane,
+            # ретраи с backoff ждут своего времени
+            OutboxMessage.next_attempt_at <= _now(),
+        )
+        .order_by(OutboxMessage.next_attempt_at.asc())
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    return (
+        update(OutboxMessage)
+        .where(OutboxMessage.id.in_(candidates))
+        .values(
+            status=OutboxStatus.sending,
+            locked_by=worker_id,
+            locked_until=_now() + timedelta(seconds=lease_seconds),
+        )
+        .returning(OutboxMessage.id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _renew_lease_stmt(ids: list[int], worker_id: str, lease_seconds: int):
+    return (
+        update(OutboxMessage)
+        .where(
+            OutboxMessage.id.in_(ids),
+            OutboxMessage.status == OutboxStatus.sending,
+            OutboxMessage.locked_by == worker_id,
+        )
+        .values(locked_until=_now() + timedelta(seconds=lease_seconds))
+        .returning(OutboxMessage.id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def renew_lease(db: Session, ids: list[int], worker_id: str, lease_seconds: int | None = None) -> set[int]:
+    """
+    Атомарно продлевает lease прямо перед отправкой: ожидание слота rate-limit может
+    пережить SENDER_LEASE_SECONDS, и сообщение к этому моменту уже переотдано.
+    Возвращает id, которые всё ещё держит этот воркер.
+    """
+    lease_seconds = lease_seconds or settings.SENDER_LEASE_SECONDS
+    return {row[0] for row in db.execute(_renew_lease_stmt(ids, worker_id, lease_seconds))}
+
+
+def lease_chunk_size(phone_rate: float | None, lease_seconds: int) -> int:
+    # сколько сообщений номер гарантированно успевает отправить за половину lease
+    rate = phone_rate or settings.WHATSAPP_RATE_PER_SECOND
+    return max(1, int(rate * lease_seconds / 2))
+
+
+def reclaim_expired(db: Session) -> int:
+    """
+    Возвращает в очередь сообщения, у которых истёк lease
+    (воркер упал или завис посреди отправки).
+    """
+    return db.execute(_reclaim_stmt()).rowcount or 0
+
+
+def claim_batch(
+    db: Session,
+    worker_id: str,
+    limit: int,
+    lease_seconds: int,
+    sender: SenderNumber | None = None,
+) -> list[int]:
+    """
+    Атомарно забирает до `limit` queued-сообщений (только номера `sender`, если задан) в статус sending.
+    FOR UPDATE SKIP LOCKED: параллельные воркеры (в т.ч. на других нодах)
+    никогда не получат одну и ту же строку.
+    Взвешенное деление между полосами (lane_quotas): маркетинговый бэклог не задерживает
+    напоминания, но и сам не голодает. Недобор одной полосы отдаётся остальным по приоритету.
+    Возвращает id в порядке отправки: по полосам, внутри — по очереди.
+    """
+    claimed: dict[Lane, list[int]] = {}
+    full: list[Lane] = []
+    for lane, quota in lane_quotas(limit):
+        if quota <= 0:
+            full.append(lane)
+            continue
+        claimed[lane] = sorted(row[0] for row in db.execute(_claim_stmt(worker_id, quota, lease_seconds, lane, sender)))
+        if len(claimed[lane]) == quota:
+            full.append(lane)
+
+    spare = limit - sum(len(ids) for ids in claimed.values())
+    for lane in sorted(full):
+        if spare <= 0:
+            break
+        extra = sorted(row[0] for row in db.execute(_claim_stmt(worker_id, spare, lease_seconds, lane, sender)))
+        claimed.setdefault(lane, []).extend(extra)
+        spare -= len(extra)
+
+    return [msg_id for lane in sorted(claimed) for msg_id in claimed[lane]]
+
+
+def expire_overdue(db: Session) -> int:
+    """
+    Сообщения, чей deadline_at прошёл в очереди (2h-напоминание после начала визита),
+    не отправляются: outbox -> expired, задача -> canceled.
+    """
+    expired = db.execute(_expire_stmt()).all()
+    if not expired:
+        return 0
+    db.execute(
+        update(Task)
+        .where(Task.id.in_([task_id for _, task_id, _, _ in expired]))
+        .values(status=TaskStatus.canceled, last_error="Deadline passed")
+        .execution_options(synchronize_session=False)
+    )
+    log_events(
+        db,
+        [
+            event_row(
+                "message.expired",
+                task_id=task_id,
+                outbox_id=outbox_id,
+                template_key=template_key,
+                template_version=template_version,
+            )
+            for outbox_id, task_id, template_key, template_version in expired
+        ],
+    )
+    return len(expired)
+
+
+def mark_sent(db: Session, msg: OutboxMessage, provider_id: str) -> None:
+    task = msg.task
+    appt = task.appointment
+
+    msg.status = OutboxStatus.sent
+    msg.attempts += 1
+    # "" -> NULL: provider_message_id уникален
+    msg.provider_message_id = provider_id or None
+    msg.sent_at = _now()
+    msg.locked_until = None
+
+    task.status = TaskStatus.done
+
+    log_event(
+        db,
+        "message.sent",
+        appointment_id=appt.id,
+        client_id=appt.client_id,
+        task_id=task.id,
+        outbox_id=msg.id,
+        template_key=msg.template_key,
+        template_version=msg.template_version,
+        meta={"provider_message_id": provider_id},
+    )
+
+
+def mark_failed(
+    db: Session,
+    msg: OutboxMessage,
+    error: BaseException,
+    status: OutboxStatus = OutboxStatus.failed,
+) -> None:
+    task = msg.task
+    appt = task.appointment
+
+    msg.status = status
+    msg.error = str(error)
+    msg.locked_until = None
+    task.status = TaskStatus.failed
+    task.last_error = str(error)
+
+    log_event(
+        db,
+        "message.dead_lettered" if status == OutboxStatus.dead_letter else "message.failed",
+        appointment_id=appt.id,
+        client_id=appt.client_id,
+        task_id=task.id,
+        outbox_id=msg.id,
+        template_key=msg.template_key,
+        template_version=msg.template_version,
+        meta={"error": str(error)},
+    )
+
+
+def mark_retry(db: Session, msg: OutboxMessage, error: BaseException, delay: float) -> None:
+    task = msg.task
+    appt = task.appointment
+
+    # обратно в очередь; claim не увидит сообщение до next_attempt_at
+    msg.status = OutboxStatus.queued
+    msg.error = str(error)
+    msg.locked_by = None
+    msg.locked_until = None
+    msg.next_attempt_at = _now() + timedelta(seconds=delay)
+
+    log_event(
+        db,
+        "message.retry_scheduled",
+        appointment_id=appt.id,
+        client_id=appt.client_id,
+        task_id=task.id,
+        outbox_id=msg.id,
+        template_key=msg.template_key,
+        template_version=msg.template_version,
+        meta={"attempt": msg.attempts, "delay_seconds": round(delay, 1), "error": str(error)},
+    )
+
+
+def handle_send_error(db: Session, msg: OutboxMessage, error: BaseException) -> None:
+    """
+    Временная ошибка — повтор с backoff (но не после deadline_at),
+    после SENDER_MAX_ATTEMPTS попыток — dead_letter; постоянная — сразу failed.
+    """
+    msg.attempts += 1
+    kind = classify_send_error(error)
+    if not kind.retryable:
+        mark_failed(db, msg, error)
+        return
+    if msg.attempts >= settings.SENDER_MAX_ATTEMPTS:
+        mark_failed(db, msg, error, status=OutboxStatus.dead_letter)
+        return
+
+    delay = backoff_seconds(msg.attempts, kind.retry_after)
+    if msg.deadline_at is not None and _now() + timedelta(seconds=delay) >= msg.deadline_at:
+        mark_expired(db, msg)
+        return
+    mark_retry(db, msg, error, delay)
+
+
+def mark_expired(db: Session, msg: OutboxMessage) -> None:
+    task = msg.task
+    appt = task.appointment
+
+    msg.status = OutboxStatus.expired
+    msg.error = "Deadline passed"
+    msg.locked_until = None
+    task.status = TaskStatus.canceled
+    task.last_error = "Deadline passed"
+
+    log_event(
+        db,
+        "message.expired",
+        appointment_id=appt.id,
+        client_id=appt.client_id,
+        task_id=task.id,
+        outbox_id=msg.id,
+        template_key=msg.template_key,
+        template_version=msg.template_version,
+    )
+
+
+def mark_uncertain(db: Session, msg: OutboxMessage, error: BaseException) -> None:
+    task = msg.task
+    appt = task.appointment
+
+    # запрос мог дойти до провайдера: автоматический повтор рискует платным дублем — решает оператор
+    msg.status = OutboxStatus.uncertain
+    msg.attempts += 1
+    msg.error = str(error)
+    msg.locked_until = None
+    task.status = TaskStatus.failed
+    task.last_error = f"Delivery uncertain: {error}"
+
+    log_event(
+        db,
+        "message.uncertain",
+        appointment_id=appt.id,
+        client_id=appt.client_id,
+        task_id=task.id,
+        outbox_id=msg.id,
+        template_key=msg.template_key,
+        template_version=msg.template_version,
+        meta={"error": str(error)},
+    )
+
+
+def mark_capped(db: Session, msg: OutboxMessage, wait: float) -> None:
+    task = msg.task
+    appt = task.appointment
+
+    # лимит получателя исчерпан: ждём конца окна, попыткой это не считается
+    msg.status = OutboxStatus.queued
+    msg.locked_by = None
+    msg.locked_until = None
+    msg.next_attempt_at = _now() + timedelta(seconds=wait)
+
+    log_event(
+        db,
+        "message.capped",
+        appointment_id=appt.id,
+        client_id=appt.client_id,
+        task_id=task.id,
+        outbox_id=msg.id,
+        template_key=msg.template_key,
+        template_version=msg.template_version,
+        meta={"wait_seconds": round(wait, 1)},
+    )
+
+
+def is_overdue(msg: OutboxMessage) -> bool:
+    return msg.deadline_at is not None and msg.deadline_at <= _now()
+
+
+def is_capped_lane(msg: OutboxMessage) -> bool:
+    # срочная полоса (подтверждение записи, 2h-напоминание) частотным лимитом не режется
+    return msg.priority != Lane.urgent
+
+
+def send_claimed(
+    db: Session,
+    wa: WhatsAppClient,
+    limiter: TokenBucketLimiter,
+    msg_id: int,
+    worker_id: str,
+    guard: SendGuard | None = None,
+) -> bool:
+    """
+    Отправляет одно ранее захваченное сообщение. Возвращает False, если lease
+    уже потерян (сообщение переотдано другому воркеру) — тогда ничего не шлём.
+    guard: частотный лимит получателя и ключ идемпотентности (task_id, template_key) в Redis.
+    """
+    msg = db.get(OutboxMessage, msg_id)
+    if not msg or msg.status != OutboxStatus.sending or msg.locked_by != worker_id:
+        logger.warning("Outbox lease lost, skipping", extra={"outbox_id": msg_id, "worker_id": worker_id})
+        return False
+
+    if is_overdue(msg):
+        mark_expired(db, msg)
+        db.commit()
+        return True
+
+    if guard is not None:
+        existing = guard.claim(msg.task_id, msg.template_key, worker_id)
+        provider_id = sent_provider_id(existing)
+        if provider_id is not None:
+            # уже отправлено (воркер упал между send_text и commit) — только фиксируем
+            mark_sent(db, msg, provider_id)
+            db.commit()
+            return True
+        if existing is not None:
+            logger.warning(
+                "Outbox message is being sent by another worker, skipping",
+                extra={"outbox_id": msg_id, "worker_id": worker_id, "holder": existing},
+            )
+            return False
+
+        wait = guard.cap_consume(msg.to_phone) if is_capped_lane(msg) else 0.0
+        if wait > 0:
+            guard.release(msg.task_id, msg.template_key)
+            mark_capped(db, msg, wait)
+            db.commit()
+            return True
+
+    try:
+        # rate-limit: номер отправителя + конкретный получатель
+        limiter.acquire(whatsapp_buckets(wa.phone_number_id, msg.to_phone, wa.phone_rate()))
+        if not renew_lease(db, [msg_id], worker_id):
+            raise LeaseLost()
+        # продлённый lease фиксируем до HTTP-запроса: строка не остаётся заблокированной на время send_text
+        db.commit()
+        provider_id = wa.send_text(msg.to_phone, msg.rendered_text)
+    except LeaseLost:
+        db.rollback()
+        if guard is not None:
+            guard.release(msg.task_id, msg.template_key)
+        logger.warning("Outbox lease lost while waiting for rate limit, skipping", extra={"outbox_id": msg_id, "worker_id": worker_id})
+        return False
+    except Exception as e:
+        if classify_send_error(e).maybe_sent:
+            # ключ "sending:<worker>" не снимаем — истечёт по TTL
+            mark_uncertain(db, msg, e)
+        else:
+            if guard is not None:
+                guard.release(msg.task_id, msg.template_key)
+            handle_send_error(db, msg, e)
+        db.commit()
+        return True
+
+    # send_text вернулся — сообщение отправлено, ключ идемпотентности больше не снимается
+    if guard is not None:
+        try:
+            guard.confirm(msg.task_id, msg.template_key, provider_id)
+        except redis.RedisError as e:
+            logger.warning("Idempotency confirm failed after send", extra={"outbox_id": msg_id, "error": str(e)})
+    mark_sent(db, msg, provider_id)
+    db.commit()
+    return True
+
+
+def observe_outbox_queue(db: Session) -> None:
+    """
+    Гейджи очереди: глубина по полосам и возраст самого старого queued-сообщения (один агрегатный запрос).
+    """
+    rows = db.execute(
+        select(OutboxMessage.priority, func.count(), func.min(OutboxMessage.created_at))
         .where(OutboxMessage.status == OutboxStatus.queued)
-        .order_by(OutboxMessage.created_at.asc())
-        .limit(1)
-    ).scalar_one_or_none()
+        .group_by(OutboxMessage.priority)
+    ).all()
+    depth = {lane: 0 for lane in Lane}
+    oldest: datetime | None = None
+    for priority, count, created_at in rows:
+        depth[Lane(priority)] = count
+        if created_at is not None and (oldest is None or created_at < oldest):
+            oldest = created_at
+    for lane, count in depth.items():
+        metrics.OUTBOX_QUEUE_DEPTH.labels(priority=lane.name).set(count)
+    metrics.OUTBOX_OLDEST_AGE_SECONDS.set((_now() - oldest).total_seconds() if oldest is not None else 0)
 
 
-def main() -> None:
+def reclaim_and_expire(db: Session) -> None:
+    # commit — на вызывающем (в async-режиме функция выполняется через run_sync)
+    reclaimed = reclaim_expired(db)
+    expired = expire_overdue(db)
+    if reclaimed:
+        logger.warning("Reclaimed expired outbox leases", extra={"count": reclaimed})
+    if expired:
+        logger.warning("Dropped outbox messages past deadline", extra={"count": expired})
+
+
+def run_sender_number(index: int, sender: SenderNumber, r: redis.Redis, stop: threading.Event) -> None:
+    """
+    Цикл отправки одного номера: свой пул соединений, свой phone-bucket и AIMD.
+    stop — номер больше не обслуживается: дорабатывается текущая пачка, и цикл выходит.
+    """
+    worker_id = make_worker_id(index, sender)
+    rate = AdaptiveRate(r, sender.phone_number_id) if settings.WHATSAPP_ADAPTIVE_RATE else None
+    wa = WhatsAppClient(rate=rate, phone_number_id=sender.phone_number_id, token=sender.token)
+    limiter = TokenBucketLimiter(r)
+    guard = SendGuard(r)
+    lease_seconds = settings.SENDER_LEASE_SECONDS
+
+    logger.info("Sender number started", extra={"worker_id": worker_id, "phone_number_id": sender.phone_number_id})
+
+    try:
+        while not stop.is_set():
+            # 1) claim пачки сообщений этого номера
+            with SessionLocal() as db:
+                ids = claim_batch(db, worker_id, settings.SENDER_BATCH_SIZE, lease_seconds, sender)
+                db.commit()
+
+            if not ids:
+                # no messages: back off a bit
+                stop.wait(IDLE_SLEEP_SECONDS)
+                continue
+
+            # 2) отправка в порядке полос; слот rate-limit берётся перед каждым send_text
+            for msg_id in ids:
+                with SessionLocal() as db:
+                    send_claimed(db, wa, limiter, msg_id, worker_id, guard)
+    except Exception:
+        logger.exception("Sender number crashed", extra={"worker_id": worker_id})
+        raise
+    finally:
+        wa.close()
+    logger.info("Sender number stopped", extra={"worker_id": worker_id, "phone_number_id": sender.phone_number_id})
+
+
+def run_worker(index: int = 0) -> None:
+    """
+    Поток на каждый номер отправителя (app.services.tenants.sender_numbers): бэклог одного салона
+    упирается только в лимиты своего номера и не тормозит остальные.
+    Раз в SENDER_LEASE_SECONDS: возврат зависших lease, снятие просроченных,
+    запуск потоков для новых номеров, перезапуск упавших и остановка ненужных.
+    Номер, ушедший из companies, обслуживается, пока в outbox есть его queued-сообщения (backlog_numbers).
+    """
     r = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
-    wa = WhatsAppClient()
+    threads: dict[str, tuple[threading.Thread, threading.Event]] = {}
 
-    logger.info("Sender started")
+    logger.info("Sender worker started", extra={"worker_id": make_worker_id(index)})
 
     while True:
-        # 1) wait global rate-limit slot
-        wait_for_slot(r, settings.WHATSAPP_RATE_LIMIT_SECONDS)
-
-        # 2) pick one message
         with SessionLocal() as db:
-            msg = fetch_next_queued(db)
-            if not msg:
-                # no messages: back off a bit
-                set_next_allowed(r, _now_ts() + 5)
-                db.commit()
+            reclaim_and_expire(db)
+            db.commit()
+            observe_outbox_queue(db)
+            senders = sender_numbers(load_tenants(db))
+            senders += backlog_numbers(db, senders)
+
+        wanted = {sender.phone_number_id for sender in senders}
+        for phone_number_id in [n for n in threads if n not in wanted]:
+            logger.info("Stopping sender number", extra={"phone_number_id": phone_number_id})
+            _, stop = threads.pop(phone_number_id)
+            stop.set()
+
+        for sender in senders:
+            thread, _ = threads.get(sender.phone_number_id, (None, None))
+            if thread is not None and thread.is_alive():
                 continue
+            if thread is not None:
+                logger.warning("Restarting sender number", extra={"phone_number_id": sender.phone_number_id})
+            stop = threading.Event()
+            thread = threading.Thread(
+                target=run_sender_number,
+                args=(index, sender, r, stop),
+                name=f"sender-{index}-{sender.phone_number_id}",
+                daemon=True,
+            )
+            thread.start()
+            threads[sender.phone_number_id] = (thread, stop)
 
-            task = msg.task
-            appt = task.appointment
-            client = appt.client
-
-            try:
-                provider_id = wa.send_text(msg.to_phone, msg.rendered_text)
-                msg.status = OutboxStatus.sent
-                msg.provider_message_id = provider_id
-                msg.sent_at = datetime.now(timezone.utc)
-
-                task.status = TaskStatus.done
-
-                log_event(
-                    db,
-                    "message.sent",
-                    appointment_id=appt.id,
-                    client_id=client.id,
-                    task_id=task.id,
-                    outbox_id=msg.id,
-                    template_key=msg.template_key,
-                    template_version=msg.template_version,
-                    meta={"provider_message_id": provider_id},
-                )
+        time.sleep(settings.SENDER_LEASE_SECONDS)
 
-                db.commit()
 
-                # 3) set next allowed time (strict 1 per N sec)
-                set_next_allowed(r, _now_ts() + settings.WHATSAPP_RATE_LIMIT_SECONDS)
-
-            except Exception as e:
-                msg.status = OutboxStatus.failed
-                msg.error = str(e)
-                task.status = TaskStatus.failed
-                task.last_error = str(e)
-
-                log_event(
-                    db,
-                    "message.failed",
-                    appointment_id=appt.id,
-                    client_id=client.id,
-                    task_id=task.id,
-                    outbox_id=msg.id,
-                    template_key=msg.template_key,
-                    template_version=msg.template_version,
-                    meta={"error": str(e)},
+async def run_async_sender_number(index: int, sender: SenderNumber, r: aioredis.Redis, stop: asyncio.Event) -> None:
+    worker_id = make_worker_id(index, sender)
+    lease_seconds = settings.SENDER_LEASE_SECONDS
+    rate = AsyncAdaptiveRate(r, sender.phone_number_id) if settings.WHATSAPP_ADAPTIVE_RATE else None
+    guard = AsyncSendGuard(r)
+
+    logger.info(
+        "Async sender number started", extra={"worker_id": worker_id, "phone_number_id": sender.phone_number_id}
+    )
+
+    async with AsyncWhatsAppClient(
+        limiter=AsyncTokenBucketLimiter(r),
+        rate=rate,
+        phone_number_id=sender.phone_number_id,
+        token=sender.token,
+    ) as wa:
+        while not stop.is_set():
+            async with AsyncSessionLocal() as db:
+                ids = await db.run_sync(claim_batch, worker_id, settings.SENDER_BATCH_SIZE, lease_seconds, sender)
+                await db.commit()
+
+            if not ids:
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=IDLE_SLEEP_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            async with AsyncSessionLocal() as db:
+                msgs = (
+                    await db.execute(
+                        select(OutboxMessage)
+                        .options(selectinload(OutboxMessage.task).selectinload(Task.appointment))
+                        .where(
+                            OutboxMessage.id.in_(ids),
+                            OutboxMessage.status == OutboxStatus.sending,
+                            OutboxMessage.locked_by == worker_id,
+                        )
+                        .order_by(OutboxMessage.priority.asc(), OutboxMessage.created_at.asc())
+                    )
+                ).scalars().all()
+
+                sendable = []
+                for msg in msgs:
+                    if is_overdue(msg):
+                        mark_expired(db, msg)
+                        continue
+                    existing = await guard.claim(msg.task_id, msg.template_key, worker_id)
+                    provider_id = sent_provider_id(existing)
+                    if provider_id is not None:
+                        mark_sent(db, msg, provider_id)
+                        continue
+                    if existing is not None:
+                        logger.warning(
+                            "Outbox message is being sent by another worker, skipping",
+                            extra={"outbox_id": msg.id, "worker_id": worker_id, "holder": existing},
+                        )
+                        continue
+                    wait = await guard.cap_consume(msg.to_phone) if is_capped_lane(msg) else 0.0
+                    if wait > 0:
+                        await guard.release(msg.task_id, msg.template_key)
+                        mark_capped(db, msg, wait)
+                        continue
+                    sendable.append(msg)
+
+                # пачка режется так, чтобы каждая часть успевала уйти в пределах продлённого lease
+                chunk_size = lease_chunk_size(await rate.rate() if rate is not None else None, lease_seconds)
+                for start in range(0, len(sendable), chunk_size):
+                    chunk = sendable[start : start + chunk_size]
+                    held = await db.run_sync(renew_lease, [m.id for m in chunk], worker_id, lease_seconds)
+                    await db.commit()
+                    msgs = []
+                    for msg in chunk:
+                        if msg.id in held:
+                            msgs.append(msg)
+                            continue
+                        await guard.release(msg.task_id, msg.template_key)
+                        logger.warning(
+                            "Outbox lease lost before send, skipping", extra={"outbox_id": msg.id, "worker_id": worker_id}
+                        )
+
+                    results = await wa.send_many([(m.to_phone, m.rendered_text) for m in msgs])
+                    for msg, result in zip(msgs, results):
+                        if not isinstance(result, BaseException):
+                            try:
+                                await guard.confirm(msg.task_id, msg.template_key, result)
+                            except aioredis.RedisError as e:
+                                logger.warning(
+                                    "Idempotency confirm failed after send", extra={"outbox_id": msg.id, "error": str(e)}
+                                )
+                            mark_sent(db, msg, result)
+                        elif classify_send_error(result).maybe_sent:
+                            mark_uncertain(db, msg, result)
+                        else:
+                            await guard.release(msg.task_id, msg.template_key)
+                            handle_send_error(db, msg, result)
+                    await db.commit()
+                await db.commit()
+
+
+async def run_async_worker(index: int = 0) -> None:
+    """
+    Асинхронный режим (SENDER_ASYNC): по корутине на номер отправителя, пачка отправляется
+    через AsyncWhatsAppClient.send_many() — несколько запросов в полёте в рамках token bucket номера.
+    """
+    r = aioredis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    tasks: dict[str, tuple[asyncio.Task, asyncio.Event]] = {}
+
+    logger.info("Async sender worker started", extra={"worker_id": make_worker_id(index)})
+
+    while True:
+        async with AsyncSessionLocal() as db:
+            await db.run_sync(reclaim_and_expire)
+            await db.commit()
+            await db.run_sync(observe_outbox_queue)
+            senders = sender_numbers(await aload_tenants(db))
+            senders += await db.run_sync(backlog_numbers, senders)
+
+        wanted = {sender.phone_number_id for sender in senders}
+        for phone_number_id in [n for n in tasks if n not in wanted]:
+            # не cancel(): пачка, уже ушедшая в send_many, должна дойти до commit
+            logger.info("Stopping async sender number", extra={"phone_number_id": phone_number_id})
+            _, stop = tasks.pop(phone_number_id)
+            stop.set()
+
+        for sender in senders:
+            task, _ = tasks.get(sender.phone_number_id, (None, None))
+            if task is not None and not task.done():
+                continue
+            if task is not None and not task.cancelled() and task.exception() is not None:
+                logger.error(
+                    "Async sender number crashed, restarting",
+                    extra={"phone_number_id": sender.phone_number_id, "error": str(task.exception())},
                 )
+            stop = asyncio.Event()
+            task = asyncio.create_task(
+                run_async_sender_number(index, sender, r, stop), name=f"sender-{index}-{sender.phone_number_id}"
+            )
+            tasks[sender.phone_number_id] = (task, stop)
 
-                db.commit()
+        await asyncio.sleep(settings.SENDER_LEASE_SECONDS)
+
+
+def _worker_entry(index: int) -> None:
+    logging.basicConfig(level=settings.LOG_LEVEL)
+    if not metrics.multiprocess_mode():
+        # без PROMETHEUS_MULTIPROC_DIR у каждого процесса свой /metrics: порт SENDER_METRICS_PORT + index
+        _serve_metrics(index)
+    _run(index)
+
+
+def _serve_metrics(index: int = 0) -> None:
+    if settings.SENDER_METRICS_PORT > 0:
+        metrics.start_metrics_server(settings.SENDER_METRICS_PORT + index)
+
+
+def _run(index: int) -> None:
+    # пул на процесс: в sync-режиме по потоку на номер отправителя — DB_POOL_SIZES учитывает это
+    configure_role("sender")
+    if settings.SENDER_ASYNC:
+        asyncio.run(run_async_worker(index))
+    else:
+        run_worker(index)
+
+
+def main() -> None:
+    workers = max(1, settings.SENDER_WORKERS)
+    logger.info("Sender started", extra={"workers": workers, "async": settings.SENDER_ASYNC})
+
+    if workers == 1:
+        _serve_metrics()
+        _run(0)
+        return
+
+    if metrics.multiprocess_mode():
+        # один /metrics в родителе — агрегат по всем воркерам
+        _serve_metrics()
 
-                # даже при ошибке соблюдаем лимит
-                set_next_allowed(r, _now_ts() + settings.WHATSAPP_RATE_LIMIT_SECONDS)
+    # spawn: каждый процесс создаёт свои engine/redis/http-пулы с нуля
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=_worker_entry, args=(i,), name=f"sender-{i}") for i in range(workers)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+        metrics.mark_process_dead(p.pid)
 
 
 if __name__ == "__main__":
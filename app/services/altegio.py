@@ -1,12 +1,21 @@
 from __future__ import annotations
 
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime, timezone
+from datetime import date, datetime, timedelta, timezone
 
 import httpx
 
 from app.core.config import settings
 
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class AppointmentInfo:
@@ -21,11 +30,135 @@ class AppointmentInfo:
     status: str
 
 
-class AltegioClient:
-    def __init__(self) -> None:
+@dataclass
+class _CacheEntry:
+    info: AppointmentInfo
+    etag: str | None
+    expires_at: float  # time.monotonic()
+
+
+class AppointmentCache:
+    """
+    In-process TTL + LRU кэш AppointmentInfo по (company_id, appointment_id): id записей уникальны
+    только в пределах салона, а кэш общий на процесс.
+    Протухшая запись не удаляется сразу: её ETag нужен для условного запроса (If-None-Match).
+    """
+
+    def __init__(self, maxsize: int, ttl_seconds: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl_seconds
+        self._data: OrderedDict[tuple[int, int], _CacheEntry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, company_id: int, appointment_id: int) -> _CacheEntry | None:
+        key = (company_id, appointment_id)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+            return entry
+
+    def put(self, company_id: int, info: AppointmentInfo, etag: str | None) -> None:
+        key = (company_id, info.appointment_id)
+        with self._lock:
+            self._data[key] = _CacheEntry(info, etag, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def touch(self, company_id: int, appointment_id: int) -> None:
+        with self._lock:
+            entry = self._data.get((company_id, appointment_id))
+            if entry is not None:
+                entry.expires_at = time.monotonic() + self.ttl
+
+    def invalidate(self, company_id: int, appointment_id: int) -> None:
+        with self._lock:
+            self._data.pop((company_id, appointment_id), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+appointment_cache = AppointmentCache(
+    maxsize=settings.ALTEGIO_CACHE_MAXSIZE,
+    ttl_seconds=settings.ALTEGIO_CACHE_TTL_SECONDS,
+)
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.ALTEGIO_MAX_CONCURRENCY,
+        max_keepalive_connections=settings.ALTEGIO_MAX_CONCURRENCY,
+    )
+
+
+def parse_appointment(appointment_id: int, data: dict) -> AppointmentInfo:
+    # !!! Ниже — пример. Подставишь реальные ключи из Altegio ответа.
+    starts = datetime.fromisoformat(data["starts_at"]).astimezone(timezone.utc)
+    ends = datetime.fromisoformat(data["ends_at"]).astimezone(timezone.utc)
+
+    return AppointmentInfo(
+        appointment_id=appointment_id,
+        client_phone_e164=data["client"]["phone"],
+        client_name=data["client"].get("name"),
+        starts_at=starts,
+        ends_at=ends,
+        staff_name=data.get("staff", {}).get("name"),
+        service_name=data.get("service", {}).get("name"),
+        source=data.get("source"),
+        status=data.get("status", "unknown"),
+    )
+
+
+# attendance записи Altegio -> статус
+_RECORD_ATTENDANCE = {-1: "no_show", 0: "pending", 1: "arrived", 2: "confirmed"}
+
+
+def parse_record(data: dict) -> AppointmentInfo:
+    """
+    Запись из листинга GET /api/v1/records/{company_id}: начало — datetime, конец — datetime + seance_length
+    (секунды), услуга — первая из services, мастер — staff.name, телефон — client.phone.
+    """
+    starts = datetime.fromisoformat(data["datetime"]).astimezone(timezone.utc)
+    ends = starts + timedelta(seconds=int(data.get("seance_length") or data.get("length") or 0))
+    client = data.get("client") or {}
+    phone = client.get("phone")
+    if not phone:
+        raise ValueError("record has no client phone")
+    services = data.get("services") or []
+
+    if data.get("deleted"):
+        status = "deleted"
+    else:
+        status = _RECORD_ATTENDANCE.get(data.get("attendance"), "unknown")
+
+    return AppointmentInfo(
+        appointment_id=int(data["id"]),
+        client_phone_e164=phone,
+        client_name=client.get("name"),
+        starts_at=starts,
+        ends_at=ends,
+        staff_name=(data.get("staff") or {}).get("name"),
+        service_name=services[0].get("title") if services else None,
+        source="online" if data.get("online") else data.get("source"),
+        status=status,
+    )
+
+
+class _AltegioBase:
+    def __init__(
+        self,
+        cache: AppointmentCache | None = None,
+        company_id: int | None = None,
+        token: str | None = None,
+    ) -> None:
+        # company_id / token — салон (app.services.tenants); по умолчанию глобальные из настроек
         self.base = settings.ALTEGIO_API_BASE.rstrip("/")
-        self.token = settings.ALTEGIO_API_TOKEN
-        self.company_id = settings.ALTEGIO_COMPANY_ID
+        self.token = token or settings.ALTEGIO_API_TOKEN
+        self.company_id = company_id or settings.ALTEGIO_COMPANY_ID
+        self.cache = cache if cache is not None else appointment_cache
 
     def _headers(self) -> dict:
         # В Altegio часто используется Bearer/Token заголовок — подстрой под их доки.
@@ -34,29 +167,189 @@ class AltegioClient:
             "Accept": "application/json",
         }
 
-    def get_appointment(self, appointment_id: int) -> AppointmentInfo:
-        """
-        TODO: заменить URL/парсинг под реальные поля Altegio.
-        Сейчас сделано как каркас.
-        """
-        url = f"{self.base}/api/v1/appointments/{appointment_id}"
-        with httpx.Client(timeout=15) as client:
-            r = client.get(url, headers=self._headers(), params={"company_id": self.company_id})
-            r.raise_for_status()
-            data = r.json()
-
-        # !!! Ниже — пример. Подставишь реальные ключи из Altegio ответа.
-        starts = datetime.fromisoformat(data["starts_at"]).astimezone(timezone.utc)
-        ends = datetime.fromisoformat(data["ends_at"]).astimezone(timezone.utc)
-
-        return AppointmentInfo(
-            appointment_id=appointment_id,
-            client_phone_e164=data["client"]["phone"],
-            client_name=data["client"].get("name"),
-            starts_at=starts,
-            ends_at=ends,
-            staff_name=data.get("staff", {}).get("name"),
-            service_name=data.get("service", {}).get("name"),
-            source=data.get("source"),
-            status=data.get("status", "unknown"),
+    def _appointment_url(self, appointment_id: int) -> str:
+        return f"{self.base}/api/v1/appointments/{appointment_id}"
+
+    def _cached(self, appointment_id: int, use_cache: bool) -> tuple[AppointmentInfo | None, _CacheEntry | None, dict]:
+        """
+        Возвращает (свежий объект из кэша | None, протухшая запись с ETag | None, доп. заголовки для запроса).
+        Для протухшей записи с ETag — условный запрос; на 304 отвечаем этой же записью,
+        даже если кэш успел её вытеснить.
+        """
+        if not use_cache:
+            return None, None, {}
+        entry = self.cache.get(self.company_id, appointment_id)
+        if entry is None:
+            return None, None, {}
+        if entry.expires_at > time.monotonic():
+            return entry.info, None, {}
+        if not entry.etag:
+            return None, None, {}
+        return None, entry, {"If-None-Match": entry.etag}
+
+    def _handle_response(self, appointment_id: int, r: httpx.Response, stale: _CacheEntry | None) -> AppointmentInfo:
+        if r.status_code == 304 and stale is not None:
+            self.cache.put(self.company_id, stale.info, stale.etag)
+            return stale.info
+        r.raise_for_status()
+        info = parse_appointment(appointment_id, r.json())
+        self.cache.put(self.company_id, info, r.headers.get("ETag"))
+        return info
+
+
+class AltegioClient(_AltegioBase):
+    """
+    Синхронный клиент с keep-alive пулом; переиспользуй один экземпляр на процесс.
+    """
+
+    def __init__(
+        self,
+        cache: AppointmentCache | None = None,
+        company_id: int | None = None,
+        token: str | None = None,
+    ) -> None:
+        super().__init__(cache, company_id, token)
+        self._http: httpx.Client | None = None
+
+    def _client(self) -> httpx.Client:
+        if self._http is None:
+            self._http = httpx.Client(timeout=15, limits=_limits(), headers=self._headers())
+        return self._http
+
+    def close(self) -> None:
+        if self._http is not None:
+            self._http.close()
+            self._http = None
+
+    def get_appointment(self, appointment_id: int, use_cache: bool = True) -> AppointmentInfo:
+        cached, stale, extra_headers = self._cached(appointment_id, use_cache)
+        if cached is not None:
+            return cached
+
+        r = self._client().get(
+            self._appointment_url(appointment_id),
+            headers=extra_headers,
+            params={"company_id": self.company_id},
         )
+        return self._handle_response(appointment_id, r, stale)
+
+    def list_appointments(self, start_date: date, end_date: date, page: int, count: int) -> tuple[list[dict], int | None]:
+        """
+        Одна страница записей салона за период: GET /api/v1/records/{company_id}?page=&count=&start_date=&end_date=
+        (страницы с 1). Возвращает (записи, meta.total_count | None — если API его не вернул).
+        """
+        r = self._client().get(
+            f"{self.base}/api/v1/records/{self.company_id}",
+            params={
+                "start_date": start_date.isoformat(),
+                "end_date": end_date.isoformat(),
+                "page": page,
+                "count": count,
+            },
+        )
+        r.raise_for_status()
+        data = r.json()
+        if not isinstance(data, dict):
+            return data or [], None
+        total = (data.get("meta") or {}).get("total_count")
+        return data.get("data") or [], int(total) if total is not None else None
+
+    def iter_appointments(self, start_date: date, end_date: date, page_size: int = 200) -> Iterator[AppointmentInfo]:
+        """
+        Генератор по всем записям периода, страница за страницей (в памяти — одна страница).
+        Конец данных: набрали meta.total_count или пришла пустая страница. Короткая страница концом
+        не считается — API может урезать count до своего максимума. Страница, повторяющая
+        предыдущую (page проигнорирован), прерывает обход. Нераспарсенные записи пропускаются с warning.
+        """
+        page = 1
+        seen = 0
+        prev_ids: list | None = None
+        while True:
+            items, total = self.list_appointments(start_date, end_date, page, page_size)
+            if not items:
+                return
+            ids = [item.get("id") for item in items]
+            if ids == prev_ids:
+                logger.warning("Altegio returned the same page twice, stopping", extra={"page": page})
+                return
+            prev_ids = ids
+            for item in items:
+                try:
+                    info = parse_record(item)
+                except Exception as e:
+                    logger.warning("Skipping unparseable Altegio appointment", extra={"item_id": item.get("id"), "error": str(e)})
+                    continue
+                yield info
+            seen += len(items)
+            if total is not None and seen >= total:
+                return
+            page += 1
+
+    def get_appointments(self, appointment_ids: list[int], use_cache: bool = True) -> dict[int, AppointmentInfo]:
+        """
+        Пакетная загрузка с ограниченным параллелизмом (ALTEGIO_MAX_CONCURRENCY).
+        Ошибки по отдельным записям логируются, такие id в результат не попадают.
+        """
+        ids = list(dict.fromkeys(appointment_ids))
+        result: dict[int, AppointmentInfo] = {}
+        if not ids:
+            return result
+
+        with ThreadPoolExecutor(max_workers=min(len(ids), settings.ALTEGIO_MAX_CONCURRENCY)) as pool:
+            futures = {appt_id: pool.submit(self.get_appointment, appt_id, use_cache) for appt_id in ids}
+            for appt_id, fut in futures.items():
+                try:
+                    result[appt_id] = fut.result()
+                except Exception as e:
+                    logger.warning("Altegio appointment fetch failed", extra={"appointment_id": appt_id, "error": str(e)})
+        return result
+
+
+class AsyncAltegioClient(_AltegioBase):
+    def __init__(
+        self,
+        cache: AppointmentCache | None = None,
+        company_id: int | None = None,
+        token: str | None = None,
+    ) -> None:
+        super().__init__(cache, company_id, token)
+        self._http = httpx.AsyncClient(timeout=15, limits=_limits(), headers=self._headers())
+
+    async def __aenter__(self) -> AsyncAltegioClient:
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+    async def get_appointment(self, appointment_id: int, use_cache: bool = True) -> AppointmentInfo:
+        cached, stale, extra_headers = self._cached(appointment_id, use_cache)
+        if cached is not None:
+            return cached
+
+        r = await self._http.get(
+            self._appointment_url(appointment_id),
+            headers=extra_headers,
+            params={"company_id": self.company_id},
+        )
+        return self._handle_response(appointment_id, r, stale)
+
+    async def get_appointments(self, appointment_ids: list[int], use_cache: bool = True) -> dict[int, AppointmentInfo]:
+        ids = list(dict.fromkeys(appointment_ids))
+        sem = asyncio.Semaphore(settings.ALTEGIO_MAX_CONCURRENCY)
+
+        async def _one(appt_id: int) -> AppointmentInfo:
+            async with sem:
+                return await self.get_appointment(appt_id, use_cache)
+
+        results = await asyncio.gather(*(_one(i) for i in ids), return_exceptions=True)
+
+        out: dict[int, AppointmentInfo] = {}
+        for appt_id, res in zip(ids, results):
+            if isinstance(res, BaseException):
+                logger.warning("Altegio appointment fetch failed", extra={"appointment_id": appt_id, "error": str(res)})
+                continue
+            out[appt_id] = res
+        return out
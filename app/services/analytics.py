@@ -1,8 +1,164 @@
 from __future__ import annotations
 
+import atexit
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+
+from sqlalchemy import event, insert
 from sqlalchemy.orm import Session
 
+from app.core.config import settings
 from app.db.models import EventLog
+from app.db.session import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+def event_row(
+    event_name: str,
+    appointment_id: int | None = None,
+    client_id: int | None = None,
+    task_id: int | None = None,
+    outbox_id: int | None = None,
+    template_key: str | None = None,
+    template_version: int | None = None,
+    meta: dict | None = None,
+) -> dict:
+    return {
+        "event_name": event_name,
+        "appointment_id": appointment_id,
+        "client_id": client_id,
+        "task_id": task_id,
+        "outbox_id": outbox_id,
+        "template_key": template_key,
+        "template_version": template_version,
+        "meta_json": meta or {},
+    }
+
+
+class BufferedEventSink:
+    """
+    In-process буфер событий: фоновый поток пишет их в event_log multi-row INSERT-ами
+    по порогу размера (batch_size) или времени (flush_interval).
+    Буфер ограничен max_buffer — при переполнении события отбрасываются (счётчик dropped).
+    """
+
+    def __init__(self, max_buffer: int, batch_size: int, flush_interval: float) -> None:
+        self.max_buffer = max_buffer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flushed = 0
+        self.dropped = 0
+        self.flush_errors = 0
+        self._buf: list[dict] = []
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._pid: int | None = None
+        atexit.register(self.flush)
+
+    def _ensure_thread(self) -> None:
+        # после fork (Celery prefork) поток родителя в дочернем процессе не существует
+        if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="event-sink", daemon=True)
+            self._thread.start()
+
+    def _keep(self, rows: list[dict]) -> list[dict]:
+        free = max(0, self.max_buffer - len(self._buf))
+        if len(rows) > free:
+            self.dropped += len(rows) - free
+            return rows[:free]
+        return rows
+
+    def add(self, rows: list[dict]) -> None:
+        now = datetime.now(timezone.utc)
+        with self._cond:
+            self._ensure_thread()
+            for row in self._keep(rows):
+                # время события, а не время flush-а
+                row.setdefault("ts", now)
+                self._buf.append(row)
+            if len(self._buf) >= self.batch_size:
+                self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._buf) >= self.batch_size, timeout=self.flush_interval)
+            self.flush()
+
+    def flush(self) -> int:
+        with self._cond:
+            rows, self._buf = self._buf, []
+        if not rows:
+            return 0
+
+        try:
+            with SessionLocal() as db:
+                for i in range(0, len(rows), self.batch_size):
+                    db.execute(insert(EventLog), rows[i : i + self.batch_size])
+                db.commit()
+        except Exception as e:
+            logger.exception("Event log flush failed", extra={"rows": len(rows), "error": str(e)})
+            with self._cond:
+                self.flush_errors += 1
+                # вернём в начало буфера сколько влезет, остальное — dropped
+                self._buf[:0] = self._keep(rows)
+            return 0
+
+        with self._cond:
+            self.flushed += len(rows)
+        return len(rows)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "buffered": len(self._buf),
+                "flushed": self.flushed,
+                "dropped": self.dropped,
+                "flush_errors": self.flush_errors,
+            }
+
+
+buffered_sink = BufferedEventSink(
+    max_buffer=settings.EVENT_BUFFER_MAX,
+    batch_size=settings.EVENT_BUFFER_BATCH_SIZE,
+    flush_interval=settings.EVENT_BUFFER_FLUSH_SECONDS,
+)
+
+
+# Буферизуемые события привязываются к сессии вызывающего и уходят в буфер только после её commit:
+# откатившаяся работа (enqueue, отправка, sync задач) не оставляет событий о несуществующих строках.
+_PENDING_KEY = "analytics.pending_events"
+
+
+def _defer(db: Session, rows: list[dict]) -> None:
+    now = datetime.now(timezone.utc)
+    for row in rows:
+        # время события, а не время commit-а / flush-а
+        row.setdefault("ts", now)
+    db.info.setdefault(_PENDING_KEY, []).extend(rows)
+
+
+@event.listens_for(Session, "after_commit")
+def _release_pending_events(session: Session) -> None:
+    rows = session.info.pop(_PENDING_KEY, None)
+    if rows:
+        buffered_sink.add(rows)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending_events(session: Session) -> None:
+    session.info.pop(_PENDING_KEY, None)
+
+
+def _buffered(transactional: bool | None) -> bool:
+    # EVENT_SINK="buffered" включает буфер по умолчанию; transactional=True всегда пишет в транзакцию вызывающего
+    if transactional is not None:
+        return not transactional
+    return settings.EVENT_SINK == "buffered"
 
 
 def log_event(
@@ -15,15 +171,31 @@ def log_event(
     template_key: str | None = None,
     template_version: int | None = None,
     meta: dict | None = None,
+    transactional: bool | None = None,
 ) -> None:
-    e = EventLog(
-        event_name=event_name,
+    row = event_row(
+        event_name,
         appointment_id=appointment_id,
         client_id=client_id,
         task_id=task_id,
         outbox_id=outbox_id,
         template_key=template_key,
         template_version=template_version,
-        meta_json=meta or {},
+        meta=meta,
     )
-    db.add(e)
+    if _buffered(transactional):
+        _defer(db, [row])
+        return
+    db.add(EventLog(**row))
+
+
+def log_events(db: Session, rows: list[dict], transactional: bool | None = None) -> None:
+    """
+    Один multi-row INSERT вместо N ORM-объектов. rows — результаты event_row().
+    """
+    if not rows:
+        return
+    if _buffered(transactional):
+        _defer(db, rows)
+        return
+    db.execute(insert(EventLog), rows)
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import json
+import time
+import uuid
+
+import redis
+import redis.asyncio as aioredis
+
+# Redis-очередь для пачечной обработки: API делает RPUSH, Celery-задача забирает пачками.
+# Рядом живёт debounce-ключ: пока он есть, задача-обработчик уже запланирована.
+# Надёжная выдача: claim() переносит пачку в "in flight" (hash batch_id -> элементы + zset времени),
+# ack() снимает её только после commit. Пачка упавшего воркера через visibility_seconds
+# возвращается в голову очереди (requeue_stale). ack(retry=...) откладывает часть элементов
+# в {queue}:retry — они вернутся в очередь при следующем запуске обработчика (promote_retries).
+
+CLAIM_LUA = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items == 0 then
+    return items
+end
+redis.call('LTRIM', KEYS[1], #items, -1)
+redis.call('HSET', KEYS[2], ARGV[2], cjson.encode(items))
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[2])
+return items
+"""
+
+# KEYS: queue, inflight hash, inflight zset; ARGV: batch ids. Уже подтверждённые пачки пропускаются.
+REQUEUE_LUA = """
+local n = 0
+for _, batch_id in ipairs(ARGV) do
+    local raw = redis.call('HGET', KEYS[2], batch_id)
+    if raw then
+        local items = cjson.decode(raw)
+        for i = #items, 1, -1 do
+            redis.call('LPUSH', KEYS[1], items[i])
+        end
+        n = n + #items
+    end
+    redis.call('HDEL', KEYS[2], batch_id)
+    redis.call('ZREM', KEYS[3], batch_id)
+end
+return n
+"""
+
+# в голову очереди: отложенные элементы старше всего, что пришло после них
+PROMOTE_LUA = """
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+for i = #items, 1, -1 do
+    redis.call('LPUSH', KEYS[2], items[i])
+end
+redis.call('DEL', KEYS[1])
+return #items
+"""
+
+DEFAULT_VISIBILITY_SECONDS = 300
+
+
+def _inflight_keys(queue_key: str) -> tuple[str, str]:
+    return f"{queue_key}:inflight", f"{queue_key}:inflight:ts"
+
+
+def _retry_key(queue_key: str) -> str:
+    return f"{queue_key}:retry"
+
+
+async def push(r: aioredis.Redis, queue_key: str, items: list[dict], debounce_seconds: float) -> bool:
+    """
+    Кладёт элементы в очередь. Возвращает True, если нужно запланировать задачу-обработчик
+    (apply_async(countdown=debounce_seconds)).
+    """
+    if not items:
+        return False
+    pipe = r.pipeline(transaction=False)
+    pipe.rpush(queue_key, *[json.dumps(i, default=str) for i in items])
+    pipe.set(f"{queue_key}:scheduled", "1", nx=True, ex=int(debounce_seconds) + 5)
+    _, scheduled = await pipe.execute()
+    return bool(scheduled)
+
+
+def reset_debounce(r: redis.Redis, queue_key: str) -> None:
+    # вызывать ДО чтения очереди: всё, что придёт позже, запланирует новую задачу
+    r.delete(f"{queue_key}:scheduled")
+
+
+def claim(r: redis.Redis, queue_key: str, limit: int) -> tuple[str | None, list[dict]]:
+    """
+    Забирает до `limit` элементов в "in flight". Возвращает (batch_id, элементы); пустая очередь — (None, []).
+    """
+    batch_id = uuid.uuid4().hex
+    raw = r.eval(CLAIM_LUA, 3, queue_key, *_inflight_keys(queue_key), limit, batch_id, time.time())
+    if not raw:
+        return None, []
+    return batch_id, [json.loads(x) for x in raw]
+
+
+def ack(r: redis.Redis, queue_key: str, batch_id: str, retry: list[dict] | None = None) -> None:
+    # после commit: пачка обработана; retry — элементы, которые нужно попробовать ещё раз позже
+    inflight, inflight_ts = _inflight_keys(queue_key)
+    pipe = r.pipeline(transaction=True)
+    if retry:
+        pipe.rpush(_retry_key(queue_key), *[json.dumps(i, default=str) for i in retry])
+    pipe.hdel(inflight, batch_id)
+    pipe.zrem(inflight_ts, batch_id)
+    pipe.execute()
+
+
+def requeue(r: redis.Redis, queue_key: str, batch_ids: list[str]) -> int:
+    # пачки возвращаются в голову очереди в исходном порядке
+    if not batch_ids:
+        return 0
+    return int(r.eval(REQUEUE_LUA, 3, queue_key, *_inflight_keys(queue_key), *batch_ids))
+
+
+def requeue_stale(r: redis.Redis, queue_key: str, visibility_seconds: float = DEFAULT_VISIBILITY_SECONDS) -> int:
+    """
+    Пачки, не подтверждённые за visibility_seconds (воркер упал / убит по time limit), — обратно в очередь.
+    visibility_seconds должен быть больше времени обработки одной пачки.
+    """
+    _, inflight_ts = _inflight_keys(queue_key)
+    stale = r.zrangebyscore(inflight_ts, "-inf", time.time() - visibility_seconds)
+    return requeue(r, queue_key, stale)
+
+
+def promote_retries(r: redis.Redis, queue_key: str) -> int:
+    return int(r.eval(PROMOTE_LUA, 2, _retry_key(queue_key), queue_key))
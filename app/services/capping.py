@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import redis
+import redis.asyncio as aioredis
+
+from app.core.config import settings
+
+# Защита от лишних платных сообщений:
+# - идемпотентность отправки по (task_id, template_key): "sending:<worker>" на время lease,
+#   после успеха — "sent:<provider_message_id>" на SENDER_IDEMPOTENCY_TTL_SECONDS;
+# - частотный лимит на получателя: не больше SENDER_RECIPIENT_CAP сообщений
+#   за окно SENDER_RECIPIENT_CAP_WINDOW_SECONDS (окно начинается с первого сообщения).
+
+# KEYS[1] — счётчик получателя; ARGV: limit, window_ms.
+# Возвращает 0 и засчитывает сообщение, либо сколько мс ждать до конца окна.
+CAP_CONSUME_LUA = """
+local n = tonumber(redis.call('GET', KEYS[1]) or '0')
+if n >= tonumber(ARGV[1]) then
+    local ttl = redis.call('PTTL', KEYS[1])
+    if ttl < 0 then
+        redis.call('PEXPIRE', KEYS[1], ARGV[2])
+        ttl = tonumber(ARGV[2])
+    end
+    return ttl
+end
+if redis.call('INCR', KEYS[1]) == 1 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def cap_enabled() -> bool:
+    return settings.SENDER_RECIPIENT_CAP > 0
+
+
+def _cap_key(to_phone_e164: str) -> str:
+    return f"whatsapp:cap:to:{to_phone_e164}"
+
+
+def _idem_key(task_id: int, template_key: str) -> str:
+    return f"whatsapp:sent:{task_id}:{template_key}"
+
+
+def _cap_args() -> list[int]:
+    return [settings.SENDER_RECIPIENT_CAP, int(settings.SENDER_RECIPIENT_CAP_WINDOW_SECONDS * 1000)]
+
+
+def sent_provider_id(value: str | None) -> str | None:
+    """
+    Значение ключа идемпотентности -> provider id, если сообщение уже ушло (иначе None).
+    """
+    if value and value.startswith("sent:"):
+        return value.removeprefix("sent:")
+    return None
+
+
+class SendGuard:
+    def __init__(self, r: redis.Redis) -> None:
+        self.r = r
+        self._cap = r.register_script(CAP_CONSUME_LUA)
+
+    def cap_wait_many(self, phones: set[str]) -> dict[str, float]:
+        """
+        Только проверка (без списания) для пачки получателей: {phone: секунд до конца окна}.
+        Используется при постановке в outbox; списание — перед отправкой.
+        """
+        if not cap_enabled() or not phones:
+            return {}
+        phones_list = list(phones)
+        pipe = self.r.pipeline(transaction=False)
+        for phone in phones_list:
+            pipe.get(_cap_key(phone))
+            pipe.pttl(_cap_key(phone))
+        res = pipe.execute()
+        out: dict[str, float] = {}
+        for i, phone in enumerate(phones_list):
+            count, ttl_ms = int(res[2 * i] or 0), res[2 * i + 1]
+            if count >= settings.SENDER_RECIPIENT_CAP and ttl_ms > 0:
+                out[phone] = ttl_ms / 1000.0
+        return out
+
+    def cap_consume(self, to_phone_e164: str) -> float:
+        # 0.0 — можно отправлять (сообщение засчитано), иначе секунды до конца окна
+        if not cap_enabled():
+            return 0.0
+        return int(self._cap(keys=[_cap_key(to_phone_e164)], args=_cap_args())) / 1000.0
+
+    def claim(self, task_id: int, template_key: str, worker_id: str) -> str | None:
+        """
+        None — отправку можно начинать; иначе текущее значение ключа (кто-то шлёт или уже отправил).
+        """
+        key = _idem_key(task_id, template_key)
+        if self.r.set(key, f"sending:{worker_id}", nx=True, ex=settings.SENDER_LEASE_SECONDS):
+            return None
+        return self.r.get(key) or ""
+
+    def confirm(self, task_id: int, template_key: str, provider_id: str) -> None:
+        self.r.set(_idem_key(task_id, template_key), f"sent:{provider_id}", ex=settings.SENDER_IDEMPOTENCY_TTL_SECONDS)
+
+    def release(self, task_id: int, template_key: str) -> None:
+        self.r.delete(_idem_key(task_id, template_key))
+
+
+class AsyncSendGuard:
+    """
+    То же самое для asyncio (redis.asyncio).
+    """
+
+    def __init__(self, r: aioredis.Redis) -> None:
+        self.r = r
+        self._cap = r.register_script(CAP_CONSUME_LUA)
+
+    async def cap_consume(self, to_phone_e164: str) -> float:
+        if not cap_enabled():
+            return 0.0
+        return int(await self._cap(keys=[_cap_key(to_phone_e164)], args=_cap_args())) / 1000.0
+
+    async def claim(self, task_id: int, template_key: str, worker_id: str) -> str | None:
+        key = _idem_key(task_id, template_key)
+        if await self.r.set(key, f"sending:{worker_id}", nx=True, ex=settings.SENDER_LEASE_SECONDS):
+            return None
+        return await self.r.get(key) or ""
+
+    async def confirm(self, task_id: int, template_key: str, provider_id: str) -> None:
+        await self.r.set(
+            _idem_key(task_id, template_key), f"sent:{provider_id}", ex=settings.SENDER_IDEMPOTENCY_TTL_SECONDS
+        )
+
+    async def release(self, task_id: int, template_key: str) -> None:
+        await self.r.delete(_idem_key(task_id, template_key))
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import json
+import time
+import zlib
+
+import redis
+import redis.asyncio as aioredis
+
+from app.core.config import settings
+
+# Коалесинг webhook-событий Altegio по записи (ALTEGIO_COALESCE_SECONDS > 0):
+# события одной записи копятся в своём списке, через окно одна задача забирает их все разом
+# и применяет пачкой — в БД пишется только последнее состояние.
+KEY_PREFIX = "altegio:appt"
+# ключ записи -> время первого ещё не обработанного события (для подметания потерянных окон)
+KEY_PENDING = "altegio:appt:pending"
+
+# Читает все события записи и снимает debounce: пришедшие во время обработки запланируют новую задачу.
+# Сам список не трогается до commit — его подрезает ACK_LUA.
+PEEK_ALL_LUA = """
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[2])
+return items
+"""
+
+# KEYS: события, pending; ARGV: сколько событий применено, ключ записи, новая голова ('' — без замены)
+ACK_LUA = """
+if tonumber(ARGV[1]) > 0 then
+    redis.call('LTRIM', KEYS[1], ARGV[1], -1)
+end
+local left = redis.call('LLEN', KEYS[1])
+if left > 0 and ARGV[3] ~= '' then
+    redis.call('LSET', KEYS[1], 0, ARGV[3])
+end
+if left == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[2])
+end
+return left
+"""
+
+
+def _events_key(key: str) -> str:
+    return f"{KEY_PREFIX}:{key}:events"
+
+
+def _scheduled_key(key: str) -> str:
+    return f"{KEY_PREFIX}:{key}:scheduled"
+
+
+def lock_name(key: str) -> str:
+    return f"lock:{KEY_PREFIX}:{key}"
+
+
+def appointment_id_of(payload: dict) -> int | None:
+    try:
+        return int(payload.get("appointment_id") or 0) or None
+    except (TypeError, ValueError):
+        return None
+
+
+def appointment_key(event: dict) -> str | None:
+    """
+    Ключ записи "<company_id>:<appointment_id>": id записей Altegio уникальны только внутри салона.
+    Салон — как в parse_altegio_event: из события, из payload, иначе ALTEGIO_COMPANY_ID.
+    """
+    payload = event.get("payload")
+    if not isinstance(payload, dict):
+        return None
+    appointment_id = appointment_id_of(payload)
+    if not appointment_id:
+        return None
+    company_id = event.get("company_id") or payload.get("company_id") or settings.ALTEGIO_COMPANY_ID
+    return f"{company_id}:{appointment_id}"
+
+
+def shard_queue(key: str) -> str | None:
+    """
+    Celery-очередь шарда записи (ALTEGIO_COALESCE_SHARDS > 0): события одной записи всегда
+    попадают в одну очередь; воркер шарда запускается с -Q altegio-<n> -c 1.
+    None — общая очередь по умолчанию (порядок тогда держит только lock записи).
+    """
+    shards = settings.ALTEGIO_COALESCE_SHARDS
+    if shards <= 0:
+        return None
+    return f"altegio-{zlib.crc32(str(key).encode()) % shards}"
+
+
+async def push(r: aioredis.Redis, key: str, event: dict, window_seconds: float) -> bool:
+    """
+    Добавляет событие в окно записи. True — окно только что открылось,
+    нужно запланировать обработку через window_seconds.
+    """
+    pipe = r.pipeline(transaction=True)
+    pipe.rpush(_events_key(key), json.dumps(event, default=str))
+    # страховка от вечного мусора, если запись так и не обработали
+    pipe.expire(_events_key(key), 24 * 3600)
+    pipe.zadd(KEY_PENDING, {key: time.time()}, nx=True)
+    pipe.set(_scheduled_key(key), "1", nx=True, ex=int(window_seconds) + 30)
+    *_, scheduled = await pipe.execute()
+    return bool(scheduled)
+
+
+def peek_all(r: redis.Redis, key: str) -> list[dict]:
+    raw = r.eval(PEEK_ALL_LUA, 2, _events_key(key), _scheduled_key(key))
+    return [json.loads(x) for x in raw]
+
+
+def ack(r: redis.Redis, key: str, done: int, head: dict | None = None) -> int:
+    """
+    После commit: снимает первые `done` событий записи; head — замена первого оставшегося
+    (счётчик попыток упавшего события). Возвращает, сколько событий осталось в списке.
+    """
+    return int(
+        r.eval(
+            ACK_LUA,
+            2,
+            _events_key(key),
+            KEY_PENDING,
+            done,
+            key,
+            json.dumps(head, default=str) if head is not None else "",
+        )
+    )
+
+
+def stale_appointments(r: redis.Redis, older_than_seconds: float, limit: int = 1000) -> list[str]:
+    # окна, задача по которым потерялась (рестарт воркера, сбой брокера)
+    return list(r.zrangebyscore(KEY_PENDING, "-inf", time.time() - older_than_seconds, start=0, num=limit))
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+
+import redis.asyncio as aioredis
+from sqlalchemy import delete
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.core.config import settings
+from app.db.models import WebhookDedup
+from app.db.session import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+_redis: aioredis.Redis | None = None
+
+
+def get_async_redis() -> aioredis.Redis:
+    global _redis
+    if _redis is None:
+        _redis = aioredis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _redis
+
+
+def _redis_key(provider: str, event_key: str) -> str:
+    return f"dedup:{provider}:{event_key}"
+
+
+def _insert_stmt(rows: list[dict]):
+    return pg_insert(WebhookDedup).values(rows).on_conflict_do_nothing(constraint="uq_webhook_dedup")
+
+
+async def claim_in_redis(provider: str, event_key: str) -> bool | None:
+    """
+    SET NX EX: True — событие новое, False — дубль, None — Redis недоступен.
+    """
+    try:
+        ok = await get_async_redis().set(
+            _redis_key(provider, event_key), "1", nx=True, ex=settings.WEBHOOK_DEDUP_TTL_SECONDS
+        )
+    except aioredis.RedisError as e:
+        logger.warning("Redis dedup unavailable, falling back to DB", extra={"error": str(e)})
+        return None
+    return bool(ok)
+
+
+async def release_in_redis(provider: str, event_key: str) -> None:
+    try:
+        await get_async_redis().delete(_redis_key(provider, event_key))
+    except aioredis.RedisError:
+        pass
+
+
+async def release_in_db(provider: str, event_key: str) -> None:
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                delete(WebhookDedup).where(WebhookDedup.provider == provider, WebhookDedup.event_key == event_key)
+            )
+            await db.commit()
+    except Exception as e:
+        # строка осталась — ретрай провайдера будет принят за дубль
+        logger.error("Webhook dedup release failed", extra={"event_key": event_key, "error": str(e)})
+
+
+async def claim_in_db(provider: str, event_key: str) -> bool:
+    """
+    INSERT ... ON CONFLICT DO NOTHING RETURNING id: без гонки SELECT-then-INSERT.
+    """
+    async with AsyncSessionLocal() as db:
+        res = await db.execute(
+            _insert_stmt([{"provider": provider, "event_key": event_key}]).returning(WebhookDedup.id)
+        )
+        inserted = res.scalar_one_or_none() is not None
+        await db.commit()
+    return inserted
+
+
+class DedupWriter:
+    """
+    Фоновая пачечная запись в webhook_dedup (долговременная копия Redis-ключей).
+    Сбрасывается по размеру пачки или по таймеру.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._rows: list[dict] = []
+        self._task: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+        # держится на время записи пачки: discard() дожидается её, прежде чем удалять строку
+        self._flushing = asyncio.Lock()
+
+    def add(self, provider: str, event_key: str) -> None:
+        self._rows.append({"provider": provider, "event_key": event_key})
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        if len(self._rows) >= self.batch_size:
+            self._wakeup.set()
+
+    async def discard(self, provider: str, event_key: str) -> None:
+        # убирает ещё не записанную строку; уже ушедшую в БД удаляет вызывающий
+        self._rows = [row for row in self._rows if row != {"provider": provider, "event_key": event_key}]
+        async with self._flushing:
+            pass
+
+    async def flush(self) -> None:
+        async with self._flushing:
+            rows, self._rows = self._rows, []
+            if not rows:
+                return
+            try:
+                async with AsyncSessionLocal() as db:
+                    await db.execute(_insert_stmt(rows))
+                    await db.commit()
+            except Exception as e:
+                logger.exception("Webhook dedup batch write failed", extra={"rows": len(rows), "error": str(e)})
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+dedup_writer = DedupWriter(
+    batch_size=settings.WEBHOOK_DEDUP_BATCH_SIZE,
+    flush_interval=settings.WEBHOOK_DEDUP_FLUSH_SECONDS,
+)
+
+
+async def claim_event(provider: str, event_key: str) -> bool:
+    """
+    Основная проверка идемпотентности вебхука. True — обрабатываем, False — дубль.
+    """
+    claimed = await claim_in_redis(provider, event_key)
+    if claimed is None:
+        return await claim_in_db(provider, event_key)
+    if not claimed:
+        return False
+
+    if settings.WEBHOOK_DEDUP_DB_ASYNC:
+        dedup_writer.add(provider, event_key)
+        return True
+    # Redis-ключ мог истечь раньше, чем строка в БД — тогда решает БД
+    return await claim_in_db(provider, event_key)
+
+
+async def release_event(provider: str, event_key: str) -> None:
+    """
+    Откат claim_event, если событие так и не удалось поставить в обработку: снимаются и Redis-ключ,
+    и строка webhook_dedup (в т.ч. ещё не записанная dedup_writer-ом) — иначе ретрай провайдера станет "дублем".
+    """
+    await release_in_redis(provider, event_key)
+    await dedup_writer.discard(provider, event_key)
+    await release_in_db(provider, event_key)
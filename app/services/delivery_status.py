@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import hashlib
+import hmac
+import json
+import logging
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.services.analytics import event_row, log_events
+
+logger = logging.getLogger(__name__)
+
+# Очередь статусов из WhatsApp webhook (см. app.services.batch_queue).
+KEY_STATUS_QUEUE = "whatsapp:statuses"
+
+# статус может только "расти": sent -> delivered -> read; failed — терминальный
+STATUS_RANK = {"sent": 1, "delivered": 2, "read": 3, "failed": 4}
+
+STATUS_EVENTS = {
+    "delivered": "message.delivered",
+    "read": "message.read",
+    "failed": "message.delivery_failed",
+}
+
+
+def verify_signature(body: bytes, signature_header: str | None) -> bool:
+    """
+    X-Hub-Signature-256: sha256=<hex HMAC-SHA256(body, app secret)>.
+    """
+    if not settings.WHATSAPP_APP_SECRET:
+        # с пустым ключом HMAC посчитает кто угодно — без секрета callback-и не принимаем
+        logger.error("WHATSAPP_APP_SECRET is not configured, rejecting WhatsApp webhook")
+        return False
+    if not signature_header or not signature_header.startswith("sha256="):
+        return False
+    expected = hmac.new(settings.WHATSAPP_APP_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature_header.removeprefix("sha256="))
+
+
+def parse_statuses(payload: dict) -> list[dict]:
+    """
+    Достаёт entry[].changes[].value.statuses[] из callback-а Cloud API.
+    """
+    out: list[dict] = []
+    for entry in payload.get("entry") or []:
+        for change in entry.get("changes") or []:
+            for st in (change.get("value") or {}).get("statuses") or []:
+                status = st.get("status")
+                if not st.get("id") or status not in STATUS_RANK:
+                    continue
+                errors = st.get("errors") or []
+                out.append(
+                    {
+                        "id": st["id"],
+                        "status": status,
+                        "ts": int(st.get("timestamp") or 0),
+                        "error": json.dumps(errors[0], ensure_ascii=False) if errors else None,
+                    }
+                )
+    return out
+
+
+def _collapse(statuses: list[dict]) -> list[dict]:
+    # на одно сообщение в пачке оставляем самый "старший" статус: UPDATE ... FROM не применит два раза
+    best: dict[str, dict] = {}
+    for st in statuses:
+        cur = best.get(st["id"])
+        if cur is None or STATUS_RANK[st["status"]] > STATUS_RANK[cur["status"]]:
+            best[st["id"]] = st
+    return list(best.values())
+
+
+_RANK_SQL = "CASE {col} WHEN 'sent' THEN 1 WHEN 'delivered' THEN 2 WHEN 'read' THEN 3 WHEN 'failed' THEN 4 ELSE 0 END"
+
+
+def apply_status_batch(db: Session, statuses: list[dict]) -> int:
+    """
+    Один UPDATE outbox_messages ... FROM (VALUES ...) по provider_message_id на всю пачку
+    + bulk-вставка событий. Возвращает число обновлённых сообщений.
+    """
+    rows = _collapse(statuses)
+    if not rows:
+        return 0
+
+    params: dict = {}
+    values_sql: list[str] = []
+    for i, st in enumerate(rows):
+        values_sql.append(f"(:id{i}, :st{i}, :ts{i}, :err{i})")
+        params[f"id{i}"] = st["id"]
+        params[f"st{i}"] = st["status"]
+        params[f"ts{i}"] = datetime.fromtimestamp(st["ts"], tz=timezone.utc) if st["ts"] else datetime.now(timezone.utc)
+        params[f"err{i}"] = st["error"]
+
+    sql = f"""
+        UPDATE outbox_messages AS o
+        SET status = v.status::outboxstatus,
+            delivered_at = CASE WHEN v.status IN ('delivered', 'read') THEN coalesce(o.delivered_at, v.ts)
+                                ELSE o.delivered_at END,
+            read_at = CASE WHEN v.status = 'read' THEN v.ts ELSE o.read_at END,
+            error = CASE WHEN v.status = 'failed' THEN v.error ELSE o.error END
+        FROM (VALUES {", ".join(values_sql)}) AS v(provider_message_id, status, ts, error)
+        WHERE o.provider_message_id = v.provider_message_id
+          AND {_RANK_SQL.format(col="v.status")} > {_RANK_SQL.format(col="o.status::text")}
+        RETURNING o.id, o.task_id, o.template_key, o.template_version, v.status, v.ts, v.error
+    """
+    updated = db.execute(text(sql), params).all()
+
+    events = []
+    for outbox_id, task_id, template_key, template_version, status, ts, error in updated:
+        row = event_row(
+            STATUS_EVENTS.get(status, f"message.{status}"),
+            task_id=task_id,
+            outbox_id=outbox_id,
+            template_key=template_key,
+            template_version=template_version,
+            meta={"error": error} if error else None,
+        )
+        # время события — время статуса у провайдера (для латентностей воронки)
+        row["ts"] = ts
+        events.append(row)
+    log_events(db, events)
+    return len(updated)
+
+
+_MATCHED_SQL = text(
+    "SELECT provider_message_id FROM outbox_messages WHERE provider_message_id IN :ids"
+).bindparams(bindparam("ids", expanding=True))
+
+
+def unmatched_for_retry(db: Session, statuses: list[dict], now: float | None = None) -> list[dict]:
+    """
+    Статусы, для которых ещё нет outbox-строки: callback обогнал commit provider_message_id у sender-а.
+    Возвращаются для повторной попытки (с отметкой first_seen), пока не старше WHATSAPP_STATUS_RETRY_SECONDS.
+    """
+    if not statuses:
+        return []
+    now = now or time.time()
+    matched = {row[0] for row in db.execute(_MATCHED_SQL, {"ids": list({st["id"] for st in statuses})})}
+    retry: list[dict] = []
+    dropped = 0
+    for st in statuses:
+        if st["id"] in matched:
+            continue
+        first_seen = st.get("first_seen") or now
+        if now - first_seen > settings.WHATSAPP_STATUS_RETRY_SECONDS:
+            dropped += 1
+            continue
+        retry.append({**st, "first_seen": first_seen})
+    if dropped:
+        logger.warning("Dropped WhatsApp statuses without outbox message", extra={"count": dropped})
+    return retry
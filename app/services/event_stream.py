@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import json
+import logging
+
+import redis.asyncio as aioredis
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# ALTEGIO_EVENTS_STREAM: webhook пишет события в Redis Stream, asyncio-consumer-ы
+# (app.tasks.stream_consumer) читают их через consumer group:
+# XREADGROUP -> применить -> XACK; упавший consumer не теряет события — их подбирает XAUTOCLAIM.
+STREAM_KEY = "altegio:stream"
+GROUP = "altegio-consumers"
+# события, которые не применились за ALTEGIO_STREAM_MAX_DELIVERIES доставок
+DEAD_KEY = "altegio:stream:dead"
+# запись -> id её упавшего события: более новые события записи ждут, пока оно не применится
+BLOCKED_KEY = "altegio:stream:blocked"
+
+UNBLOCK_LUA = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+Entry = tuple[str, dict]  # (stream entry id, event)
+
+
+async def publish(r: aioredis.Redis, event: dict) -> str:
+    # MAXLEN ~ — обрезка по макроузлам, O(1) на запись
+    return await r.xadd(
+        STREAM_KEY,
+        {"event": json.dumps(event, default=str)},
+        maxlen=settings.ALTEGIO_STREAM_MAXLEN,
+        approximate=True,
+    )
+
+
+async def ensure_group(r: aioredis.Redis) -> None:
+    try:
+        await r.xgroup_create(STREAM_KEY, GROUP, id="0", mkstream=True)
+    except aioredis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def _decode(raw: list) -> tuple[list[Entry], list[str]]:
+    # записи, обрезанные MAXLEN, приходят с пустыми полями — их уже не применить, только снять из pending
+    entries: list[Entry] = []
+    dropped: list[str] = []
+    for entry_id, fields in raw:
+        if fields and "event" in fields:
+            entries.append((entry_id, json.loads(fields["event"])))
+        else:
+            dropped.append(entry_id)
+    return entries, dropped
+
+
+async def _decode_and_ack_dropped(r: aioredis.Redis, raw: list) -> list[Entry]:
+    entries, dropped = _decode(raw)
+    if dropped:
+        logger.warning("Altegio stream entries trimmed before processing", extra={"count": len(dropped)})
+        await ack(r, dropped)
+    return entries
+
+
+async def read(r: aioredis.Redis, consumer: str, count: int, block_ms: int) -> list[Entry]:
+    resp = await r.xreadgroup(GROUP, consumer, {STREAM_KEY: ">"}, count=count, block=block_ms)
+    if not resp:
+        return []
+    return await _decode_and_ack_dropped(r, resp[0][1])
+
+
+async def reclaim(r: aioredis.Redis, consumer: str, min_idle_ms: int, count: int) -> list[Entry]:
+    """
+    Pending-записи, которые другой (упавший / зависший) consumer держит дольше min_idle_ms.
+    """
+    entries: list[Entry] = []
+    start = "0-0"
+    while True:
+        res = await r.xautoclaim(STREAM_KEY, GROUP, consumer, min_idle_ms, start_id=start, count=count)
+        start, raw = res[0], res[1]
+        entries += await _decode_and_ack_dropped(r, raw)
+        if start == "0-0" or len(entries) >= count:
+            return entries
+
+
+async def ack(r: aioredis.Redis, entry_ids: list[str]) -> None:
+    if entry_ids:
+        await r.xack(STREAM_KEY, GROUP, *entry_ids)
+
+
+async def deliveries(r: aioredis.Redis, entry_id: str) -> int:
+    pending = await r.xpending_range(STREAM_KEY, GROUP, min=entry_id, max=entry_id, count=1)
+    return int(pending[0]["times_delivered"]) if pending else 0
+
+
+async def dead_letter(r: aioredis.Redis, entry_id: str, event: dict, error: str) -> None:
+    pipe = r.pipeline(transaction=True)
+    pipe.xadd(
+        DEAD_KEY,
+        {"entry_id": entry_id, "event": json.dumps(event, default=str), "error": error},
+        maxlen=settings.ALTEGIO_STREAM_MAXLEN,
+        approximate=True,
+    )
+    pipe.xack(STREAM_KEY, GROUP, entry_id)
+    await pipe.execute()
+
+
+async def blockers(r: aioredis.Redis, keys: set[str]) -> dict[str, str]:
+    if not keys:
+        return {}
+    ordered = sorted(keys)
+    return {key: entry_id for key, entry_id in zip(ordered, await r.hmget(BLOCKED_KEY, ordered)) if entry_id}
+
+
+async def block(r: aioredis.Redis, key: str, entry_id: str) -> None:
+    # первое упавшее событие записи; более новые не перезаписывают
+    await r.hsetnx(BLOCKED_KEY, key, entry_id)
+
+
+async def unblock(r: aioredis.Redis, key: str, entry_id: str) -> None:
+    await r.eval(UNBLOCK_LUA, 1, BLOCKED_KEY, key, entry_id)
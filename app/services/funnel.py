@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import bindparam, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db.models import AnalyticsWatermark, TemplateFunnelStats
+
+WATERMARK_NAME = "template_funnel"
+
+# верхние границы корзин латентности, секунды; последняя корзина — ">= 86400"
+FUNNEL_LATENCY_BUCKETS = [1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600, 86400]
+
+COUNT_COLUMNS = {
+    "message.queued": "queued",
+    "message.sent": "sent",
+    "message.failed": "failed",
+    "message.dead_lettered": "failed",
+    "message.delivered": "delivered",
+    "message.read": "read",
+}
+HIST_COLUMNS = {
+    "message.sent": "queued_to_sent_hist",
+    "message.delivered": "sent_to_delivered_hist",
+    "message.read": "sent_to_read_hist",
+}
+
+# Верхняя граница обрабатываемого диапазона id: всё до первого "слишком свежего" события
+# (ts >= cutoff), чтобы не перепрыгнуть через строки ещё не закоммиченных транзакций.
+_HI_SQL = text(
+    """
+    SELECT coalesce(
+        (SELECT min(id) - 1 FROM event_log WHERE id > :lo AND ts >= :cutoff),
+        (SELECT max(id) FROM event_log WHERE id > :lo),
+        :lo
+    )
+    """
+)
+
+# Дыры в последовательности id внутри (lo, hi]: id выдан, но строки ещё нет — транзакция
+# не закоммичена (или откатилась). Их id запоминаются в watermark и досчитываются позже.
+_GAPS_SQL = text(
+    """
+    SELECT prev_id + 1, id - 1
+    FROM (
+        SELECT id, lag(id, 1, CAST(:lo AS bigint)) OVER (ORDER BY id) AS prev_id
+        FROM (
+            SELECT id FROM event_log WHERE id > :lo AND id <= :hi
+            UNION ALL
+            SELECT CAST(:hi AS bigint) + 1
+        ) ids
+    ) s
+    WHERE id - prev_id > 1
+    """
+)
+
+_LATE_SQL = text("SELECT id FROM event_log WHERE id IN :ids").bindparams(bindparam("ids", expanding=True))
+
+# queued -> sent считаем от outbox.created_at, sent -> delivered/read — от outbox.sent_at
+_AGG_SQL = text(
+    """
+    SELECT e.template_key,
+           e.template_version,
+           e.event_name,
+           CASE
+               WHEN e.event_name = 'message.sent'
+                   THEN width_bucket(EXTRACT(EPOCH FROM e.ts - o.created_at)::float8, CAST(:bounds AS float8[]))
+               WHEN e.event_name IN ('message.delivered', 'message.read')
+                   THEN width_bucket(EXTRACT(EPOCH FROM e.ts - o.sent_at)::float8, CAST(:bounds AS float8[]))
+           END AS bucket,
+           count(*) AS n
+    FROM event_log e
+    LEFT JOIN outbox_messages o ON o.id = e.outbox_id
+    WHERE ((e.id > :lo AND e.id <= :hi) OR e.id IN :late)
+      AND e.event_name IN :names
+      AND e.template_key IS NOT NULL
+    GROUP BY 1, 2, 3, 4
+    """
+).bindparams(bindparam("names", expanding=True), bindparam("late", expanding=True))
+
+
+def _empty_hist() -> list[int]:
+    return [0] * (len(FUNNEL_LATENCY_BUCKETS) + 1)
+
+
+def _lock_watermark(db: Session) -> AnalyticsWatermark:
+    # строка watermark под FOR UPDATE — заодно не даёт двум refresh-ам работать одновременно
+    db.execute(
+        pg_insert(AnalyticsWatermark)
+        .values(name=WATERMARK_NAME, last_event_id=0)
+        .on_conflict_do_nothing(index_elements=["name"])
+    )
+    return db.execute(
+        select(AnalyticsWatermark).where(AnalyticsWatermark.name == WATERMARK_NAME).with_for_update()
+    ).scalar_one()
+
+
+def _pending_gaps(db: Session, wm: AnalyticsWatermark, now: datetime) -> tuple[dict[int, float], list[int]]:
+    """
+    Дыры из прошлых refresh-ей: возвращает (ещё не появившиеся id, появившиеся — их пора посчитать).
+    Дыра старше FUNNEL_GAP_MAX_AGE_SECONDS считается откатившейся транзакцией и забывается.
+    """
+    horizon = now.timestamp() - settings.FUNNEL_GAP_MAX_AGE_SECONDS
+    pending = {int(event_id): seen for event_id, seen in (wm.pending_ids or []) if seen >= horizon}
+    if not pending:
+        return {}, []
+    late = [row[0] for row in db.execute(_LATE_SQL, {"ids": list(pending)})]
+    for event_id in late:
+        pending.pop(event_id, None)
+    return pending, late
+
+
+def _new_gaps(db: Session, lo: int, hi: int) -> list[int]:
+    gaps: list[int] = []
+    for first, last in db.execute(_GAPS_SQL, {"lo": lo, "hi": hi}):
+        # огромная дыра — это setval/сброс кэша sequence, а не транзакции в полёте: берём только верх
+        gaps.extend(range(max(first, last - settings.FUNNEL_GAP_MAX_IDS + 1), last + 1))
+    return gaps
+
+
+def refresh_funnel_stats(db: Session, now: datetime | None = None) -> dict:
+    """
+    Обрабатывает только события после watermark (не больше FUNNEL_REFRESH_MAX_EVENTS за раз)
+    и прибавляет их к template_funnel_stats. Коммитит вызывающий.
+    id берутся из sequence до коммита, поэтому строка поздно закоммиченной транзакции может
+    оказаться ниже watermark: такие дыры хранятся в watermark.pending_ids и досчитываются, когда строка появится.
+    """
+    now = now or datetime.now(timezone.utc)
+    wm = _lock_watermark(db)
+    lo = wm.last_event_id
+    pending, late = _pending_gaps(db, wm, now)
+
+    cutoff = now - timedelta(seconds=settings.FUNNEL_REFRESH_LAG_SECONDS)
+    hi = db.execute(_HI_SQL, {"lo": lo, "cutoff": cutoff}).scalar_one()
+    hi = min(hi, lo + settings.FUNNEL_REFRESH_MAX_EVENTS)
+    if hi > lo:
+        for event_id in _new_gaps(db, lo, hi):
+            pending[event_id] = now.timestamp()
+    # список дыр ограничен: при переполнении забываются самые старые
+    wm.pending_ids = sorted(pending.items(), key=lambda item: item[1])[-settings.FUNNEL_GAP_MAX_IDS :]
+    if hi == lo and not late:
+        return {"from_id": lo, "to_id": lo, "late": 0, "templates": 0}
+
+    rows = db.execute(
+        _AGG_SQL,
+        {"lo": lo, "hi": hi, "late": late, "names": list(COUNT_COLUMNS), "bounds": FUNNEL_LATENCY_BUCKETS},
+    ).all()
+
+    deltas: dict[tuple[str, int], list] = {}
+    for template_key, template_version, event_name, bucket, n in rows:
+        deltas.setdefault((template_key, template_version or 0), []).append((event_name, bucket, n))
+
+    if deltas:
+        existing = {
+            (s.template_key, s.template_version): s
+            for s in db.execute(
+                select(TemplateFunnelStats)
+                .where(TemplateFunnelStats.template_key.in_({k for k, _ in deltas}))
+                .with_for_update()
+            ).scalars()
+        }
+
+        for key, items in deltas.items():
+            stats = existing.get(key)
+            if stats is None:
+                stats = TemplateFunnelStats(
+                    template_key=key[0],
+                    template_version=key[1],
+                    queued=0,
+                    sent=0,
+                    failed=0,
+                    delivered=0,
+                    read=0,
+                )
+                db.add(stats)
+
+            for event_name, bucket, n in items:
+                col = COUNT_COLUMNS[event_name]
+                setattr(stats, col, (getattr(stats, col) or 0) + n)
+
+                hist_col = HIST_COLUMNS.get(event_name)
+                if hist_col and bucket is not None:
+                    # новый список, иначе JSON-колонка не увидит изменения
+                    hist = list(getattr(stats, hist_col) or _empty_hist())
+                    hist[bucket] += n
+                    setattr(stats, hist_col, hist)
+
+    wm.last_event_id = hi
+    return {"from_id": lo, "to_id": hi, "late": len(late), "templates": len(deltas)}
+
+
+def hist_percentile(hist: list[int] | None, p: float) -> float | None:
+    """
+    Приближённый перцентиль по гистограмме: верхняя граница корзины, в которую он попал.
+    """
+    if not hist:
+        return None
+    total = sum(hist)
+    if not total:
+        return None
+    target = p * total
+    acc = 0
+    for i, n in enumerate(hist):
+        acc += n
+        if acc >= target:
+            return float(FUNNEL_LATENCY_BUCKETS[min(i, len(FUNNEL_LATENCY_BUCKETS) - 1)])
+    return float(FUNNEL_LATENCY_BUCKETS[-1])
+
+
+def latency_summary(hist: list[int] | None) -> dict:
+    return {
+        "count": sum(hist or []),
+        "p50_s": hist_percentile(hist, 0.50),
+        "p90_s": hist_percentile(hist, 0.90),
+        "p99_s": hist_percentile(hist, 0.99),
+    }
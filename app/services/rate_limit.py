@@ -1,9 +1,15 @@
 from __future__ import annotations
 
+import asyncio
 import time
+from dataclasses import dataclass
 from datetime import datetime, timezone
 
 import redis
+import redis.asyncio as aioredis
+
+from app.core import metrics
+from app.core.config import settings
 
 
 KEY_NEXT_ALLOWED = "whatsapp:next_allowed_at"  # unix timestamp seconds
@@ -26,3 +32,253 @@ def wait_for_slot(r: redis.Redis, min_interval_seconds: int) -> None:
             return
         sleep_for = max(1, next_allowed - now)
         time.sleep(sleep_for)
+
+
+# --- token bucket -----------------------------------------------------------
+#
+# KEYS[i]  — ключ bucket-а (hash: tokens, ts)
+# ARGV     — по паре (rate tokens/sec, burst) на каждый ключ
+# Время берём из Redis (TIME), чтобы не зависеть от часов отдельных нод.
+# Токены списываются только если они есть во ВСЕХ bucket-ах сразу;
+# иначе возвращается точное время ожидания в миллисекундах.
+TOKEN_BUCKET_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local wait = 0
+local state = {}
+
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local burst = tonumber(ARGV[i * 2])
+    local data = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(data[1]) or burst
+    local ts = tonumber(data[2]) or now
+    if now > ts then
+        tokens = math.min(burst, tokens + (now - ts) * rate / 1000)
+    end
+    if tokens < 1 then
+        wait = math.max(wait, math.ceil((1 - tokens) * 1000 / rate))
+    end
+    state[i] = {tokens, rate, burst}
+end
+
+if wait > 0 then
+    return wait
+end
+
+for i, key in ipairs(KEYS) do
+    local tokens, rate, burst = state[i][1], state[i][2], state[i][3]
+    redis.call('HSET', key, 'tokens', tokens - 1, 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(burst * 1000 / rate) + 1000)
+end
+return 0
+"""
+
+
+@dataclass(frozen=True)
+class Bucket:
+    key: str
+    rate: float  # tokens per second
+    burst: int
+
+
+def phone_bucket(phone_number_id: str, rate: float | None = None) -> Bucket:
+    # rate — текущая скорость от AdaptiveRate (WHATSAPP_ADAPTIVE_RATE), иначе константа из настроек
+    return Bucket(
+        key=f"whatsapp:bucket:phone:{phone_number_id}",
+        rate=rate or settings.WHATSAPP_RATE_PER_SECOND,
+        burst=settings.WHATSAPP_RATE_BURST,
+    )
+
+
+def recipient_bucket(to_phone_e164: str) -> Bucket:
+    return Bucket(
+        key=f"whatsapp:bucket:to:{to_phone_e164}",
+        rate=settings.WHATSAPP_RECIPIENT_RATE_PER_SECOND,
+        burst=settings.WHATSAPP_RECIPIENT_RATE_BURST,
+    )
+
+
+def whatsapp_buckets(
+    phone_number_id: str,
+    to_phone_e164: str | None = None,
+    phone_rate: float | None = None,
+) -> list[Bucket]:
+    buckets = [phone_bucket(phone_number_id, phone_rate)]
+    if to_phone_e164:
+        buckets.append(recipient_bucket(to_phone_e164))
+    return buckets
+
+
+def _script_args(buckets: list[Bucket]) -> tuple[list[str], list[float | int]]:
+    args: list[float | int] = []
+    for b in buckets:
+        args.extend((b.rate, b.burst))
+    return [b.key for b in buckets], args
+
+
+class TokenBucketLimiter:
+    """
+    Атомарный (Lua) token bucket в Redis, общий для всех sender-ов и Celery-воркеров.
+    """
+
+    def __init__(self, r: redis.Redis) -> None:
+        self._script = r.register_script(TOKEN_BUCKET_LUA)
+
+    def try_acquire(self, buckets: list[Bucket]) -> float:
+        """
+        Пытается взять по токену из каждого bucket-а.
+        Возвращает 0.0 при успехе, иначе — сколько секунд ждать до следующей попытки.
+        """
+        keys, args = _script_args(buckets)
+        wait_ms = int(self._script(keys=keys, args=args))
+        return wait_ms / 1000.0
+
+    def acquire(self, buckets: list[Bucket], timeout: float | None = None) -> float:
+        """
+        Блокирует до получения токенов. Возвращает суммарное время ожидания (сек).
+        При timeout бросает TimeoutError.
+        """
+        waited = 0.0
+        while True:
+            wait = self.try_acquire(buckets)
+            if wait <= 0:
+                metrics.RATE_LIMIT_WAIT_SECONDS.observe(waited)
+                return waited
+            if timeout is not None and waited + wait > timeout:
+                raise TimeoutError(f"Rate limit slot not available within {timeout}s")
+            time.sleep(wait)
+            waited += wait
+
+
+class AsyncTokenBucketLimiter:
+    """
+    То же самое для asyncio (redis.asyncio): ожидание не блокирует event loop.
+    """
+
+    def __init__(self, r: aioredis.Redis) -> None:
+        self._script = r.register_script(TOKEN_BUCKET_LUA)
+
+    async def try_acquire(self, buckets: list[Bucket]) -> float:
+        keys, args = _script_args(buckets)
+        wait_ms = int(await self._script(keys=keys, args=args))
+        return wait_ms / 1000.0
+
+    async def acquire(self, buckets: list[Bucket], timeout: float | None = None) -> float:
+        waited = 0.0
+        while True:
+            wait = await self.try_acquire(buckets)
+            if wait <= 0:
+                metrics.RATE_LIMIT_WAIT_SECONDS.observe(waited)
+                return waited
+            if timeout is not None and waited + wait > timeout:
+                raise TimeoutError(f"Rate limit slot not available within {timeout}s")
+            await asyncio.sleep(wait)
+            waited += wait
+
+
+# --- adaptive rate (AIMD) ---------------------------------------------------
+#
+# Скорость phone-bucket-а на номер отправителя, общая для всех sender-ов:
+# KEYS[1] — hash {rate, cut_at}; ARGV: successes, throttled (0/1), initial, min, max, step, factor, cooldown_ms.
+# Additive increase: +step msg/s за каждые `rate` успешных отправок (≈ +step в секунду при полной загрузке).
+# Multiplicative decrease: rate * factor на throttling-ответ, не чаще раза в cooldown —
+# пачка 429 от уже летевших запросов не должна обрушить скорость в ноль.
+AIMD_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local data = redis.call('HMGET', KEYS[1], 'rate', 'cut_at')
+local rate = tonumber(data[1]) or tonumber(ARGV[3])
+local cut_at = tonumber(data[2]) or 0
+local min_rate, max_rate = tonumber(ARGV[4]), tonumber(ARGV[5])
+
+if tonumber(ARGV[2]) == 1 then
+    if now - cut_at >= tonumber(ARGV[8]) then
+        rate = rate * tonumber(ARGV[7])
+        redis.call('HSET', KEYS[1], 'cut_at', now)
+    end
+elseif tonumber(ARGV[1]) > 0 then
+    rate = rate + tonumber(ARGV[6]) * tonumber(ARGV[1]) / rate
+end
+
+rate = math.max(min_rate, math.min(max_rate, rate))
+redis.call('HSET', KEYS[1], 'rate', rate)
+return tostring(rate)
+"""
+
+# как часто процесс синхронизирует накопленные успехи и перечитывает общую скорость
+AIMD_SYNC_SECONDS = 1.0
+
+
+def _aimd_args(successes: int, throttled: bool) -> list[float | int]:
+    return [
+        successes,
+        1 if throttled else 0,
+        settings.WHATSAPP_RATE_PER_SECOND,
+        settings.WHATSAPP_RATE_MIN_PER_SECOND,
+        settings.WHATSAPP_RATE_MAX_PER_SECOND,
+        settings.WHATSAPP_RATE_INCREASE_STEP,
+        settings.WHATSAPP_RATE_DECREASE_FACTOR,
+        int(settings.WHATSAPP_RATE_DECREASE_COOLDOWN_SECONDS * 1000),
+    ]
+
+
+class AdaptiveRate:
+    """
+    AIMD-регулятор скорости отправки для номера (phone_number_id), состояние — в Redis.
+    Успехи копятся локально и уходят в Redis не чаще AIMD_SYNC_SECONDS; throttling — сразу.
+    """
+
+    def __init__(self, r: redis.Redis, phone_number_id: str) -> None:
+        self.key = f"whatsapp:aimd:{phone_number_id}"
+        self._script = r.register_script(AIMD_LUA)
+        self._rate = float(settings.WHATSAPP_RATE_PER_SECOND)
+        self._pending = 0
+        self._synced_at = 0.0
+
+    def _sync(self, throttled: bool = False) -> float:
+        successes, self._pending = self._pending, 0
+        self._rate = float(self._script(keys=[self.key], args=_aimd_args(successes, throttled)))
+        self._synced_at = time.monotonic()
+        return self._rate
+
+    def rate(self) -> float:
+        if time.monotonic() - self._synced_at >= AIMD_SYNC_SECONDS:
+            return self._sync()
+        return self._rate
+
+    def on_success(self) -> None:
+        self._pending += 1
+
+    def on_throttle(self) -> float:
+        return self._sync(throttled=True)
+
+
+class AsyncAdaptiveRate:
+    """
+    То же самое для asyncio (redis.asyncio).
+    """
+
+    def __init__(self, r: aioredis.Redis, phone_number_id: str) -> None:
+        self.key = f"whatsapp:aimd:{phone_number_id}"
+        self._script = r.register_script(AIMD_LUA)
+        self._rate = float(settings.WHATSAPP_RATE_PER_SECOND)
+        self._pending = 0
+        self._synced_at = 0.0
+
+    async def _sync(self, throttled: bool = False) -> float:
+        successes, self._pending = self._pending, 0
+        self._rate = float(await self._script(keys=[self.key], args=_aimd_args(successes, throttled)))
+        self._synced_at = time.monotonic()
+        return self._rate
+
+    async def rate(self) -> float:
+        if time.monotonic() - self._synced_at >= AIMD_SYNC_SECONDS:
+            return await self._sync()
+        return self._rate
+
+    def on_success(self) -> None:
+        self._pending += 1
+
+    async def on_throttle(self) -> float:
+        return await self._sync(throttled=True)
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import random
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import httpx
+import redis
+
+from app.core.config import settings
+
+# HTTP-статусы Graph API, после которых имеет смысл повторить
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+# коды ошибок Cloud API (error.code), временные по своей природе: throughput / pair rate limit / service unavailable
+RETRYABLE_GRAPH_CODES = {1, 2, 4, 80007, 130429, 131016, 131056}
+# сигналы "слишком быстро для номера": по ним AdaptiveRate снижает скорость.
+# 131056 (pair rate limit) сюда не входит — это лимит на пару отправитель-получатель,
+# его держит recipient-bucket, а общую скорость номера он не характеризует.
+THROTTLE_GRAPH_CODES = {4, 80007, 130429}
+
+
+# запрос точно не дошёл до провайдера: соединение не установлено / не получено из пула
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, redis.RedisError)
+
+
+@dataclass(frozen=True)
+class SendErrorClass:
+    retryable: bool
+    retry_after: float | None = None  # секунды, из заголовка Retry-After
+    # ответа нет, но запрос мог быть принят (таймаут чтения, обрыв после отправки) — повтор может задублировать
+    maybe_sent: bool = False
+
+
+def _graph_code(response: httpx.Response) -> int | None:
+    try:
+        return int(response.json()["error"]["code"])
+    except Exception:
+        return None
+
+
+def parse_retry_after(value: str | None, now: datetime | None = None) -> float | None:
+    """
+    Retry-After: либо число секунд, либо HTTP-date.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = now or datetime.now(timezone.utc)
+    return max(0.0, (at - now).total_seconds())
+
+
+def classify_send_error(error: BaseException) -> SendErrorClass:
+    """
+    Временная ошибка (429 / 5xx / нет соединения / исчерпан rate-limit) — повторяем;
+    остальное (400 с кривым номером, 401 и т.п.) — сразу failed.
+    Таймаут чтения / обрыв после отправки запроса — maybe_sent: провайдер мог сообщение принять.
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        response = error.response
+        retryable = response.status_code in RETRYABLE_STATUS or _graph_code(response) in RETRYABLE_GRAPH_CODES
+        return SendErrorClass(retryable, parse_retry_after(response.headers.get("Retry-After")))
+    # redis: недоступен rate-limiter / AIMD-состояние — сообщение не виновато
+    if isinstance(error, NOT_SENT_ERRORS):
+        return SendErrorClass(True)
+    if isinstance(error, (httpx.TimeoutException, httpx.TransportError, TimeoutError, ConnectionError)):
+        return SendErrorClass(True, maybe_sent=True)
+    return SendErrorClass(False)
+
+
+def is_throttle_error(error: BaseException) -> bool:
+    if not isinstance(error, httpx.HTTPStatusError):
+        return False
+    return error.response.status_code == 429 or _graph_code(error.response) in THROTTLE_GRAPH_CODES
+
+
+def backoff_seconds(attempt: int, retry_after: float | None = None) -> float:
+    """
+    Экспоненциальный backoff с "full jitter": uniform(0, min(max, base * 2^(attempt-1))),
+    но не раньше, чем просит провайдер (Retry-After).
+    attempt — номер только что неудавшейся попытки, с 1.
+    """
+    cap = min(settings.SENDER_RETRY_MAX_SECONDS, settings.SENDER_RETRY_BASE_SECONDS * 2 ** max(0, attempt - 1))
+    delay = random.uniform(0, cap)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
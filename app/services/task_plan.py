@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from app.db.models import Lane, TaskStatus
+
+
+@dataclass(frozen=True)
+class TaskSpec:
+    type: str
+    planned_at: datetime
+    template_key: str
+    priority: Lane = Lane.normal
+    deadline_at: datetime | None = None
+
+    def payload(self) -> dict:
+        return {"template_key": self.template_key}
+
+    def task_row(self, appointment_id: int) -> dict:
+        # для bulk insert(Task) / Task(**row)
+        return {
+            "appointment_id": appointment_id,
+            "type": self.type,
+            "planned_at": self.planned_at,
+            "status": TaskStatus.scheduled,
+            "payload_json": self.payload(),
+            "priority": int(self.priority),
+            "deadline_at": self.deadline_at,
+        }
+
+
+def default_task_specs(
+    starts_at: datetime,
+    ends_at: datetime,
+    now: datetime,
+    include_created: bool = True,
+) -> list[TaskSpec]:
+    """
+    MVP-логика:
+    - created: подтверждение сразу
+    - reminders: за 24ч и за 2ч
+    - review: через 2ч после визита
+    - rebook: через 21 день после визита
+    Напоминания и подтверждение после начала визита не шлём (deadline_at = starts_at),
+    запрос отзыва — не позже суток после визита.
+    """
+    specs = [
+        TaskSpec("reminder_24h", starts_at - timedelta(hours=24), "REMINDER_24H", Lane.normal, starts_at),
+        TaskSpec("reminder_2h", starts_at - timedelta(hours=2), "REMINDER_2H", Lane.urgent, starts_at),
+        TaskSpec("review_request", ends_at + timedelta(hours=2), "REVIEW_REQUEST", Lane.normal, ends_at + timedelta(days=1)),
+        TaskSpec("rebook_invite", ends_at + timedelta(days=21), "REBOOK_INVITE", Lane.bulk),
+    ]
+    if include_created:
+        specs.insert(0, TaskSpec("send_created", now, "APPT_CREATED", Lane.urgent, starts_at))
+    return specs
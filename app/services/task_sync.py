@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.orm import Session
+
+from app.db.models import OutboxMessage, OutboxStatus, Task, TaskStatus
+from app.services.analytics import event_row
+from app.services.task_plan import TaskSpec, default_task_specs
+
+ACTIVE_TASK_STATUSES = (TaskStatus.scheduled, TaskStatus.queued)
+
+
+@dataclass(frozen=True)
+class AppointmentPlan:
+    appointment_id: int
+    client_id: int
+    starts_at: datetime
+    ends_at: datetime
+    canceled: bool = False
+
+
+@dataclass
+class TaskDiff:
+    # новые и перенесённые задачи — для timer wheel после commit
+    planned: list[tuple[int, datetime]] = field(default_factory=list)
+    canceled: list[int] = field(default_factory=list)
+    outbox_deleted: int = 0
+    events: list[dict] = field(default_factory=list)
+
+
+def sync_appointment_tasks(db: Session, plans: list[AppointmentPlan], now: datetime) -> TaskDiff:
+    """
+    Приводит активные задачи записей к желаемому набору (default_task_specs без "created"):
+    - перенос записи: UPDATE planned_at у существующих задач, недостающие — INSERT,
+      ставшие прошлыми — canceled;
+    - отмена записи: все активные задачи -> canceled.
+    Queued-задачи, чьё сообщение ещё не захвачено sender-ом, возвращаются в scheduled
+    (текст отрендерен со старым временем), а сообщение удаляется из outbox.
+    Один запрос на каждый вид изменения для всей пачки записей. События — в diff.events.
+    """
+    diff = TaskDiff()
+    if not plans:
+        return diff
+    by_appt = {p.appointment_id: p for p in plans}
+
+    existing = db.execute(
+        select(Task.id, Task.appointment_id, Task.type, Task.planned_at, Task.deadline_at, Task.status)
+        .where(Task.appointment_id.in_(by_appt), Task.status.in_(ACTIVE_TASK_STATUSES))
+        .order_by(Task.id)
+        .with_for_update()
+    ).all()
+
+    # claim sender-а переводит сообщение в sending, поэтому status = queued — ещё не ушло
+    queued_ids = [t.id for t in existing if t.status == TaskStatus.queued]
+    released: set[int] = set()
+    if queued_ids:
+        released = set(
+            db.scalars(
+                delete(OutboxMessage)
+                .where(OutboxMessage.task_id.in_(queued_ids), OutboxMessage.status == OutboxStatus.queued)
+                .returning(OutboxMessage.task_id)
+            )
+        )
+        diff.outbox_deleted = len(released)
+
+    desired: dict[tuple[int, str], TaskSpec] = {}
+    managed: dict[int, set[str]] = {}
+    for p in plans:
+        if p.canceled:
+            continue
+        specs = default_task_specs(p.starts_at, p.ends_at, now, include_created=False)
+        managed[p.appointment_id] = {s.type for s in specs}
+        for s in specs:
+            if s.planned_at > now:
+                desired[(p.appointment_id, s.type)] = s
+
+    moves: list[dict] = []
+    cancels: list[int] = []
+    covered: set[tuple[int, str]] = set()
+    for t in existing:
+        key = (t.appointment_id, t.type)
+        if t.status == TaskStatus.queued and t.id not in released:
+            # сообщение уже отправляется — не трогаем и не дублируем
+            covered.add(key)
+            continue
+        plan = by_appt[t.appointment_id]
+        if plan.canceled:
+            cancels.append(t.id)
+        elif t.type not in managed[t.appointment_id]:
+            # не наш тип (например, send_created): только перерендер, если сообщение сняли
+            if t.id in released:
+                moves.append({"id": t.id, "planned_at": t.planned_at, "status": TaskStatus.scheduled})
+        elif key not in desired or key in covered:
+            cancels.append(t.id)
+        else:
+            covered.add(key)
+            spec = desired[key]
+            if spec.planned_at != t.planned_at or spec.deadline_at != t.deadline_at or t.id in released:
+                moves.append(
+                    {"id": t.id, "planned_at": spec.planned_at, "deadline_at": spec.deadline_at, "status": TaskStatus.scheduled}
+                )
+
+    if moves:
+        db.execute(update(Task), moves)
+    if cancels:
+        db.execute(update(Task).where(Task.id.in_(cancels)).values(status=TaskStatus.canceled))
+
+    new_rows = [spec.task_row(appt_id) for (appt_id, task_type), spec in desired.items() if (appt_id, task_type) not in covered]
+    inserted = []
+    if new_rows:
+        inserted = db.execute(
+            insert(Task).returning(Task.id, Task.appointment_id, Task.planned_at),
+            new_rows,
+        ).all()
+
+    task_appt = {t.id: t.appointment_id for t in existing}
+    for m in moves:
+        diff.planned.append((m["id"], m["planned_at"]))
+        diff.events.append(_event("task.rescheduled", by_appt[task_appt[m["id"]]], m["id"], m["planned_at"]))
+    for task_id, appt_id, planned_at in inserted:
+        diff.planned.append((task_id, planned_at))
+        diff.events.append(_event("task.scheduled", by_appt[appt_id], task_id, planned_at))
+    for task_id in cancels:
+        diff.canceled.append(task_id)
+        diff.events.append(_event("task.canceled", by_appt[task_appt[task_id]], task_id))
+    return diff
+
+
+def _event(name: str, plan: AppointmentPlan, task_id: int, planned_at: datetime | None = None) -> dict:
+    return event_row(
+        name,
+        appointment_id=plan.appointment_id,
+        client_id=plan.client_id,
+        task_id=task_id,
+        meta={"planned_at": planned_at.isoformat()} if planned_at else None,
+    )
@@ -1,14 +1,122 @@
 from __future__ import annotations
 
-from jinja2 import Environment, BaseLoader
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+import redis.asyncio as aioredis
+from jinja2 import Environment, BaseLoader, Template
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 
+from app.core import metrics
+from app.core.config import settings
 from app.db.models import MessageTemplate
 
+logger = logging.getLogger(__name__)
 
 _jinja = Environment(loader=BaseLoader(), autoescape=False)
 
+# Счётчик изменений шаблонов: API делает INCR, процессы-рендереры сверяются с ним
+# и перечитывают шаблоны из БД только когда он изменился.
+KEY_TEMPLATES_STAMP = "templates:stamp"
+
+
+class TemplateCache:
+    """
+    Process-local кэш:
+    - активные шаблоны (key, language) -> (text, version), одной выборкой из БД;
+    - скомпилированные Jinja-шаблоны по (key, language, version) с LRU-вытеснением.
+    max_age_seconds — страховка на случай потерянного INCR (Redis был недоступен при публикации):
+    шаблоны перечитываются не реже этого интервала, даже если stamp не менялся.
+    """
+
+    def __init__(self, maxsize: int, check_interval_seconds: float, max_age_seconds: float) -> None:
+        self.maxsize = maxsize
+        self.check_interval = check_interval_seconds
+        self.max_age = max_age_seconds
+        self._loaded_at = 0.0
+        self._compiled: OrderedDict[tuple[str, str, int], Template] = OrderedDict()
+        self._rows: dict[tuple[str, str], tuple[str, int]] | None = None
+        self._stamp: str | None = None
+        self._checked_at = 0.0
+        self._redis: redis.Redis | None = None
+        self._lock = threading.Lock()
+
+    def _current_stamp(self) -> str | None:
+        try:
+            if self._redis is None:
+                self._redis = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+            return self._redis.get(KEY_TEMPLATES_STAMP) or "0"
+        except redis.RedisError as e:
+            # без Redis не знаем, менялось ли что-то — перечитываем на каждой проверке
+            logger.warning("Template stamp check failed", extra={"error": str(e)})
+            return None
+
+    def _ensure_fresh(self, db: Session) -> dict[tuple[str, str], tuple[str, int]]:
+        now = time.monotonic()
+        if self._rows is not None and now - self._checked_at < self.check_interval:
+            return self._rows
+
+        # stamp читаем ДО выборки: изменение между ними просто вызовет ещё одну перезагрузку
+        stamp = self._current_stamp()
+        self._checked_at = now
+        expired = now - self._loaded_at >= self.max_age
+        if self._rows is None or stamp is None or stamp != self._stamp or expired:
+            rows = db.execute(select(MessageTemplate).where(MessageTemplate.is_active.is_(True))).scalars().all()
+            self._rows = {(t.key, t.language): (t.text, t.version) for t in rows}
+            self._stamp = stamp
+            self._loaded_at = now
+        return self._rows
+
+    def _compile(self, key: str, language: str, version: int, text: str) -> Template:
+        ck = (key, language, version)
+        tpl = self._compiled.get(ck)
+        if tpl is not None:
+            self._compiled.move_to_end(ck)
+            return tpl
+
+        tpl = _jinja.from_string(text)
+        self._compiled[ck] = tpl
+        while len(self._compiled) > self.maxsize:
+            self._compiled.popitem(last=False)
+        return tpl
+
+    def get(self, db: Session, key: str, language: str) -> tuple[Template, int]:
+        with self._lock:
+            row = self._ensure_fresh(db).get((key, language))
+            if row is None:
+                raise RuntimeError(f"Template not found or inactive: {key}/{language}")
+            text, version = row
+            return self._compile(key, language, version, text), version
+
+    def clear(self) -> None:
+        with self._lock:
+            self._compiled.clear()
+            self._rows = None
+            self._stamp = None
+
+
+template_cache = TemplateCache(
+    maxsize=settings.TEMPLATE_CACHE_MAXSIZE,
+    check_interval_seconds=settings.TEMPLATE_STAMP_CHECK_SECONDS,
+    max_age_seconds=settings.TEMPLATE_CACHE_MAX_AGE_SECONDS,
+)
+
+
+async def publish_templates_changed() -> None:
+    """
+    Вызывается API после create/update шаблона: все процессы увидят новый stamp
+    и перечитают шаблоны при следующей проверке.
+    """
+    r = aioredis.Redis.from_url(settings.REDIS_URL)
+    try:
+        await r.incr(KEY_TEMPLATES_STAMP)
+    finally:
+        await r.aclose()
+
 
 def render_template(db: Session, key: str, language: str, context: dict) -> tuple[str, int]:
     """
@@ -16,17 +124,7 @@ def render_template(db: Session, key: str, language: str, context: dict) -> tupl
     Шаблон хранится в БД как Jinja2-текст, например:
     "Привет, {{ client_name }}! Вы записаны на {{ date }} в {{ time }}."
     """
-    t = db.execute(
-        select(MessageTemplate).where(
-            MessageTemplate.key == key,
-            MessageTemplate.language == language,
-            MessageTemplate.is_active.is_(True),
-        )
-    ).scalar_one_or_none()
-
-    if not t:
-        raise RuntimeError(f"Template not found or inactive: {key}/{language}")
-
-    tpl = _jinja.from_string(t.text)
-    rendered = tpl.render(**context)
-    return rendered, t.version
+    with metrics.timed(metrics.TEMPLATE_RENDER_SECONDS, template_key=key):
+        tpl, version = template_cache.get(db, key, language)
+        rendered = tpl.render(**context)
+    return rendered, version
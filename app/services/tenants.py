@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import threading
+import time
+from dataclasses import dataclass
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db.models import Company, OutboxMessage, OutboxStatus
+
+# Салоны (tenants) читаются из таблицы companies и кэшируются в процессе:
+# webhook-и, enqueue и sender обращаются к ним на каждую пачку.
+TENANT_CACHE_SECONDS = 60.0
+
+
+@dataclass(frozen=True)
+class Tenant:
+    altegio_company_id: int
+    altegio_api_token: str
+    webhook_secret: str
+    # None — номер по умолчанию (settings.WHATSAPP_PHONE_NUMBER_ID), так же хранится в outbox
+    phone_number_id: str | None
+    whatsapp_token: str
+
+
+@dataclass(frozen=True)
+class SenderNumber:
+    """
+    Номер отправителя — независимый поток отправки: свой token bucket / AIMD, свой пул соединений.
+    default — номер по умолчанию, он же забирает сообщения с phone_number_id IS NULL.
+    """
+
+    phone_number_id: str
+    token: str
+    default: bool = False
+
+
+def default_tenant(company_id: int | None = None) -> Tenant:
+    return Tenant(
+        altegio_company_id=company_id or settings.ALTEGIO_COMPANY_ID,
+        altegio_api_token=settings.ALTEGIO_API_TOKEN,
+        webhook_secret=settings.ALTEGIO_WEBHOOK_SECRET,
+        phone_number_id=None,
+        whatsapp_token=settings.WHATSAPP_TOKEN,
+    )
+
+
+def _from_row(c: Company) -> Tenant:
+    phone_number_id = c.whatsapp_phone_number_id or None
+    if phone_number_id == settings.WHATSAPP_PHONE_NUMBER_ID:
+        phone_number_id = None
+    return Tenant(
+        altegio_company_id=c.altegio_company_id,
+        altegio_api_token=c.altegio_api_token or settings.ALTEGIO_API_TOKEN,
+        webhook_secret=c.altegio_webhook_secret or settings.ALTEGIO_WEBHOOK_SECRET,
+        phone_number_id=phone_number_id,
+        whatsapp_token=c.whatsapp_token or settings.WHATSAPP_TOKEN,
+    )
+
+
+_cache: tuple[float, dict[int, Tenant]] | None = None
+_cache_lock = threading.Lock()
+
+
+def load_tenants(db: Session) -> dict[int, Tenant]:
+    """
+    {altegio_company_id: Tenant} активных салонов, с кэшем на TENANT_CACHE_SECONDS.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is not None and _cache[0] > time.monotonic():
+            return _cache[1]
+    rows = db.execute(select(Company).where(Company.is_active.is_(True))).scalars().all()
+    tenants = {c.altegio_company_id: _from_row(c) for c in rows}
+    with _cache_lock:
+        _cache = (time.monotonic() + TENANT_CACHE_SECONDS, tenants)
+    return tenants
+
+
+async def aload_tenants(db: AsyncSession) -> dict[int, Tenant]:
+    return await db.run_sync(load_tenants)
+
+
+def tenant_for(tenants: dict[int, Tenant], company_id: int | None) -> Tenant:
+    # компания без строки в companies работает на глобальных кредах
+    if company_id and company_id in tenants:
+        return tenants[company_id]
+    return default_tenant(company_id)
+
+
+def sender_numbers(tenants: dict[int, Tenant]) -> list[SenderNumber]:
+    """
+    Номер по умолчанию + собственные номера салонов.
+    Несколько салонов на одном номере делят один поток (лимиты провайдера — на номер).
+    """
+    numbers = {
+        settings.WHATSAPP_PHONE_NUMBER_ID: SenderNumber(settings.WHATSAPP_PHONE_NUMBER_ID, settings.WHATSAPP_TOKEN, True)
+    }
+    for t in tenants.values():
+        if t.phone_number_id and t.phone_number_id not in numbers:
+            numbers[t.phone_number_id] = SenderNumber(t.phone_number_id, t.whatsapp_token)
+    return list(numbers.values())
+
+
+def backlog_numbers(db: Session, active: list[SenderNumber]) -> list[SenderNumber]:
+    """
+    Номера вне активного списка (салон отключён или сменил номер), у которых в outbox ещё есть
+    queued-сообщения: их поток дорабатывает очередь и останавливается, когда она пуста.
+    Токен — из строки companies (в т.ч. неактивной), иначе глобальный.
+    """
+    served = {s.phone_number_id for s in active}
+    numbers = db.execute(
+        select(OutboxMessage.phone_number_id)
+        .where(OutboxMessage.status == OutboxStatus.queued, OutboxMessage.phone_number_id.is_not(None))
+        .distinct()
+    ).scalars().all()
+    orphaned = [n for n in numbers if n not in served]
+    if not orphaned:
+        return []
+    tokens = {
+        c.whatsapp_phone_number_id: c.whatsapp_token
+        for c in db.execute(select(Company).where(Company.whatsapp_phone_number_id.in_(orphaned))).scalars()
+        if c.whatsapp_token
+    }
+    return [SenderNumber(n, tokens.get(n) or settings.WHATSAPP_TOKEN) for n in orphaned]
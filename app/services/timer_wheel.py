@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import logging
+import time
+from datetime import datetime
+
+import redis
+import redis.asyncio as aioredis
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Зеркало Task.planned_at в Redis: ZSET (member = task id, score = unix ts).
+# Используется опциональным dispatcher-ом (SCHEDULER_ZSET_ENABLED) вместо поллинга таблицы tasks.
+KEY_DUE = "tasks:due"
+# "будильник" dispatcher-а: появилась задача раньше той, до которой он спит
+KEY_WAKEUP = "tasks:due:wakeup"
+
+# Атомарно забирает до ARGV[2] задач со score <= ARGV[1].
+POP_DUE_LUA = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #ids > 0 then
+    redis.call('ZREM', KEYS[1], unpack(ids))
+end
+return ids
+"""
+
+
+def add_tasks(r: redis.Redis, planned: list[tuple[int, datetime]]) -> None:
+    """
+    planned = [(task_id, planned_at), ...]. Вызывать ПОСЛЕ commit,
+    иначе dispatcher может забрать id ещё не видимой задачи.
+    """
+    if not planned:
+        return
+    pipe = r.pipeline(transaction=False)
+    pipe.zadd(KEY_DUE, {str(task_id): planned_at.timestamp() for task_id, planned_at in planned})
+    pipe.lpush(KEY_WAKEUP, "1")
+    pipe.ltrim(KEY_WAKEUP, 0, 0)
+    pipe.execute()
+
+
+def mirror(r: redis.Redis, planned: list[tuple[int, datetime]]) -> None:
+    """
+    Опциональный движок (SCHEDULER_ZSET_ENABLED): копия planned_at для dispatcher-а.
+    Вызывать после commit. Ошибка Redis не критична — задачу подберёт поллинг enqueue_due_tasks.
+    """
+    if not settings.SCHEDULER_ZSET_ENABLED or not planned:
+        return
+    try:
+        add_tasks(r, planned)
+    except redis.RedisError as e:
+        logger.warning("Timer wheel mirror failed", extra={"error": str(e)})
+
+
+def remove_tasks(r: redis.Redis, task_ids: list[int]) -> None:
+    if task_ids:
+        r.zrem(KEY_DUE, *[str(i) for i in task_ids])
+
+
+def unmirror(r: redis.Redis, task_ids: list[int]) -> None:
+    """
+    Пара к mirror() для отменённых задач. Не обязательна для корректности:
+    dispatcher всё равно берёт только scheduled-задачи, это чистка ZSET.
+    """
+    if not settings.SCHEDULER_ZSET_ENABLED or not task_ids:
+        return
+    try:
+        remove_tasks(r, task_ids)
+    except redis.RedisError as e:
+        logger.warning("Timer wheel unmirror failed", extra={"error": str(e)})
+
+
+async def amirror(r: aioredis.Redis, planned: list[tuple[int, datetime]]) -> None:
+    """
+    mirror() для asyncio-процессов (app.tasks.stream_consumer).
+    """
+    if not settings.SCHEDULER_ZSET_ENABLED or not planned:
+        return
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.zadd(KEY_DUE, {str(task_id): planned_at.timestamp() for task_id, planned_at in planned})
+        pipe.lpush(KEY_WAKEUP, "1")
+        pipe.ltrim(KEY_WAKEUP, 0, 0)
+        await pipe.execute()
+    except redis.RedisError as e:
+        logger.warning("Timer wheel mirror failed", extra={"error": str(e)})
+
+
+async def aunmirror(r: aioredis.Redis, task_ids: list[int]) -> None:
+    if not settings.SCHEDULER_ZSET_ENABLED or not task_ids:
+        return
+    try:
+        await r.zrem(KEY_DUE, *[str(i) for i in task_ids])
+    except redis.RedisError as e:
+        logger.warning("Timer wheel unmirror failed", extra={"error": str(e)})
+
+
+def pop_due(r: redis.Redis, limit: int, now: float | None = None) -> list[int]:
+    now = time.time() if now is None else now
+    ids = r.eval(POP_DUE_LUA, 1, KEY_DUE, now, limit)
+    return [int(i) for i in ids]
+
+
+def seconds_until_next(r: redis.Redis, now: float | None = None) -> float | None:
+    """
+    Сколько секунд до ближайшей задачи; None — если ZSET пуст.
+    """
+    now = time.time() if now is None else now
+    head = r.zrange(KEY_DUE, 0, 0, withscores=True)
+    if not head:
+        return None
+    return max(0.0, head[0][1] - now)
+
+
+def wait_for_next(r: redis.Redis, max_wait: float) -> None:
+    """
+    Блокируется до ближайшего due-времени (но не дольше max_wait)
+    или до сигнала о новой более ранней задаче.
+    """
+    until_next = seconds_until_next(r)
+    timeout = max_wait if until_next is None else min(until_next, max_wait)
+    if timeout <= 0:
+        return
+    # BLPOP c timeout=0 ждёт бесконечно — поэтому минимум 10 мс
+    r.blpop([KEY_WAKEUP], timeout=max(timeout, 0.01))
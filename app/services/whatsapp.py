@@ -1,16 +1,93 @@
 from __future__ import annotations
 
+import asyncio
+import logging
+import time
+
 import httpx
 
+from app.core import metrics
 from app.core.config import settings
+from app.services.rate_limit import AdaptiveRate, AsyncAdaptiveRate, AsyncTokenBucketLimiter, whatsapp_buckets
+from app.services.retry import is_throttle_error
+
+logger = logging.getLogger(__name__)
+
+
+def _http2_available() -> bool:
+    # HTTP/2 в httpx требует extra-зависимость: pip install "httpx[http2]"
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.WHATSAPP_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.WHATSAPP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=60,
+    )
+
+
+def _build_payload(to_phone_e164: str, text: str) -> dict:
+    return {
+        "messaging_product": "whatsapp",
+        "to": to_phone_e164,
+        "type": "text",
+        "text": {"body": text},
+    }
+
+
+def _parse_message_id(data: dict) -> str:
+    # В ответе обычно приходит id сообщения.
+    # Верни строку id, чтобы сохранить в БД.
+    try:
+        return data["messages"][0]["id"]
+    except Exception:
+        return ""
 
 
 class WhatsAppClient:
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        rate: AdaptiveRate | None = None,
+        phone_number_id: str | None = None,
+        token: str | None = None,
+    ) -> None:
         self.base = settings.WHATSAPP_API_BASE.rstrip("/")
         self.ver = settings.WHATSAPP_API_VERSION
-        self.token = settings.WHATSAPP_TOKEN
-        self.phone_number_id = settings.WHATSAPP_PHONE_NUMBER_ID
+        # номер салона (app.services.tenants.SenderNumber); по умолчанию — глобальный из настроек
+        self.token = token or settings.WHATSAPP_TOKEN
+        self.phone_number_id = phone_number_id or settings.WHATSAPP_PHONE_NUMBER_ID
+        # AIMD (WHATSAPP_ADAPTIVE_RATE): ответы провайдера подстраивают скорость phone-bucket-а
+        self.rate = rate
+        self._http: httpx.Client | None = None
+
+    def phone_rate(self) -> float | None:
+        return self.rate.rate() if self.rate is not None else None
+
+    @property
+    def messages_url(self) -> str:
+        return f"{self.base}/{self.ver}/{self.phone_number_id}/messages"
+
+    def _headers(self) -> dict:
+        return {
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/json",
+        }
+
+    def _client(self) -> httpx.Client:
+        # один keep-alive пул на всё время жизни клиента (без TLS-handshake на каждое сообщение)
+        if self._http is None:
+            self._http = httpx.Client(timeout=20, limits=_limits())
+        return self._http
+
+    def close(self) -> None:
+        if self._http is not None:
+            self._http.close()
+            self._http = None
 
     def send_text(self, to_phone_e164: str, text: str) -> str:
         """
@@ -21,29 +98,107 @@ class WhatsAppClient:
         if not self.token or not self.phone_number_id:
             raise RuntimeError("WhatsApp credentials are not configured")
 
-        url = f"{self.base}/{self.ver}/{self.phone_number_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "messaging_product": "whatsapp",
-            "to": to_phone_e164,
-            "type": "text",
-            "text": {"body": text},
-        }
-
-        with httpx.Client(timeout=20) as client:
-            r = client.post(url, headers=headers, json=payload)
+        start = time.perf_counter()
+        try:
+            r = self._client().post(self.messages_url, headers=self._headers(), json=_build_payload(to_phone_e164, text))
+        except Exception:
+            metrics.WHATSAPP_SEND_SECONDS.labels(status="error").observe(time.perf_counter() - start)
+            raise
+        metrics.WHATSAPP_SEND_SECONDS.labels(status=str(r.status_code)).observe(time.perf_counter() - start)
+        try:
             r.raise_for_status()
-            data = r.json()
+        except httpx.HTTPStatusError as e:
+            if self.rate is not None and is_throttle_error(e):
+                self.rate.on_throttle()
+            raise
+        if self.rate is not None:
+            self.rate.on_success()
+        return _parse_message_id(r.json())
+
+
+class AsyncWhatsAppClient:
+    """
+    Асинхронный клиент с долгоживущим пулом соединений (keep-alive, опционально HTTP/2).
+    send_many() держит несколько запросов "в полёте", не выходя за бюджет rate-limiter-а.
+    """
+
+    def __init__(
+        self,
+        limiter: AsyncTokenBucketLimiter | None = None,
+        rate: AsyncAdaptiveRate | None = None,
+        phone_number_id: str | None = None,
+        token: str | None = None,
+    ) -> None:
+        self.base = settings.WHATSAPP_API_BASE.rstrip("/")
+        self.ver = settings.WHATSAPP_API_VERSION
+        self.token = token or settings.WHATSAPP_TOKEN
+        self.phone_number_id = phone_number_id or settings.WHATSAPP_PHONE_NUMBER_ID
+        self.limiter = limiter
+        self.rate = rate
+        self.concurrency = max(1, settings.WHATSAPP_SEND_CONCURRENCY)
+
+        http2 = settings.WHATSAPP_HTTP2
+        if http2 and not _http2_available():
+            logger.warning("WHATSAPP_HTTP2 is enabled but 'h2' is not installed, falling back to HTTP/1.1")
+            http2 = False
+
+        self._http = httpx.AsyncClient(
+            timeout=20,
+            limits=_limits(),
+            http2=http2,
+            headers={
+                "Authorization": f"Bearer {self.token}",
+                "Content-Type": "application/json",
+            },
+        )
+
+    @property
+    def messages_url(self) -> str:
+        return f"{self.base}/{self.ver}/{self.phone_number_id}/messages"
+
+    async def __aenter__(self) -> AsyncWhatsAppClient:
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.aclose()
 
-        # В ответе обычно приходит id сообщения.
-        # Верни строку id, чтобы сохранить в БД.
-        msg_id = ""
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+    async def send_text(self, to_phone_e164: str, text: str) -> str:
+        if not self.token or not self.phone_number_id:
+            raise RuntimeError("WhatsApp credentials are not configured")
+
+        if self.limiter is not None:
+            phone_rate = await self.rate.rate() if self.rate is not None else None
+            await self.limiter.acquire(whatsapp_buckets(self.phone_number_id, to_phone_e164, phone_rate))
+
+        start = time.perf_counter()
         try:
-            msg_id = data["messages"][0]["id"]
+            r = await self._http.post(self.messages_url, json=_build_payload(to_phone_e164, text))
         except Exception:
-            msg_id = ""
+            metrics.WHATSAPP_SEND_SECONDS.labels(status="error").observe(time.perf_counter() - start)
+            raise
+        metrics.WHATSAPP_SEND_SECONDS.labels(status=str(r.status_code)).observe(time.perf_counter() - start)
+        try:
+            r.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            if self.rate is not None and is_throttle_error(e):
+                await self.rate.on_throttle()
+            raise
+        if self.rate is not None:
+            self.rate.on_success()
+        return _parse_message_id(r.json())
+
+    async def send_many(self, messages: list[tuple[str, str]]) -> list[str | BaseException]:
+        """
+        messages = [(to_phone_e164, text), ...]
+        Возвращает список той же длины: provider message id или исключение для этого сообщения.
+        """
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def _one(to_phone: str, text: str) -> str:
+            async with sem:
+                return await self.send_text(to_phone, text)
 
-        return msg_id
+        return await asyncio.gather(*(_one(to, text) for to, text in messages), return_exceptions=True)
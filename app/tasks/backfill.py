@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import argparse
+import logging
+from collections.abc import Iterable, Iterator
+from datetime import date, datetime, timezone
+from itertools import islice
+
+import redis
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db.models import Task
+from app.db.session import SessionLocal
+from app.db.upserts import upsert_appointments, upsert_clients
+from app.services import timer_wheel
+from app.services.altegio import AltegioClient, AppointmentInfo
+from app.services.analytics import event_row, log_events
+from app.services.task_plan import default_task_specs
+from app.services.tenants import load_tenants, tenant_for
+
+logger = logging.getLogger(__name__)
+
+
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    it = iter(items)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+
+def import_chunk(
+    db: Session,
+    infos: list[AppointmentInfo],
+    company_id: int,
+    now: datetime,
+) -> tuple[dict, list[tuple[int, datetime]]]:
+    """
+    Пачка записей Altegio -> bulk upsert clients + appointments -> bulk insert задач
+    (только для новых записей и только будущих задач; подтверждение "created" при импорте не шлём).
+    Возвращает (статистика, [(task_id, planned_at)] для timer wheel).
+    """
+    client_ids = upsert_clients(db, [{"phone_e164": i.client_phone_e164, "name": i.client_name} for i in infos])
+
+    appts = upsert_appointments(
+        db,
+        [
+            {
+                "altegio_company_id": company_id,
+                "altegio_appointment_id": i.appointment_id,
+                "client_id": client_ids[i.client_phone_e164],
+                "starts_at": i.starts_at,
+                "ends_at": i.ends_at,
+                "status": i.status,
+                "staff_name": i.staff_name,
+                "service_name": i.service_name,
+                "source": i.source,
+            }
+            for i in infos
+        ],
+    )
+
+    by_altegio_id = {i.appointment_id: i for i in infos}
+    task_rows: list[dict] = []
+    new_appts = 0
+    for appt_id, _, altegio_id, inserted in appts:
+        if not inserted:
+            continue
+        new_appts += 1
+        info = by_altegio_id[altegio_id]
+        for spec in default_task_specs(info.starts_at, info.ends_at, now, include_created=False):
+            if spec.planned_at <= now:
+                continue
+            task_rows.append(spec.task_row(appt_id))
+
+    planned: list[tuple[int, datetime]] = []
+    if task_rows:
+        planned = list(db.execute(insert(Task).returning(Task.id, Task.planned_at), task_rows).tuples())
+
+    log_events(
+        db,
+        [
+            event_row(
+                "altegio.backfill.chunk",
+                meta={"appointments": len(appts), "new_appointments": new_appts, "tasks": len(planned)},
+            )
+        ],
+    )
+    return {"appointments": len(appts), "new_appointments": new_appts, "tasks": len(planned)}, planned
+
+
+def run_backfill(
+    date_from: date,
+    date_to: date,
+    chunk_size: int | None = None,
+    company_id: int | None = None,
+) -> dict:
+    """
+    Стриминговый импорт: страницы Altegio -> чанки -> по транзакции на чанк.
+    Повторный запуск безопасен: существующие записи обновляются, задачи создаются только для новых.
+    company_id — салон из companies (креды Altegio оттуда), по умолчанию ALTEGIO_COMPANY_ID.
+    """
+    chunk_size = chunk_size or settings.BACKFILL_CHUNK_SIZE
+    with SessionLocal() as db:
+        tenant = tenant_for(load_tenants(db), company_id)
+    altegio = AltegioClient(company_id=tenant.altegio_company_id, token=tenant.altegio_api_token)
+    r = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    totals = {"appointments": 0, "new_appointments": 0, "tasks": 0, "chunks": 0}
+
+    try:
+        infos = altegio.iter_appointments(date_from, date_to, page_size=settings.BACKFILL_PAGE_SIZE)
+        for chunk in chunked(infos, chunk_size):
+            now = datetime.now(timezone.utc)
+            with SessionLocal() as db:
+                stats, planned = import_chunk(db, chunk, altegio.company_id, now)
+                db.commit()
+            timer_wheel.mirror(r, planned)
+
+            for k, v in stats.items():
+                totals[k] += v
+            totals["chunks"] += 1
+            logger.info("Backfill chunk imported", extra=totals)
+    finally:
+        altegio.close()
+
+    return totals
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Import Altegio appointments for a date range")
+    parser.add_argument("--from", dest="date_from", required=True, type=date.fromisoformat)
+    parser.add_argument("--to", dest="date_to", required=True, type=date.fromisoformat)
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--company-id", type=int, default=None, help="Altegio company id (default: ALTEGIO_COMPANY_ID)")
+    args = parser.parse_args()
+
+    totals = run_backfill(args.date_from, args.date_to, args.chunk_size, args.company_id)
+    logger.info("Backfill finished", extra=totals)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=settings.LOG_LEVEL)
+    main()
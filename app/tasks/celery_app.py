@@ -1,8 +1,13 @@
 from __future__ import annotations
 
+import os
+
 from celery import Celery
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown
 
+from app.core import metrics
 from app.core.config import settings
+from app.db.session import configure_role, dispose_inherited_engines
 
 celery_app = Celery(
     "salon_whatsapp_bot",
@@ -20,10 +25,54 @@ celery_app.conf.update(
     broker_connection_retry_on_startup=True,
 )
 
+
+@worker_process_init.connect
+def _init_worker_db(**_) -> None:
+    # каждый prefork-ребёнок — свой маленький пул (DB_POOL_SIZES worker=...), открывается лениво
+    configure_role("worker")
+    dispose_inherited_engines()
+
+
+@worker_init.connect
+def _start_metrics_server(**_) -> None:
+    # prefork-дети пишут метрики в PROMETHEUS_MULTIPROC_DIR, родитель отдаёт агрегат;
+    # без него /metrics видит только сам родительский процесс (годится для -P solo / threads)
+    metrics.start_metrics_server(settings.CELERY_METRICS_PORT)
+
+
+@worker_process_shutdown.connect
+def _mark_metrics_dead(**_) -> None:
+    metrics.mark_process_dead(os.getpid())
+
+
 # periodic schedule
+# С SCHEDULER_ZSET_ENABLED основную работу делает dispatcher (app.tasks.dispatcher),
+# а поллинг остаётся страховкой — его интервал можно увеличить.
 celery_app.conf.beat_schedule = {
-    "enqueue-due-tasks-every-60s": {
+    "enqueue-due-tasks": {
         "task": "app.tasks.jobs.enqueue_due_tasks",
+        "schedule": float(settings.ENQUEUE_POLL_SECONDS),
+    },
+    # страховка: статусы, для которых debounce-задача не запланировалась
+    "apply-whatsapp-statuses": {
+        "task": "app.tasks.jobs.apply_whatsapp_statuses",
+        "schedule": 60.0,
+    },
+    # то же для webhook-событий Altegio (ALTEGIO_EVENTS_BATCHING); пустая очередь — один LPOP
+    "drain-altegio-events": {
+        "task": "app.tasks.jobs.drain_altegio_events",
         "schedule": 60.0,
     },
+    "sweep-coalesced-events": {
+        "task": "app.tasks.jobs.sweep_coalesced_events",
+        "schedule": 60.0,
+    },
+    "refresh-funnel-stats": {
+        "task": "app.tasks.jobs.refresh_funnel_stats",
+        "schedule": float(settings.FUNNEL_REFRESH_SECONDS),
+    },
+    "maintain-event-log-daily": {
+        "task": "app.tasks.jobs.maintain_event_log",
+        "schedule": 24 * 3600.0,
+    },
 }
@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timezone
+
+from app.core.config import settings
+from app.db.session import SessionLocal, configure_role
+from app.services import timer_wheel
+from app.tasks.jobs import enqueue_due_batch, get_redis
+
+logger = logging.getLogger(__name__)
+
+# потолок сна: периодически перепроверяем ZSET, даже если будильник не сработал
+MAX_IDLE_SECONDS = 30
+
+
+def main() -> None:
+    """
+    Dispatcher для SCHEDULER_ZSET_ENABLED: спит до ближайшего planned_at из Redis ZSET,
+    атомарно забирает due id и сразу материализует их в outbox.
+    Beat-поллинг enqueue_due_tasks остаётся страховкой (ENQUEUE_POLL_SECONDS можно увеличить).
+    """
+    configure_role("dispatcher")
+    r = get_redis()
+    batch_size = settings.ENQUEUE_BATCH_SIZE
+
+    logger.info("Timer wheel dispatcher started")
+
+    while True:
+        ids = timer_wheel.pop_due(r, batch_size)
+        if not ids:
+            timer_wheel.wait_for_next(r, MAX_IDLE_SECONDS)
+            continue
+
+        with SessionLocal() as db:
+            selected, enqueued, deferred = enqueue_due_batch(db, datetime.now(timezone.utc), len(ids), task_ids=ids)
+            db.commit()
+        # отложенные лимитом получателя задачи уже вынуты из ZSET — возвращаем их с новым planned_at
+        timer_wheel.mirror(r, deferred)
+
+        logger.info("Dispatched due tasks", extra={"popped": len(ids), "selected": selected, "enqueued": enqueued})
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=settings.LOG_LEVEL)
+    main()
@@ -1,28 +1,61 @@
 from __future__ import annotations
 
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 
 import logging
+import time
+
+import redis
 from celery.utils.log import get_task_logger
 from sqlalchemy import select
-from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session, selectinload
 
+from app.core import metrics
 from app.core.config import settings
-from app.db.models import Appointment, Client, OutboxMessage, Task, TaskStatus
+from app.db.models import Appointment, Client, Lane, OutboxMessage, Task, TaskStatus
+from app.db.partitions import drop_expired_event_log_partitions, ensure_event_log_partitions
 from app.db.session import SessionLocal
-from app.services.analytics import log_event
+from app.db.upserts import upsert_appointments, upsert_clients
+from app.services import batch_queue, coalesce, timer_wheel
+from app.services.capping import SendGuard
+from app.services.analytics import event_row, log_events
+from app.services.delivery_status import KEY_STATUS_QUEUE, apply_status_batch, unmatched_for_retry
+from app.services.funnel import refresh_funnel_stats as _refresh_funnel_stats
+from app.services.task_plan import default_task_specs
+from app.services.task_sync import AppointmentPlan, TaskDiff, sync_appointment_tasks
 from app.services.templating import render_template
+from app.services.tenants import load_tenants, tenant_for
 from app.tasks import celery_app
+from app.tasks.backfill import run_backfill
 
 
 logger = get_task_logger(__name__)
 py_logger = logging.getLogger(__name__)
 
 
+_redis: redis.Redis | None = None
+
+# Очередь webhook-событий Altegio при ALTEGIO_EVENTS_BATCHING (см. app.services.batch_queue)
+KEY_ALTEGIO_EVENTS = "altegio:events"
+# напоминания одного типа для нескольких записей клиента склеиваются в одно сообщение
+MERGEABLE_TASK_TYPES = ("reminder_24h", "reminder_2h")
+# типы webhook-событий, после которых напоминания по записи не нужны
+ALTEGIO_CANCEL_EVENTS = ("canceled", "cancelled", "deleted")
+
+
 def _now() -> datetime:
     return datetime.now(timezone.utc)
 
 
+def get_redis() -> redis.Redis:
+    # лениво: Celery prefork создаёт дочерние процессы после импорта модуля
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _redis
+
+
 def _parse_dt(value) -> datetime | None:
     try:
         if not value:
@@ -35,123 +68,10 @@ def _parse_dt(value) -> datetime | None:
         return None
 
 
-def upsert_client(db: Session, phone: str, name: str | None) -> Client:
-    c = db.execute(select(Client).where(Client.phone_e164 == phone)).scalar_one_or_none()
-    if c:
-        if name and c.name != name:
-            c.name = name
-        return c
-    c = Client(phone_e164=phone, name=name, locale="ru")
-    db.add(c)
-    db.flush()
-    return c
-
-
-def upsert_appointment(
-    db: Session,
-    company_id: int,
-    appt_id: int,
-    client: Client,
-    starts_at: datetime,
-    ends_at: datetime,
-    status: str,
-    staff_name: str | None,
-    service_name: str | None,
-    source: str | None,
-) -> Appointment:
-    a = db.execute(
-        select(Appointment).where(
-            Appointment.alteg.io_company_id == company_id,  # type: ignore[attr-defined]
-            Appointment.alteg.io_appointment_id == appt_id,  # type: ignore[attr-defined]
-        )
-    ).scalar_one_or_none()
-
-    if a:
-        a.client_id = client.id
-        a.starts_at = starts_at
-        a.ends_at = ends_at
-        a.status = status
-        a.staff_name = staff_name
-        a.service_name = service_name
-        a.source = source
-        return a
-
-    a = Appointment(
-        altegio_company_id=company_id,
-        altegio_appointment_id=appt_id,
-        client_id=client.id,
-        starts_at=starts_at,
-        ends_at=ends_at,
-        status=status,
-        staff_name=staff_name,
-        service_name=service_name,
-        source=source,
-    )
-    db.add(a)
-    db.flush()
-    return a
-
-
-def schedule_default_tasks(db: Session, appt: Appointment, client: Client) -> None:
-    """
-    MVP-логика:
-    - created: подтверждение сразу
-    - reminders: за 24ч и за 2ч
-    - review: через 2ч после визита
-    - rebook: через 21 день после визита
-    """
-    # created now
-    db.add(
-        Task(
-            appointment_id=appt.id,
-            type="send_created",
-            planned_at=_now(),
-            status=TaskStatus.scheduled,
-            payload_json={"template_key": "APPT_CREATED"},
-        )
-    )
-
-    # reminders
-    db.add(
-        Task(
-            appointment_id=appt.id,
-            type="reminder_24h",
-            planned_at=appt.starts_at - timedelta(hours=24),
-            status=TaskStatus.scheduled,
-            payload_json={"template_key": "REMINDER_24H"},
-        )
-    )
-    db.add(
-        Task(
-            appointment_id=appt.id,
-            type="reminder_2h",
-            planned_at=appt.starts_at - timedelta(hours=2),
-            status=TaskStatus.scheduled,
-            payload_json={"template_key": "REMINDER_2H"},
-        )
-    )
-
-    # review request
-    db.add(
-        Task(
-            appointment_id=appt.id,
-            type="review_request",
-            planned_at=appt.ends_at + timedelta(hours=2),
-            status=TaskStatus.scheduled,
-            payload_json={"template_key": "REVIEW_REQUEST"},
-        )
-    )
-
-    # rebook invite
-    db.add(
-        Task(
-            appointment_id=appt.id,
-            type="rebook_invite",
-            planned_at=appt.ends_at + timedelta(days=21),
-            status=TaskStatus.scheduled,
-            payload_json={"template_key": "REBOOK_INVITE"},
-        )
-    )
+def schedule_default_tasks(db: Session, appointment_id: int, starts_at: datetime, ends_at: datetime) -> list[Task]:
+    tasks = [Task(**spec.task_row(appointment_id)) for spec in default_task_specs(starts_at, ends_at, _now())]
+    db.add_all(tasks)
+    return tasks
 
 
 def build_context(appt: Appointment, client: Client) -> dict:
@@ -164,10 +84,10 @@ def build_context(appt: Appointment, client: Client) -> dict:
     }
 
 
-@celery_app.task(name="app.tasks.jobs.process_altegio_event")
-def process_altegio_event(event: dict) -> dict:
+def parse_altegio_event(event: dict) -> dict:
     """
     event = {"event_key": "...", "received_at": "...", "payload": {...}}
+    Возвращает разобранное событие; при отсутствии обязательных полей — {"ignored": "<причина>"}.
     Подстроишь payload-парсинг под реальные поля Altegio webhook.
     """
     payload = event.get("payload") or {}
@@ -177,121 +97,584 @@ def process_altegio_event(event: dict) -> dict:
     appt_id = int(payload.get("appointment_id", 0)) if payload.get("appointment_id") else 0
     if not appt_id:
         logger.warning("No appointment_id in payload", extra={"event_key": event_key})
-        return {"status": "ignored_no_appointment_id", "event_key": event_key}
+        return {"ignored": "ignored_no_appointment_id", "event_key": event_key}
 
     phone = str(payload.get("client_phone", "")).strip()
     if not phone:
-        return {"status": "ignored_no_phone", "event_key": event_key}
+        return {"ignored": "ignored_no_phone", "event_key": event_key}
 
-    name = payload.get("client_name")
     starts_at = _parse_dt(payload.get("starts_at")) or _now()
-    ends_at = _parse_dt(payload.get("ends_at")) or (starts_at + timedelta(hours=1))
-    staff_name = payload.get("staff_name")
-    service_name = payload.get("service_name")
-    source = payload.get("source")
-    status_str = str(payload.get("status", event_type))
+    # салон: из URL webhook-а (/webhook/altegio/{company_id}), из тела, иначе ALTEGIO_COMPANY_ID
+    company_id = event.get("company_id") or payload.get("company_id") or settings.ALTEGIO_COMPANY_ID
+    return {
+        "event_key": event_key,
+        "type": event_type,
+        "company_id": int(company_id),
+        "altegio_appointment_id": appt_id,
+        "phone": phone,
+        "name": payload.get("client_name"),
+        "starts_at": starts_at,
+        "ends_at": _parse_dt(payload.get("ends_at")) or (starts_at + timedelta(hours=1)),
+        "status": str(payload.get("status", event_type)),
+        "staff_name": payload.get("staff_name"),
+        "service_name": payload.get("service_name"),
+        "source": payload.get("source"),
+    }
 
-    with SessionLocal() as db:
-        client = upsert_client(db, phone, name)
-        appt = upsert_appointment(
-            db=db,
-            company_id=settings.ALTEGIO_COMPANY_ID,
-            appt_id=appt_id,
-            client=client,
-            starts_at=starts_at,
-            ends_at=ends_at,
-            status=status_str,
-            staff_name=staff_name,
-            service_name=service_name,
-            source=source,
-        )
 
-        log_event(
-            db,
-            event_name=f"altegio.webhook.{event_type}",
-            appointment_id=appt.id,
-            client_id=client.id,
-            meta={"event_key": event_key},
+def apply_altegio_events(db: Session, events: list[dict]) -> tuple[list[dict], TaskDiff]:
+    """
+    Пачка webhook-событий за фиксированное число statement-ов:
+    один INSERT ... ON CONFLICT для клиентов, один для записей, bulk INSERT задач и событий.
+    На updated / canceled задачи записи синхронизируются с новым временем (app.services.task_sync).
+    Порядок событий важен: для одной записи побеждает последнее.
+    Возвращает (результат по каждому событию, изменения задач — для timer wheel после commit).
+    """
+    results: list[dict] = []
+    parsed: list[dict] = []
+    for event in events:
+        p = parse_altegio_event(event)
+        if "ignored" in p:
+            results.append({"status": p["ignored"], "event_key": p["event_key"]})
+        else:
+            parsed.append(p)
+            results.append({"status": "ok", "event_key": p["event_key"]})
+    if not parsed:
+        return results, TaskDiff()
+
+    client_ids = upsert_clients(db, [{"phone_e164": p["phone"], "name": p["name"]} for p in parsed])
+    appts = upsert_appointments(
+        db,
+        [
+            {
+                "altegio_company_id": p["company_id"],
+                "altegio_appointment_id": p["altegio_appointment_id"],
+                "client_id": client_ids[p["phone"]],
+                "starts_at": p["starts_at"],
+                "ends_at": p["ends_at"],
+                "status": p["status"],
+                "staff_name": p["staff_name"],
+                "service_name": p["service_name"],
+                "source": p["source"],
+            }
+            for p in parsed
+        ],
+    )
+    appt_ids = {(company_id, altegio_id): appt_id for appt_id, company_id, altegio_id, _ in appts}
+
+    rows: list[dict] = []
+    last: dict[int, dict] = {}
+    created: set[int] = set()
+    for p in parsed:
+        appt_id = appt_ids[(p["company_id"], p["altegio_appointment_id"])]
+        rows.append(
+            event_row(
+                f"altegio.webhook.{p['type']}",
+                appointment_id=appt_id,
+                client_id=client_ids[p["phone"]],
+                meta={"event_key": p["event_key"]},
+            )
         )
+        last[appt_id] = p
+        if p["type"] == "created":
+            created.add(appt_id)
+
+    diff = TaskDiff()
+    plans: list[AppointmentPlan] = []
+    scheduled: list[Task] = []
+    for appt_id, p in last.items():
+        client_id = client_ids[p["phone"]]
+        canceled = p["type"] in ALTEGIO_CANCEL_EVENTS
+        if appt_id in created and not canceled:
+            # MVP: на created — планируем всё (по одному набору на запись, даже если created пришёл дважды)
+            scheduled += schedule_default_tasks(db, appt_id, p["starts_at"], p["ends_at"])
+            rows.append(event_row("task.scheduled.default_set", appointment_id=appt_id, client_id=client_id))
+        elif canceled or p["type"] == "updated":
+            plans.append(AppointmentPlan(appt_id, client_id, p["starts_at"], p["ends_at"], canceled=canceled))
+
+    if scheduled:
+        # id нужны для зеркалирования в timer wheel
+        db.flush()
+        diff.planned += [(t.id, t.planned_at) for t in scheduled]
+    if plans:
+        synced = sync_appointment_tasks(db, plans, _now())
+        diff.planned += synced.planned
+        diff.canceled += synced.canceled
+        diff.outbox_deleted += synced.outbox_deleted
+        rows += synced.events
+
+    log_events(db, rows)
+    return results, diff
+
+
+def _mirror_diff(diff: TaskDiff) -> None:
+    # после commit: иначе dispatcher может увидеть id ещё не закоммиченной задачи
+    r = get_redis()
+    timer_wheel.mirror(r, diff.planned)
+    timer_wheel.unmirror(r, diff.canceled)
 
-        # MVP: на created — планируем всё
-        if event_type == "created":
-            schedule_default_tasks(db, appt, client)
-            log_event(db, "task.scheduled.default_set", appointment_id=appt.id, client_id=client.id)
 
-        # На canceled/updated можно добавить отдельные task-ы позже
+@celery_app.task(name="app.tasks.jobs.process_altegio_event")
+def process_altegio_event(event: dict) -> dict:
+    with SessionLocal() as db:
+        results, diff = apply_altegio_events(db, [event])
         db.commit()
 
-    return {"status": "ok", "event_key": event_key}
+    _mirror_diff(diff)
+    return results[0]
 
 
-@celery_app.task(name="app.tasks.jobs.enqueue_due_tasks")
-def enqueue_due_tasks() -> dict:
+def apply_events_in_order(events: list[dict]) -> list[dict]:
     """
-    Каждую минуту:
-    - берём tasks со статусом scheduled и planned_at <= now
-    - рендерим текст через шаблон
-    - кладём в outbox
+    Пачка событий в одной транзакции. Если пачка падает целиком (кривой payload и т.п.),
+    откатываемся и применяем события по одному — одно плохое событие не теряет предыдущие.
+    На первом упавшем событии останавливаемся: более новые события той же записи не должны
+    примениться раньше него. Возвращает неприменённый хвост (упавшее событие и всё после него).
     """
-    now = _now()
-    made = 0
+    if not events:
+        return []
 
-    with SessionLocal() as db:
-        due = db.execute(
-            select(Task)
-            .where(Task.status == TaskStatus.scheduled, Task.planned_at <= now)
-            .order_by(Task.planned_at.asc())
-            .limit(200)
-        ).scalars().all()
-
-        for task in due:
-            appt = task.appointment
-            client = appt.client
-            template_key = task.payload_json.get("template_key")
-            if not template_key:
-                task.status = TaskStatus.failed
-                task.last_error = "No template_key in payload_json"
-                log_event(db, "task.failed", appointment_id=appt.id, client_id=client.id, task_id=task.id)
-                continue
-
-            try:
-                context = build_context(appt, client)
-                rendered, version = render_template(db, template_key, client.locale, context)
-
-                outbox = OutboxMessage(
-                    task_id=task.id,
-                    to_phone=client.phone_e164,
-                    template_key=template_key,
-                    template_version=version,
-                    rendered_text=rendered,
-                )
-                db.add(outbox)
-                db.flush()
+    try:
+        with SessionLocal() as db:
+            _, diff = apply_altegio_events(db, events)
+            db.commit()
+        _mirror_diff(diff)
+        return []
+    except Exception as e:
+        py_logger.warning("Altegio batch failed, applying events one by one", extra={"events": len(events), "error": str(e)})
+
+    for i, event in enumerate(events):
+        try:
+            with SessionLocal() as db:
+                _, diff = apply_altegio_events(db, [event])
+                db.commit()
+            _mirror_diff(diff)
+        except Exception as e:
+            py_logger.exception("Altegio event failed", extra={"event_key": event.get("event_key"), "error": str(e)})
+            return events[i:]
+    return []
+
+
+def retry_events(unapplied: list[dict]) -> list[dict]:
+    # попытка засчитывается только упавшему (первому) событию; после ALTEGIO_EVENTS_MAX_ATTEMPTS оно отбрасывается
+    if not unapplied:
+        return []
+    head, *rest = unapplied
+    attempts = int(head.get("attempts") or 0) + 1
+    if attempts >= settings.ALTEGIO_EVENTS_MAX_ATTEMPTS:
+        py_logger.error("Altegio event dropped after retries", extra={"event_key": head.get("event_key"), "attempts": attempts})
+        return rest
+    return [{**head, "attempts": attempts}, *rest]
+
+
+@celery_app.task(name="app.tasks.jobs.process_altegio_events_batch")
+def process_altegio_events_batch(events: list[dict]) -> dict:
+    unapplied = apply_events_in_order(events)
+    return {"events": len(events), "failed": len(unapplied)}
+
+
+@celery_app.task(name="app.tasks.jobs.drain_altegio_events")
+def drain_altegio_events() -> dict:
+    """
+    ALTEGIO_EVENTS_BATCHING: webhook копит события в Redis, здесь они применяются
+    пачками по ALTEGIO_EVENTS_BATCH_SIZE (одна транзакция на пачку).
+    Пачка снимается из Redis только после commit; неприменённый хвост откладывается до следующего запуска.
+    """
+    r = get_redis()
+    batch_queue.reset_debounce(r, KEY_ALTEGIO_EVENTS)
+    batch_queue.requeue_stale(r, KEY_ALTEGIO_EVENTS)
+    batch_queue.promote_retries(r, KEY_ALTEGIO_EVENTS)
+
+    popped = 0
+    deferred = 0
+    while True:
+        batch_id, batch = batch_queue.claim(r, KEY_ALTEGIO_EVENTS, settings.ALTEGIO_EVENTS_BATCH_SIZE)
+        if not batch:
+            break
+        retry = retry_events(apply_events_in_order(batch))
+        batch_queue.ack(r, KEY_ALTEGIO_EVENTS, batch_id, retry=retry)
+        popped += len(batch)
+        deferred += len(retry)
+        if retry:
+            # остальное — на следующем запуске, после отложенного хвоста
+            break
+
+    return {"popped": popped, "deferred": deferred}
+
+
+def schedule_appointment_events(appointment_key: str, countdown: float) -> None:
+    process_appointment_events.apply_async(
+        (appointment_key,),
+        countdown=countdown,
+        queue=coalesce.shard_queue(appointment_key),
+    )
 
-                task.status = TaskStatus.queued
-                log_event(
-                    db,
-                    "message.queued",
+
+@celery_app.task(name="app.tasks.jobs.process_appointment_events")
+def process_appointment_events(appointment_key: str) -> dict:
+    """
+    ALTEGIO_COALESCE_SECONDS: все накопленные за окно события одной записи — одной пачкой
+    (в БД пишется только последнее состояние). Lock записи сохраняет порядок, даже если
+    две задачи одной записи попали на разные воркеры.
+    appointment_key — "<company_id>:<appointment_id>" (coalesce.appointment_key).
+    """
+    r = get_redis()
+    lock = r.lock(coalesce.lock_name(appointment_key), timeout=120)
+    if not lock.acquire(blocking=False):
+        # предыдущее окно ещё применяется — события дождутся его в списке
+        schedule_appointment_events(appointment_key, countdown=1)
+        return {"status": "busy", "appointment_key": appointment_key}
+
+    try:
+        # список подрезается только после commit: сбой посреди окна не теряет события
+        events = coalesce.peek_all(r, appointment_key)
+        if not events:
+            return {"status": "empty", "appointment_key": appointment_key}
+        retry = retry_events(apply_events_in_order(events))
+        coalesce.ack(r, appointment_key, len(events) - len(retry), retry[0] if retry else None)
+        if retry:
+            schedule_appointment_events(appointment_key, countdown=settings.ALTEGIO_COALESCE_SECONDS)
+        res = {"events": len(events), "deferred": len(retry)}
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            py_logger.warning("Appointment lock expired before release", extra={"appointment_key": appointment_key})
+
+    return {"status": "ok", "appointment_key": appointment_key, **res}
+
+
+@celery_app.task(name="app.tasks.jobs.sweep_coalesced_events")
+def sweep_coalesced_events() -> dict:
+    # окна, чья задача потерялась: пересоздаём обработку (лишний запуск безвреден — список уже пуст)
+    stale = coalesce.stale_appointments(get_redis(), settings.ALTEGIO_COALESCE_SECONDS * 3 + 60)
+    for appointment_key in stale:
+        schedule_appointment_events(appointment_key, countdown=0)
+    return {"rescheduled": len(stale)}
+
+
+def _merge_siblings(db: Session, due: list[Task], now: datetime) -> dict[int, list[Task]]:
+    """
+    Правило склейки: у клиента несколько записей — напоминания одного типа, которые наступят
+    в ближайшие ENQUEUE_MERGE_WINDOW_SECONDS, уходят одним сообщением вместе с due-задачей.
+    Возвращает {id due-задачи: [задачи, приклеиваемые к ней]}; один дополнительный запрос на пачку.
+    """
+    window = settings.ENQUEUE_MERGE_WINDOW_SECONDS
+    mergeable = [t for t in due if t.type in MERGEABLE_TASK_TYPES]
+    if window <= 0 or not mergeable:
+        return {}
+
+    siblings = db.execute(
+        select(Task)
+        .options(selectinload(Task.appointment).selectinload(Appointment.client))
+        .join(Task.appointment)
+        .where(
+            Task.status == TaskStatus.scheduled,
+            Task.type.in_({t.type for t in mergeable}),
+            Appointment.client_id.in_({t.appointment.client_id for t in mergeable}),
+            Task.planned_at <= now + timedelta(seconds=window),
+            Task.id.not_in([t.id for t in due]),
+        )
+        .order_by(Task.planned_at.asc())
+        .with_for_update(skip_locked=True, of=Task)
+    ).scalars().all()
+
+    primary: dict[tuple[int, str], Task] = {}
+    for t in mergeable:
+        primary.setdefault((t.appointment.client_id, t.type), t)
+    merged: dict[int, list[Task]] = {}
+    for s in siblings:
+        p = primary.get((s.appointment.client_id, s.type))
+        if p is not None:
+            merged.setdefault(p.id, []).append(s)
+    # несколько due-задач одного клиента и типа в самой пачке тоже склеиваются
+    for t in mergeable:
+        p = primary[(t.appointment.client_id, t.type)]
+        if p is not t:
+            merged.setdefault(p.id, []).append(t)
+    return merged
+
+
+def enqueue_due_batch(
+    db: Session,
+    now: datetime,
+    limit: int,
+    task_ids: list[int] | None = None,
+) -> tuple[int, int, list[tuple[int, datetime]]]:
+    """
+    Одна пачка due-задач: один SELECT ... FOR UPDATE SKIP LOCKED с eager-load appointment+client
+    (параллельные воркеры берут непересекающиеся пачки),
+    рендер из кэша шаблонов, bulk INSERT ... RETURNING в outbox и bulk INSERT событий.
+    Сообщение получает phone_number_id салона записи — sender шлёт его со своей полосы.
+    Перед постановкой: склейка напоминаний одного клиента (_merge_siblings),
+    частотный лимит на получателя (задача откладывается до конца окна),
+    идемпотентность — INSERT ... ON CONFLICT (task_id, template_key) DO NOTHING.
+    task_ids — только эти задачи (dispatcher timer wheel), иначе — все due.
+    Возвращает (сколько задач выбрано, сколько сообщений поставлено в outbox,
+    [(task_id, planned_at)] отложенных лимитом — зеркалить в timer wheel после commit).
+    """
+    stmt = (
+        select(Task)
+        .options(selectinload(Task.appointment).selectinload(Appointment.client))
+        .where(Task.status == TaskStatus.scheduled, Task.planned_at <= now)
+        .order_by(Task.planned_at.asc())
+        .limit(limit)
+        .with_for_update(skip_locked=True, of=Task)
+    )
+    if task_ids is not None:
+        stmt = stmt.where(Task.id.in_(task_ids))
+    due = db.execute(stmt).scalars().all()
+    picked_at = _now()
+    for task in due:
+        metrics.TASK_DUE_LAG_SECONDS.observe(max(0.0, (picked_at - task.planned_at).total_seconds()))
+
+    merged = _merge_siblings(db, due, now)
+    absorbed = {t.id for group in merged.values() for t in group}
+    capped = SendGuard(get_redis()).cap_wait_many(
+        {t.appointment.client.phone_e164 for t in due if t.priority != Lane.urgent}
+    )
+    tenants = load_tenants(db)
+
+    outbox_rows: list[dict] = []
+    queued: dict[int, tuple[Task, str, int]] = {}
+    events: list[dict] = []
+    deferred: list[tuple[int, datetime]] = []
+    enqueued = 0
+
+    for task in due:
+        if task.id in absorbed:
+            continue
+        appt = task.appointment
+        client = appt.client
+        if task.deadline_at is not None and task.deadline_at <= now:
+            # воркеры лежали / очередь стояла: напоминание после начала визита уже бесполезно
+            task.status = TaskStatus.canceled
+            task.last_error = "Deadline passed before enqueue"
+            events.append(event_row("task.expired", appointment_id=appt.id, client_id=client.id, task_id=task.id))
+            continue
+
+        wait = capped.get(client.phone_e164, 0) if task.priority != Lane.urgent else 0
+        if wait > 0:
+            # лимит получателя исчерпан: задача ждёт конца окна (приклеенные остаются как были)
+            task.planned_at = now + timedelta(seconds=wait)
+            deferred.append((task.id, task.planned_at))
+            merged.pop(task.id, None)
+            events.append(
+                event_row(
+                    "task.capped",
                     appointment_id=appt.id,
                     client_id=client.id,
                     task_id=task.id,
-                    outbox_id=outbox.id,
-                    template_key=template_key,
-                    template_version=version,
+                    meta={"deferred_seconds": round(wait)},
                 )
-                made += 1
-            except Exception as e:
-                task.status = TaskStatus.failed
-                task.last_error = str(e)
-                log_event(
-                    db,
+            )
+            continue
+
+        template_key = task.payload_json.get("template_key")
+        if not template_key:
+            task.status = TaskStatus.failed
+            task.last_error = "No template_key in payload_json"
+            events.append(event_row("task.failed", appointment_id=appt.id, client_id=client.id, task_id=task.id))
+            continue
+
+        group = sorted([task, *merged.get(task.id, [])], key=lambda t: t.appointment.starts_at)
+        try:
+            texts = []
+            for t in group:
+                text, version = render_template(db, template_key, client.locale, build_context(t.appointment, client))
+                texts.append(text)
+            rendered = "\n\n".join(texts)
+        except Exception as e:
+            task.status = TaskStatus.failed
+            task.last_error = str(e)
+            merged.pop(task.id, None)
+            events.append(
+                event_row(
                     "task.failed",
                     appointment_id=appt.id,
                     client_id=client.id,
                     task_id=task.id,
                     meta={"error": str(e), "template_key": template_key},
                 )
+            )
+            continue
+
+        outbox_rows.append(
+            {
+                "task_id": task.id,
+                "to_phone": client.phone_e164,
+                # полоса sender-а: номер WhatsApp салона
+                "phone_number_id": tenant_for(tenants, appt.altegio_company_id).phone_number_id,
+                "template_key": template_key,
+                "template_version": version,
+                "rendered_text": rendered,
+                "priority": task.priority,
+                "deadline_at": task.deadline_at,
+            }
+        )
+        queued[task.id] = (task, template_key, version)
+
+    if outbox_rows:
+        inserted = db.execute(
+            pg_insert(OutboxMessage)
+            .on_conflict_do_nothing(index_elements=[OutboxMessage.task_id, OutboxMessage.template_key])
+            .returning(OutboxMessage.id, OutboxMessage.task_id),
+            outbox_rows,
+        ).all()
+        enqueued = len(inserted)
+        for outbox_id, task_id in inserted:
+            task, template_key, version = queued[task_id]
+            task.status = TaskStatus.queued
+            events.append(
+                event_row(
+                    "message.queued",
+                    appointment_id=task.appointment_id,
+                    client_id=task.appointment.client_id,
+                    task_id=task.id,
+                    outbox_id=outbox_id,
+                    template_key=template_key,
+                    template_version=version,
+                )
+            )
+            for sibling in merged.get(task_id, []):
+                sibling.status = TaskStatus.canceled
+                sibling.last_error = f"Merged into task {task_id}"
+                events.append(
+                    event_row(
+                        "task.merged",
+                        appointment_id=sibling.appointment_id,
+                        client_id=sibling.appointment.client_id,
+                        task_id=sibling.id,
+                        outbox_id=outbox_id,
+                        meta={"into_task_id": task_id},
+                    )
+                )
+        # конфликт: сообщение для этой задачи уже есть (повторно доставленная задача) — второго не будет
+        for task_id in queued.keys() - {task_id for _, task_id in inserted}:
+            queued[task_id][0].status = TaskStatus.queued
+            events.append(event_row("message.duplicate_skipped", task_id=task_id))
 
+    log_events(db, events)
+    return len(due), enqueued, deferred
+
+
+@celery_app.task(name="app.tasks.jobs.drain_due_tasks")
+def drain_due_tasks(slot: int = 0) -> dict:
+    """
+    Пачками по ENQUEUE_BATCH_SIZE, пока due-задачи не кончатся
+    (или не выйдет ENQUEUE_MAX_SECONDS — остаток заберёт следующий запуск).
+    Redis-lock на слот: если предыдущий drain этого слота ещё работает, новый сразу выходит.
+    """
+    lock = get_redis().lock(f"lock:drain_due_tasks:{slot}", timeout=settings.ENQUEUE_MAX_SECONDS + 60)
+    if not lock.acquire(blocking=False):
+        return {"status": "skipped_overlap", "slot": slot}
+
+    now = _now()
+    batch_size = settings.ENQUEUE_BATCH_SIZE
+    deadline = time.monotonic() + settings.ENQUEUE_MAX_SECONDS
+    made = 0
+    batches = 0
+
+    try:
+        while True:
+            with SessionLocal() as db:
+                selected, enqueued, deferred = enqueue_due_batch(db, now, batch_size)
+                db.commit()
+            timer_wheel.mirror(get_redis(), deferred)
+            made += enqueued
+            batches += 1
+            if selected < batch_size or time.monotonic() >= deadline:
+                break
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            py_logger.warning("drain_due_tasks lock expired before release", extra={"slot": slot})
+
+    return {"status": "ok", "slot": slot, "enqueued": made, "batches": batches}
+
+
+@celery_app.task(name="app.tasks.jobs.enqueue_due_tasks")
+def enqueue_due_tasks() -> dict:
+    """
+    Каждую минуту:
+    - берём tasks со статусом scheduled и planned_at <= now
+    - рендерим текст через шаблон
+    - кладём в outbox
+    При ENQUEUE_PARALLELISM > 1 раздаём работу на N drain-задач (разные Celery-воркеры),
+    строки между ними делятся через SKIP LOCKED.
+    """
+    parallelism = max(1, settings.ENQUEUE_PARALLELISM)
+    if parallelism == 1:
+        return drain_due_tasks(0)
+
+    for slot in range(parallelism):
+        drain_due_tasks.delay(slot)
+    return {"status": "dispatched", "slots": parallelism}
+
+
+@celery_app.task(name="app.tasks.jobs.maintain_event_log")
+def maintain_event_log() -> dict:
+    """
+    Раз в сутки: партиции event_log на EVENT_LOG_PARTITIONS_AHEAD месяцев вперёд
+    и удаление партиций старше EVENT_LOG_RETENTION_MONTHS (агрегаты остаются).
+    """
+    with SessionLocal() as db:
+        created = ensure_event_log_partitions(db, settings.EVENT_LOG_PARTITIONS_AHEAD)
+        dropped = drop_expired_event_log_partitions(db, settings.EVENT_LOG_RETENTION_MONTHS)
+        db.commit()
+
+    if created or dropped:
+        py_logger.info("event_log partitions maintained", extra={"created": created, "dropped": dropped})
+    return {"created": created, "dropped": dropped}
+
+
+@celery_app.task(name="app.tasks.jobs.refresh_funnel_stats")
+def refresh_funnel_stats() -> dict:
+    # инкрементально: только события после watermark
+    with SessionLocal() as db:
+        res = _refresh_funnel_stats(db)
         db.commit()
+    return res
 
-    return {"enqueued": made}
+
+@celery_app.task(name="app.tasks.jobs.apply_whatsapp_statuses")
+def apply_whatsapp_statuses() -> dict:
+    """
+    Забирает накопленные статусы доставки пачками по WHATSAPP_STATUS_BATCH_SIZE:
+    один UPDATE ... FROM (VALUES ...) на пачку. Пачка снимается из Redis только после commit;
+    статусы, обогнавшие commit sender-а, откладываются до следующего запуска.
+    """
+    r = get_redis()
+    batch_queue.reset_debounce(r, KEY_STATUS_QUEUE)
+    batch_queue.requeue_stale(r, KEY_STATUS_QUEUE)
+    batch_queue.promote_retries(r, KEY_STATUS_QUEUE)
+
+    popped = 0
+    applied = 0
+    deferred = 0
+    while True:
+        batch_id, batch = batch_queue.claim(r, KEY_STATUS_QUEUE, settings.WHATSAPP_STATUS_BATCH_SIZE)
+        if not batch:
+            break
+        try:
+            with SessionLocal() as db:
+                applied += apply_status_batch(db, batch)
+                retry = unmatched_for_retry(db, batch)
+                db.commit()
+        except Exception:
+            batch_queue.requeue(r, KEY_STATUS_QUEUE, [batch_id])
+            raise
+        batch_queue.ack(r, KEY_STATUS_QUEUE, batch_id, retry=retry)
+        popped += len(batch)
+        deferred += len(retry)
+
+    return {"popped": popped, "applied": applied, "deferred": deferred}
+
+
+@celery_app.task(name="app.tasks.jobs.backfill_appointments")
+def backfill_appointments(date_from: str, date_to: str, company_id: int | None = None) -> dict:
+    """
+    date_from / date_to — ISO-даты (YYYY-MM-DD). То же самое из CLI: python -m app.tasks.backfill
+    """
+    return run_backfill(date.fromisoformat(date_from), date.fromisoformat(date_to), company_id=company_id)
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import socket
+import time
+import zlib
+from collections import defaultdict
+
+import redis.asyncio as aioredis
+
+from app.core.config import settings
+from app.db.session import AsyncSessionLocal, configure_role
+from app.services import coalesce, event_stream, timer_wheel
+from app.tasks.jobs import apply_altegio_events
+
+logger = logging.getLogger(__name__)
+
+
+def make_consumer_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _shard(event: dict) -> int:
+    # события одной записи — всегда в одном шарде, внутри шарда порядок потока сохраняется
+    key = coalesce.appointment_key(event) or "0"
+    return zlib.crc32(key.encode()) % max(1, settings.ALTEGIO_STREAM_CONCURRENCY)
+
+
+async def apply_events(r: aioredis.Redis, events: list[dict]) -> None:
+    # те же apply_altegio_events, что и у Celery-пути, но на AsyncSession (run_sync)
+    async with AsyncSessionLocal() as db:
+        _, diff = await db.run_sync(apply_altegio_events, events)
+        await db.commit()
+    await timer_wheel.amirror(r, diff.planned)
+    await timer_wheel.aunmirror(r, diff.canceled)
+
+
+async def _active_blockers(r: aioredis.Redis, keys: set[str]) -> dict[str, str]:
+    # блокировка, чьё событие уже не pending (применено другим consumer-ом, обрезано MAXLEN), снимается
+    active = {}
+    for key, entry_id in (await event_stream.blockers(r, keys)).items():
+        if await event_stream.deliveries(r, entry_id):
+            active[key] = entry_id
+        else:
+            await event_stream.unblock(r, key, entry_id)
+    return active
+
+
+async def process_shard(r: aioredis.Redis, entries: list[event_stream.Entry]) -> None:
+    """
+    Шард — одной транзакцией; если она падает, события применяются по одному.
+    Упавшее событие остаётся pending (XAUTOCLAIM вернёт его позже) и блокирует свою запись:
+    более новые события этой записи тоже остаются pending и применяются только после него,
+    иначе повторное применение старого события затёрло бы новое состояние.
+    После ALTEGIO_STREAM_MAX_DELIVERIES доставок событие уходит в dead-letter stream и блокировку снимает.
+    """
+    keyed = [(entry_id, event, coalesce.appointment_key(event)) for entry_id, event in entries]
+    blocked = await _active_blockers(r, {key for _, _, key in keyed if key})
+    in_batch = {entry_id for entry_id, _, _ in keyed}
+    # запись заблокирована событием не из этой пачки — её события ждут, пока оно вернётся через XAUTOCLAIM
+    ready = [item for item in keyed if item[2] not in blocked or blocked[item[2]] in in_batch]
+    if not ready:
+        return
+
+    try:
+        await apply_events(r, [event for _, event, _ in ready])
+        await event_stream.ack(r, [entry_id for entry_id, _, _ in ready])
+        for key, entry_id in blocked.items():
+            if entry_id in in_batch:
+                await event_stream.unblock(r, key, entry_id)
+        return
+    except Exception as e:
+        logger.warning("Altegio stream batch failed, applying events one by one", extra={"events": len(ready), "error": str(e)})
+
+    failed_keys: set[str] = set()
+    for entry_id, event, key in ready:
+        if key in failed_keys:
+            continue
+        try:
+            await apply_events(r, [event])
+            await event_stream.ack(r, [entry_id])
+            if key:
+                await event_stream.unblock(r, key, entry_id)
+        except Exception as e:
+            if await event_stream.deliveries(r, entry_id) >= settings.ALTEGIO_STREAM_MAX_DELIVERIES:
+                await event_stream.dead_letter(r, entry_id, event, str(e))
+                if key:
+                    await event_stream.unblock(r, key, entry_id)
+                logger.error("Altegio event dead-lettered", extra={"entry_id": entry_id, "event_key": event.get("event_key"), "error": str(e)})
+            else:
+                if key:
+                    failed_keys.add(key)
+                    await event_stream.block(r, key, entry_id)
+                logger.warning("Altegio event failed, left pending", extra={"entry_id": entry_id, "error": str(e)})
+
+
+async def process_entries(r: aioredis.Redis, entries: list[event_stream.Entry]) -> None:
+    # до ALTEGIO_STREAM_CONCURRENCY транзакций параллельно, по шардам записей
+    shards: dict[int, list[event_stream.Entry]] = defaultdict(list)
+    for entry in entries:
+        shards[_shard(entry[1])].append(entry)
+    await asyncio.gather(*(process_shard(r, shard) for shard in shards.values()))
+
+
+async def run_consumer() -> None:
+    """
+    ALTEGIO_EVENTS_STREAM: asyncio-замена Celery-обработки webhook-ов Altegio.
+    XREADGROUP пачками по ALTEGIO_STREAM_BATCH_SIZE, применение шардами через AsyncSessionLocal, XACK.
+    Раз в ALTEGIO_STREAM_CLAIM_IDLE_SECONDS забирает зависшие pending-записи других consumer-ов.
+    Масштабируется запуском нескольких процессов (каждый — свой consumer в группе).
+    """
+    r = aioredis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    await event_stream.ensure_group(r)
+    consumer = make_consumer_name()
+    batch_size = settings.ALTEGIO_STREAM_BATCH_SIZE
+    claim_idle_ms = int(settings.ALTEGIO_STREAM_CLAIM_IDLE_SECONDS * 1000)
+    last_claim = 0.0
+
+    logger.info("Altegio stream consumer started", extra={"consumer": consumer})
+
+    while True:
+        if time.monotonic() - last_claim >= settings.ALTEGIO_STREAM_CLAIM_IDLE_SECONDS:
+            stale = await event_stream.reclaim(r, consumer, claim_idle_ms, batch_size)
+            if stale:
+                logger.warning("Reclaimed pending Altegio stream entries", extra={"count": len(stale)})
+                await process_entries(r, stale)
+            last_claim = time.monotonic()
+
+        entries = await event_stream.read(r, consumer, batch_size, block_ms=5000)
+        if entries:
+            await process_entries(r, entries)
+
+
+def main() -> None:
+    configure_role("consumer")
+    asyncio.run(run_consumer())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=settings.LOG_LEVEL)
+    main()